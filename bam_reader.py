@@ -0,0 +1,631 @@
+#!/usr/bin/env python
+"""
+Bare-bones BAM reading, without samtools
+
+BAM files are a series of BGZF blocks, each a small gzip member, and the
+uncompressed stream is a header followed by binary alignment records.  Here we
+provide the block layer (BgzfReader), access to the raw records, and decoding
+of the fields of a record into the same values a SAM line would have.
+
+BAI index files let us read only the part of a coordinate-sorted BAM file
+that covers some region (see read_bam_index and index_chunks).
+
+References:
+  [1] The SAM Format Specification (samtools.github.io/hts-specs/SAMv1.pdf),
+      section 4, "The BAM Format Specification", and section 5, "Indexing BAM"
+"""
+
+from sys    import byteorder
+from struct import Struct,unpack,unpack_from
+from os.path import exists
+from array  import array
+from itertools import chain
+from time   import time
+from threading import Thread,Event
+from Queue  import Queue
+import zlib
+
+BGZF_MAGIC = "\x1f\x8b"
+BAM_MAGIC  = "BAM\x01"
+BAI_MAGIC  = "BAI\x01"
+
+BAI_PSEUDO_BIN   = 37450	# (holds metadata, not chunks of records)
+BAI_LINEAR_SHIFT = 14		# (linear index has a 16K window size)
+
+bamCoreStruct  = Struct("<iiBBHHHiiii")	# refID,pos,l_read_name,mapq,bin,
+                                       	# .. n_cigar_op,flag,l_seq,next_refID,
+                                       	# .. next_pos,tlen
+BAM_CORE_SIZE  = bamCoreStruct.size    	# (32 bytes)
+unpack_bam_core = bamCoreStruct.unpack_from
+recordSizeStruct = Struct("<i")
+
+bamCigarOps     = "MIDNSHP=X"
+bamSeqBases     = "=ACMGRSVTWYHKDBN"
+bamSeqPairs     = [a+b for a in bamSeqBases for b in bamSeqBases]
+bamQualToText   = "".join([chr((q+33) & 0xFF) for q in xrange(256)])
+
+bamTagIntTypes  = { "c":"<b", "C":"<B", "s":"<h", "S":"<H", "i":"<i", "I":"<I" }
+bamTagSizes     = { "A":1, "c":1, "C":1, "s":2, "S":2, "i":4, "I":4, "f":4 }
+
+
+class BamError(Exception): pass
+
+
+# BgzfReader--
+#	Reads the uncompressed stream of a BGZF file.
+#
+#	Positions in the stream are "virtual offsets", (blockAddress<<16)+offset,
+#	where blockAddress is the file position of the compressed block and offset
+#	is the position within its uncompressed data.  As htslib does, once a
+#	block's data has been consumed we consider the position to be the start of
+#	the next block.
+#
+#	The raw (compressed) blocks are read by read_raw_block(), and inflated by
+#	inflate_block();  a subclass can override next_data() to inflate blocks
+#	some other way, e.g. ahead of time.
+
+class BgzfReader(object):
+
+	def __init__(self,f,prefix=""):
+		self.f            = f
+		self.prefix       = prefix	# bytes already read from f (e.g. by sniffing)
+		self.nextAddress  = 0		# file position of the next raw block
+		self.blockAddress = 0
+		self.data         = ""
+		self.offset       = 0
+		self.blocksRead   = 0
+		self.startTime    = None
+		self.stopTime     = None
+
+	def read_file(self,n):
+		if (self.prefix == ""): return self.f.read(n)
+		s = self.prefix[:n]
+		self.prefix = self.prefix[n:]
+		if (len(s) < n): s += self.f.read(n-len(s))
+		return s
+
+	def read_raw_block(self):
+		# returns (blockAddress,compressedData,uncompressedSize), or None at
+		# the end of the file
+		address = self.nextAddress
+		header = self.read_file(12)
+		if (header == ""): return None
+		if (len(header) < 12) or (not header.startswith("\x1f\x8b\x08\x04")):
+			raise BamError("bad BGZF block header at file position %d" % address)
+		(xLen,) = unpack_from("<H",header,10)
+		extra = self.read_file(xLen)
+		blockSize = None
+		ix = 0
+		while (ix+4 <= len(extra)):
+			(sLen,) = unpack_from("<H",extra,ix+2)
+			if (extra[ix:ix+2] == "BC") and (sLen == 2):
+				(blockSize,) = unpack_from("<H",extra,ix+4)
+				blockSize += 1
+			ix += 4 + sLen
+		if (blockSize == None):
+			raise BamError("BGZF block at file position %d lacks a BC field" % address)
+		rest = self.read_file(blockSize - 12 - xLen)
+		if (len(rest) != blockSize - 12 - xLen):
+			raise BamError("truncated BGZF block at file position %d" % address)
+		(uncompressedSize,) = unpack_from("<I",rest,len(rest)-4)
+		self.nextAddress = address + blockSize
+		return (address,rest[:-8],uncompressedSize)
+
+	def next_data(self):
+		# returns (blockAddress,data) for the next block, or None
+		rawBlock = self.read_raw_block()
+		if (rawBlock == None): return None
+		return inflate_block(rawBlock)
+
+	def next_block(self):
+		# advance to the next block;  returns False at the end of the file
+		if (self.startTime == None): self.startTime = time()
+		block = self.next_data()
+		if (block == None):
+			self.blockAddress = self.nextAddress
+			(self.data,self.offset) = ("",0)
+			self.stopTime = time()
+			return False
+		(self.blockAddress,self.data) = block
+		self.offset = 0
+		self.blocksRead += 1
+		return True
+
+	def tell(self):
+		while (self.offset >= len(self.data)):
+			if (not self.next_block()): break
+		return (self.blockAddress << 16) | self.offset
+
+	def seek(self,virtualOffset):
+		(address,offset) = (virtualOffset >> 16,virtualOffset & 0xFFFF)
+		if (address != self.blockAddress) or (self.data == ""):
+			self.f.seek(address)
+			self.prefix      = ""
+			self.nextAddress = address
+			self.next_block()
+		self.offset = offset
+
+	def read(self,n):
+		parts = []
+		while (n > 0):
+			if (self.offset >= len(self.data)):
+				if (not self.next_block()): break
+				continue
+			part = self.data[self.offset:self.offset+n]
+			self.offset += len(part)
+			n -= len(part)
+			parts += [part]
+		return "".join(parts)
+
+	def records(self,endOffset=None):
+		# yields raw alignment records (without their length prefix);  if
+		# endOffset is given, we stop at that virtual offset
+		return chain.from_iterable(self.record_lists(endOffset))
+
+	def record_lists(self,endOffset=None):
+		# yields lists of raw alignment records, generally all those in one
+		# block;  iterating over these (e.g. with chain.from_iterable) is
+		# considerably faster than yielding records one at a time
+		unpack_size = recordSizeStruct.unpack_from
+		while (True):
+			(data,offset) = (self.data,self.offset)
+			if (offset >= len(data)):
+				if (not self.next_block()): return
+				continue
+
+			# usual case, records entirely within this block
+
+			if (endOffset == None): blockEnd = len(data)
+			else:                   blockEnd = self.block_end(endOffset)
+			records = []
+			while (offset < blockEnd) and (offset+4 <= len(data)):
+				recordEnd = offset + 4 + unpack_size(data,offset)[0]
+				if (recordEnd > len(data)): break
+				records += [data[offset+4:recordEnd]]
+				offset = recordEnd
+			self.offset = offset
+			if (records != []): yield records
+			if (offset >= blockEnd) and (blockEnd < len(data)): return
+			if (offset >= len(data)): continue
+
+			# otherwise, the record spans blocks
+
+			sizeBytes = self.read(4)
+			if (len(sizeBytes) < 4): raise BamError("truncated BAM record")
+			(size,) = unpack("<i",sizeBytes)
+			record = self.read(size)
+			if (len(record) < size): raise BamError("truncated BAM record")
+			yield [record]
+
+	def close(self):
+		pass
+
+	def report(self,f):
+		print >>f, "=== bgzf decompression ==="
+		print >>f, "  blocks:      %d" % self.blocksRead
+		elapsed = self.elapsed()
+		if (elapsed > 0):
+			print >>f, "  blocks/s:    %.1f" % (self.blocksRead / elapsed)
+
+	def elapsed(self):
+		if (self.startTime == None): return 0.0
+		stopTime = self.stopTime if (self.stopTime != None) else time()
+		return stopTime - self.startTime
+
+	def chunk_records(self,chunks):
+		# yields lists of the raw records in each of a series of chunks,
+		# which are (startOffset,endOffset) pairs, in file order
+		for (startOffset,endOffset) in chunks:
+			self.seek(startOffset)
+			for records in self.record_lists(endOffset):
+				yield records
+
+	def block_end(self,endOffset):
+		# the offset within the current block at which to stop, for a virtual
+		# end offset (len(data) if it's beyond this block)
+		if ((endOffset >> 16) > self.blockAddress): return len(self.data)
+		if ((endOffset >> 16) < self.blockAddress): return 0
+		return min(endOffset & 0xFFFF,len(self.data))
+
+
+def inflate_block((address,compressedData,uncompressedSize)):
+	data = zlib.decompress(compressedData,-15)
+	if (len(data) != uncompressedSize):
+		raise BamError("BGZF block at file position %d inflates to %d bytes, expected %d" \
+		             % (address,len(data),uncompressedSize))
+	return (address,data)
+
+
+# ThreadedBgzfReader--
+#	BgzfReader that inflates blocks concurrently, in a pool of threads (zlib
+#	releases the GIL while it inflates).
+#
+#	A reader thread reads raw blocks from the file and queues them for the
+#	inflating threads;  it also queues, in file order, a "slot" for each block,
+#	which the inflating thread fills in.  We take the slots in order, so block
+#	order is preserved.  Both queues are bounded by readahead (a number of
+#	blocks), which bounds the memory used.  An exception in any of the threads
+#	(e.g. an IOError from reading the file) is posted in a slot, and raised
+#	when we reach that slot.
+#
+#	stallTime is how long we've waited for blocks that weren't inflated yet.
+
+class InflateSlot:
+	def __init__(self,rawBlock):
+		self.rawBlock = rawBlock
+		self.block    = None
+		self.error    = None
+		self.done     = Event()
+
+
+class ThreadedBgzfReader(BgzfReader):
+
+	def __init__(self,f,prefix="",numThreads=2,readahead=None):
+		BgzfReader.__init__(self,f,prefix)
+		if (readahead == None): readahead = 4*numThreads
+		self.numThreads = max(1,numThreads)
+		self.readahead  = max(1,readahead)
+		self.slots      = None
+		self.stallTime  = 0.0
+
+	def start(self):
+		# (the slots queue bounds the readahead;  the work queue is unbounded so
+		# that stop() can always post its end markers, even if the inflaters
+		# have already quit at the end of the file)
+		self.slots   = Queue(self.readahead)
+		self.work    = Queue()
+		self.stopped = False
+		self.threads = [Thread(target=self.read_raw_blocks)]
+		for _ in xrange(self.numThreads):
+			self.threads += [Thread(target=self.inflate_blocks)]
+		for thread in self.threads:
+			thread.daemon = True
+			thread.start()
+
+	def stop(self):
+		# shut down the threads, e.g. before seeking;  the reader thread may
+		# be blocked on a full queue, so we drain the queues until it's done
+		if (self.slots == None): return
+		self.stopped = True
+		while (self.threads[0].is_alive()):
+			while (not self.slots.empty()): self.slots.get()
+			self.threads[0].join(0.01)
+		for _ in xrange(self.numThreads): self.work.put(None)
+		for thread in self.threads[1:]: thread.join()
+		self.slots = None
+
+	def read_raw_blocks(self):
+		# (runs in the reader thread)
+		try:
+			while (not self.stopped):
+				rawBlock = self.read_raw_block()
+				if (rawBlock == None): break
+				slot = InflateSlot(rawBlock)
+				self.work.put(slot)
+				self.slots.put(slot)
+		except Exception, ex:
+			slot = InflateSlot(None)
+			slot.error = ex
+			slot.done.set()
+			self.slots.put(slot)
+		if (not self.stopped):
+			self.slots.put(None)
+			for _ in xrange(self.numThreads): self.work.put(None)
+
+	def inflate_blocks(self):
+		# (runs in each inflating thread)
+		while (True):
+			slot = self.work.get()
+			if (slot == None): break
+			try:
+				slot.block = inflate_block(slot.rawBlock)
+			except Exception, ex:
+				slot.error = ex
+			slot.rawBlock = None
+			slot.done.set()
+
+	def next_data(self):
+		if (self.slots == None): self.start()
+		waitStart = None
+		if (self.slots.empty()): waitStart = time()
+		slot = self.slots.get()
+		if (slot != None) and (not slot.done.is_set()):
+			if (waitStart == None): waitStart = time()
+			slot.done.wait()
+		if (waitStart != None): self.stallTime += time() - waitStart
+		if (slot == None):
+			self.slots.put(None)	# (so that later calls also see the end)
+			return None
+		if (slot.error != None): raise slot.error
+		return slot.block
+
+	def seek(self,virtualOffset):
+		address = virtualOffset >> 16
+		if (address != self.blockAddress) or (self.data == ""):
+			self.stop()
+		BgzfReader.seek(self,virtualOffset)
+
+	def close(self):
+		self.stop()
+
+	def report(self,f):
+		BgzfReader.report(self,f)
+		print >>f, "  threads:     %d (readahead %d blocks)" % (self.numThreads,self.readahead)
+		print >>f, "  queue stall: %.3fs (of %.3fs)" % (self.stallTime,self.elapsed())
+
+
+# read_bam_index--
+#	Read a BAI index file, returning a list with an entry for each reference
+#	sequence;  each entry is (bins,linear), where bins maps bin number to a
+#	list of chunks, (startOffset,endOffset) pairs of virtual offsets, and linear
+#	is the list of minimum virtual offsets for each 16K window.
+
+def read_bam_index(filename):
+	f = file(filename,"rb")
+	data = f.read()
+	f.close()
+
+	if (not data.startswith(BAI_MAGIC)):
+		raise BamError("%s is not a BAI index (bad magic number)" % filename)
+
+	ix = 4
+	(numRefs,) = unpack_from("<i",data,ix)
+	ix += 4
+
+	index = []
+	for _ in xrange(numRefs):
+		(numBins,) = unpack_from("<i",data,ix)
+		ix += 4
+		bins = {}
+		for _ in xrange(numBins):
+			(binNum,numChunks) = unpack_from("<Ii",data,ix)
+			ix += 8
+			chunks = unpack_from("<%dQ" % (2*numChunks),data,ix)
+			ix += 16*numChunks
+			if (binNum == BAI_PSEUDO_BIN): continue
+			bins[binNum] = zip(chunks[0::2],chunks[1::2])
+		(numWindows,) = unpack_from("<i",data,ix)
+		ix += 4
+		linear = unpack_from("<%dQ" % numWindows,data,ix)
+		ix += 8*numWindows
+		index += [(bins,linear)]
+
+	return index
+
+
+def bam_index_filename(bamFilename):
+	# returns the name of the index for a BAM file, or None if there isn't one
+	candidates = [bamFilename + ".bai"]
+	if (bamFilename.endswith(".bam")): candidates += [bamFilename[:-4] + ".bai"]
+	for filename in candidates:
+		if (exists(filename)): return filename
+	return None
+
+
+# index_chunks--
+#	Find the chunks of a BAM file that may contain records overlapping some
+#	regions;  regions are (refID,start,end), origin-zero half-open.  Returns a
+#	list of (startOffset,endOffset) pairs, sorted and with overlapping chunks
+#	merged.  The chunks can contain records outside the regions, so the caller
+#	still has to check each record.
+
+def index_chunks(index,regions):
+	chunks = []
+	for (refID,start,end) in regions:
+		if (refID < 0) or (refID >= len(index)): continue
+		(bins,linear) = index[refID]
+		window = start >> BAI_LINEAR_SHIFT
+		if (window < len(linear)): minOffset = linear[window]
+		else:                      minOffset = 0
+		for binNum in region_to_bins(start,end):
+			if (binNum not in bins): continue
+			chunks += [chunk for chunk in bins[binNum] if (chunk[1] > minOffset)]
+
+	chunks.sort()
+	merged = []
+	for (startOffset,endOffset) in chunks:
+		if (merged != []) and (startOffset <= merged[-1][1]):
+			if (endOffset > merged[-1][1]):
+				merged[-1] = (merged[-1][0],endOffset)
+		else:
+			merged += [(startOffset,endOffset)]
+
+	return merged
+
+
+def index_end_offset(index):
+	# the virtual offset just past the last record in any chunk of the index;
+	# records with no reference sequence (refID -1) aren't indexed, and in a
+	# coordinate-sorted file they follow this point
+	endOffset = 0
+	for (bins,_) in index:
+		for binNum in bins:
+			for (_,chunkEnd) in bins[binNum]:
+				if (chunkEnd > endOffset): endOffset = chunkEnd
+	return endOffset
+
+
+def region_to_bins(start,end):
+	# the bins that overlap an origin-zero half-open region (see the SAM spec,
+	# section 5.3)
+	end -= 1
+	bins = [0]
+	for (shift,firstBin) in [(26,1),(23,9),(20,73),(17,585),(14,4681)]:
+		bins += range(firstBin+(start>>shift),firstBin+(end>>shift)+1)
+	return bins
+
+
+# read_bam_header--
+#	Read the header of a BAM file, returning an object with the header text,
+#	and the names and lengths of the reference sequences.
+
+class BamHeader: pass
+
+def read_bam_header(bgzf):
+	magic = bgzf.read(4)
+	if (magic != BAM_MAGIC): raise BamError("not a BAM file (bad magic number)")
+
+	(textLen,) = unpack("<i",bgzf.read(4))
+	text = bgzf.read(textLen).rstrip("\x00")
+
+	(numRefs,) = unpack("<i",bgzf.read(4))
+	refNames   = []
+	refLengths = []
+	for _ in xrange(numRefs):
+		(nameLen,) = unpack("<i",bgzf.read(4))
+		refNames   += [bgzf.read(nameLen).rstrip("\x00")]
+		(refLength,) = unpack("<i",bgzf.read(4))
+		refLengths += [refLength]
+
+	header = BamHeader()
+	header.text       = text
+	header.refNames   = refNames
+	header.refLengths = refLengths
+	return header
+
+
+def header_sq_lines(header):
+	lines = [line for line in header.text.split("\n") if (line.startswith("@SQ"))]
+	if (lines == []):
+		lines = ["@SQ\tSN:%s\tLN:%d" % (name,length)
+		         for (name,length) in zip(header.refNames,header.refLengths)]
+	return lines
+
+
+# record field decoding--
+#	These take a raw record (as yielded by BgzfReader.records) and the offsets
+#	of its variable-length parts, which follow the 32-byte core:
+#	  read name    at 32,                         l_read_name bytes
+#	  cigar        at 32+l_read_name,             4*n_cigar_op bytes
+#	  seq          after cigar,                   (l_seq+1)/2 bytes
+#	  qual         after seq,                     l_seq bytes
+#	  tags         after qual,                    the rest of the record
+
+def record_name(record):
+	return record[BAM_CORE_SIZE:BAM_CORE_SIZE+ord(record[8])-1]
+
+
+def cigar_ops(packedCigar):
+	# returns the cigar as a list of (count,operation)
+	ops = array("I",packedCigar)
+	if (byteorder == "big"): ops.byteswap()
+	return [(op >> 4,bamCigarOps[op & 0xF]) for op in ops]
+
+
+def cigar_ops_to_string(packedCigar):
+	if (packedCigar == ""): return "*"
+	return "".join(["%d%s" % (rpt,op) for (rpt,op) in cigar_ops(packedCigar)])
+
+
+def seq_to_string(record,seqStart,seqLen):
+	if (seqLen == 0): return "*"
+	packed = array("B",record[seqStart:seqStart+(seqLen+1)/2])
+	return "".join([bamSeqPairs[b] for b in packed])[:seqLen]
+
+
+def qual_to_string(record,qualStart,seqLen):
+	if (seqLen == 0) or (record[qualStart] == "\xFF"): return "*"
+	return record[qualStart:qualStart+seqLen].translate(bamQualToText)
+
+
+# tags--
+#	Tag values are decoded to match what SAM text would give;  all integer
+#	types become python ints, floats are rounded as samtools prints them (%g),
+#	and arrays become the text after "B:" (e.g. "c,1,2,3").
+
+def tag_values(record,tagsStart,tags):
+	# returns a list of the values of the requested tags (None for missing
+	# tags), in the order requested
+	values = [None] * len(tags)
+	numFound = 0
+	ix = tagsStart
+	end = len(record)
+	while (ix < end) and (numFound < len(tags)):
+		tag = record[ix:ix+2]
+		(val,ix) = decode_tag_value(record,ix+2)
+		if (tag in tags):
+			values[tags.index(tag)] = val
+			numFound += 1
+	return values
+
+
+def tag_fields(record,tagsStart):
+	# returns the SAM text for all the tags, e.g. ["AS:i:50","XS:i:20"]
+	fields = []
+	ix = tagsStart
+	end = len(record)
+	while (ix < end):
+		(tag,typeCode) = (record[ix:ix+2],record[ix+2])
+		(val,ix) = decode_tag_value(record,ix+2)
+		if   (typeCode in bamTagIntTypes): typeCode = "i"
+		elif (typeCode == "f"):            val = "%g" % val
+		fields += ["%s:%s:%s" % (tag,typeCode,val)]
+	return fields
+
+
+def decode_tag_value(record,ix):
+	# ix is the position of the type code;  returns (value,ixAfterValue)
+	typeCode = record[ix]
+	ix += 1
+	if (typeCode in bamTagIntTypes):
+		(val,) = unpack_from(bamTagIntTypes[typeCode],record,ix)
+		return (val,ix+bamTagSizes[typeCode])
+	if (typeCode == "f"):
+		(val,) = unpack_from("<f",record,ix)
+		return (float("%g" % val),ix+4)
+	if (typeCode == "A"):
+		return (record[ix],ix+1)
+	if (typeCode in ["Z","H"]):
+		end = record.index("\x00",ix)
+		return (record[ix:end],end+1)
+	if (typeCode == "B"):
+		subType = record[ix]
+		(count,) = unpack_from("<i",record,ix+1)
+		ix += 5
+		size = bamTagSizes[subType]
+		if (subType == "f"):
+			vals = ["%g" % unpack_from("<f",record,ix+4*i)[0] for i in xrange(count)]
+		else:
+			fmt = bamTagIntTypes[subType]
+			vals = [str(unpack_from(fmt,record,ix+size*i)[0]) for i in xrange(count)]
+		return (",".join([subType] + vals),ix+size*count)
+	raise BamError("unknown BAM tag type \"%s\"" % typeCode)
+
+
+# record_to_sam--
+#	Format a raw record as a SAM line (without a newline), as samtools view
+#	would.
+
+def record_to_sam(record,refNames):
+	(refID,pos,nameLen,mapQ,_,numCigarOps,flag,seqLen,nextRefID,nextPos,tLen) \
+	  = unpack_bam_core(record)
+	cigarStart = BAM_CORE_SIZE + nameLen
+	seqStart   = cigarStart + 4*numCigarOps
+	qualStart  = seqStart + (seqLen+1)/2
+	tagsStart  = qualStart + seqLen
+
+	if   (nextRefID < 0):      rNext = "*"
+	elif (nextRefID == refID): rNext = "="
+	else:                      rNext = refNames[nextRefID]
+
+	fields = [record[BAM_CORE_SIZE:cigarStart-1],
+	          str(flag),
+	          refNames[refID] if (refID >= 0) else "*",
+	          str(pos+1),
+	          str(mapQ),
+	          cigar_ops_to_string(record[cigarStart:seqStart]),
+	          rNext,
+	          str(nextPos+1),
+	          str(tLen),
+	          seq_to_string(record,seqStart,seqLen),
+	          qual_to_string(record,qualStart,seqLen)]
+	return "\t".join(fields + tag_fields(record,tagsStart))
+
+
+# sniff_bgzf--
+#	Read the first two bytes of a file to see whether it is BGZF compressed;
+#	returns (isBgzf,bytesRead), since the file may not be seekable.
+
+def sniff_bgzf(f):
+	magic = f.read(2)
+	return (magic == BGZF_MAGIC,magic)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+"""
+Measure the throughput of filtered_sam_to_intervals' per-record hot path, on
+synthetic SAM records.
+"""
+
+from sys    import argv,stderr,exit
+from time   import time
+from random import Random
+from cStringIO import StringIO
+import filtered_sam_to_intervals as fsi
+
+
+def usage(s=None):
+	message = """
+usage: bench_filtered_sam_to_intervals [options]
+  --records=<number>       number of synthetic SAM records to generate
+                           (default is 200K)
+  --require:<criterion>    (cumulative) requirement, as for
+                           filtered_sam_to_intervals
+  --prohibit:<criterion>   (cumulative) prohibition, as for
+                           filtered_sam_to_intervals
+  --seed=<number>          random number generator seed
+  --repeat=<number>        number of times to repeat each measurement; the
+                           best time is reported
+                           (default is 3)
+
+  If no criteria are given, we use those create_script_insert_depth gives to
+  filtered_sam_to_intervals for MP runs:
+    --prohibit:"(CIGAR == *)" --require:"(RNEXT == =)" --require:"(PORIENT==T2T)"
+
+  Output is a report of records per second for each measurement.  The
+  reference is the per-record processing we used before criteria were
+  compiled (a full split of each line, a fresh context, and eval() of each
+  criterion string);  filtered_sam_to_intervals is measured end to end,
+  including formatting the output.  Before measuring, we check that reordering
+  the criteria (--reorder) doesn't change which records are kept."""
+
+	if (s == None): exit (message)
+	else:           exit ("%s\n%s" % (s,message))
+
+
+def main():
+	global debug
+
+	# parse the command line
+
+	numRecords  = 200*1000
+	criteria    = []
+	seed        = "bench"
+	repeat      = 3
+	debug       = []
+
+	for arg in argv[1:]:
+		if ("=" in arg):
+			argVal = arg.split("=",1)[1]
+
+		if (arg.startswith("--records=")):
+			numRecords = fsi.int_with_unit(argVal)
+		elif (arg.startswith("--require:")) or (arg.startswith("--prohibit:")):
+			criteria += [arg]
+		elif (arg.startswith("--seed=")):
+			seed = argVal
+		elif (arg.startswith("--repeat=")):
+			repeat = int(argVal)
+			if (repeat < 1): usage("repeat must be positive")
+		elif (arg == "--debug"):
+			debug += ["debug"]
+		elif (arg.startswith("--debug=")):
+			debug += argVal.split(",")
+		elif (arg.startswith("--")):
+			usage("unrecognized option: %s" % arg)
+		else:
+			usage("unrecognized option: %s" % arg)
+
+	if (criteria == []):
+		criteria = ["--prohibit:(CIGAR == *)",
+		            "--require:(RNEXT == =)",
+		            "--require:(PORIENT==T2T)"]
+
+	check_reorder(Random(seed))
+
+	samLines = synthetic_sam(numRecords,Random(seed))
+
+	print "%s synthetic SAM records" % fsi.commatize(numRecords)
+	for criterion in criteria:
+		print "  %s" % criterion
+
+	# measure the reference, which is the way records were processed before
+	# criteria were compiled and the record processor was generated-- split
+	# the whole line, build a context holding the safe functions, and eval()
+	# each criterion string
+
+	run_program([],criteria)  # (sets up the program's globals)
+
+	def reference():
+		return reference_filter(samLines)
+
+	def whole_program():
+		return run_program(samLines,criteria)
+
+	(refSecs,refKept) = best_time(reference,repeat)
+	(newSecs,newKept) = best_time(whole_program,repeat)
+	assert (refKept == newKept), \
+	       "filtered_sam_to_intervals disagrees with the reference (%d vs %d records kept)" \
+	     % (newKept,refKept)
+
+	print
+	print "(%s of %s records kept)" % (fsi.commatize(newKept),fsi.commatize(numRecords))
+	report_rate("reference, eval()",          numRecords,refSecs)
+	report_rate("filtered_sam_to_intervals",  numRecords,newSecs,refSecs)
+
+
+# reference_filter--
+#	Filter SAM records as filtered_sam_to_intervals did before any of its
+#	per-record work was specialized;  returns the number of records kept.
+
+def reference_filter(samLines):
+	criteriaStrs =  [fsi.requirements[s][0]          for s in fsi.requirements]
+	criteriaStrs += ["not " + fsi.prohibitions[s][0] for s in fsi.prohibitions]
+
+	kept = 0
+	for line in samLines:
+		fields = line.strip().split()
+		context = dict(fsi.safeDict)
+		for name in fsi.samFieldToColumn:
+			context[name] = fields[fsi.samFieldToColumn[name]]
+		for name in fsi.samIntFields:
+			context[name] = fsi.int_or_string(context[name])
+		context["FLAGS"] = context["FLAG"]
+		context["POS"] -= 1
+		context["CIGARINFO"] = fsi.split_cigar(context["CIGAR"])
+		for field in fields[fsi.SAM_MIN_COLUMNS:]:
+			(tag,typeCode,val) = field.split(":",2)
+			if (tag in fsi.tagToVariable):
+				context[fsi.tagToVariable[tag]] = int(val)
+		for variable in fsi.computedVariables:
+			if (variable not in fsi.variablesNeeded): continue
+			(func,dependencies) = fsi.computedVariables[variable]
+			context[variable] = func(*[context[name] for name in dependencies])
+		for criterion in criteriaStrs:
+			if (not eval(criterion,{"__builtins__":None},context)): break
+		else:
+			kept += 1
+
+	return kept
+
+
+# check_reorder--
+#	Make sure that reordering the criteria (see reorder_criteria) doesn't let
+#	a criterion that can fail get ahead of the one that protects it.  Here
+#	"(MAPQ > 0)" protects "(600/MAPQ > 20)", but none of the warm-up records
+#	have MAPQ 0, so during the warm-up it seems to reject nothing.  Since the
+#	order depends on measured costs, we try it several times.
+
+def check_reorder(rng,window=100,tries=10):
+	samLines = synthetic_sam(20*window,rng)
+	for (ix,line) in enumerate(samLines[:window]):
+		fields = line.split("\t")
+		fields[4] = "60"
+		samLines[ix] = "\t".join(fields)
+
+	criteria = ["--require:(MAPQ > 0)",
+	            "--prohibit:(600/MAPQ > 20)",
+	            "--prohibit:(RNEXT == =)",
+	            "--batchfilter=0"]
+	expected = run_program(samLines,criteria + ["--reorder=0"])
+	for _ in xrange(tries):
+		kept = run_program(samLines,criteria + ["--reorder=%d" % window])
+		assert (kept == expected), \
+		       "reordered criteria disagree with the given order (%d vs %d lines)" \
+		     % (kept,expected)
+
+
+# run_program--
+#	Run filtered_sam_to_intervals in this process;  returns the number of
+#	output lines (which are otherwise discarded).
+
+class LineCounter:
+	def __init__(self): self.lines = 0
+	def write(self,s):  self.lines += s.count("\n")
+
+
+def run_program(samLines,args):
+	saveStdout = fsi.stdout
+	fsi.stdout = counter = LineCounter()
+	fsi.argv   = ["filtered_sam_to_intervals","--nonames"] + args
+	fsi.stdin  = StringIO("".join(samLines))
+	try:
+		fsi.main()
+	finally:
+		fsi.stdout = saveStdout
+	return counter.lines
+
+
+def best_time(func,repeat):
+	bestSecs = None
+	for _ in xrange(repeat):
+		startTime = time()
+		result = func()
+		secs = time() - startTime
+		if (bestSecs == None) or (secs < bestSecs): bestSecs = secs
+	return (bestSecs,result)
+
+
+def report_rate(name,count,secs,refSecs=None):
+	rate = count / max(secs,1e-9)
+	line = "  %-24s %8.3fs %12s records/s" % (name,secs,fsi.commatize(int(rate)))
+	if (refSecs != None): line += "  (%.2fx)" % (refSecs / max(secs,1e-9))
+	print line
+
+
+# synthetic_sam--
+#	Generate name-sorted mate-pair SAM records, roughly resembling our MP
+#	libraries.
+
+def synthetic_sam(numRecords,rng):
+	chroms  = [("chr1",249250621),("chr2",243199373),("chr3",198022430)]
+	cigars  = ["100M"]*12 + ["90M10S","10S90M","5H95M","50M2I48M","60M5D40M","*"]
+	inserts = [400,3000,8000,8000,8000,9000,12000,40000]
+	seq     = "ACGT" * 25
+	qual    = "I" * 100
+
+	lines = []
+	pairNum = 0
+	while (len(lines) < numRecords):
+		pairNum += 1
+		qName = "SYN:%09d" % pairNum
+		(chrom,length) = rng.choice(chroms)
+		pos1 = rng.randint(1,length-50000)
+		pos2 = pos1 + rng.choice(inserts)
+		tLen = pos2 - pos1 + 100
+		for mate in [1,2]:
+			if (mate == 1): (flag,pos,pNext,sign) = (0x051,pos1,pos2,+1)
+			else:           (flag,pos,pNext,sign) = (0x0A1,pos2,pos1,-1)
+			if (rng.random() < 0.15): flag ^= 0x030
+			cigar = rng.choice(cigars)
+			if (cigar == "*"): flag |= 0x004
+			rNext = "="
+			if (rng.random() < 0.05): rNext = rng.choice(chroms)[0]
+			fields = [qName,str(flag),chrom,str(pos),str(rng.choice([0,20,60,60])),
+			          cigar,rNext,str(pNext),str(sign*tLen),seq,qual,
+			          "AS:i:%d" % rng.randint(50,100),"XS:i:%d" % rng.randint(20,100)]
+			lines += ["\t".join(fields) + "\n"]
+
+	return lines[:numRecords]
+
+
+if __name__ == "__main__": main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""
+Packed binary interval streams
+
+Our tools normally pass intervals to each other as text lines of
+<chrom> <start> <end> [<value>...].  As an alternative (--in=binary and
+--out=binary) they can use a binary stream, which saves formatting the
+numbers as text and then parsing them again.
+
+A stream is an 8-byte header followed by a series of frames.  The header is
+"IVLB", a version byte, the type of the values ("i" for 32-bit integers or
+"d" for 64-bit floats), the number of values in each record, and a pad byte.
+Each frame is a kind byte, three pad bytes, and a 32-bit count:
+  "D" frames add count names to the chromosome dictionary;  each name is a
+      16-bit length followed by the name
+  "R" frames hold count fixed-width records, each a 32-bit chromosome number
+      (the position of its name in the dictionary), 32-bit start and end, and
+      the values
+A chromosome's name is always in a D frame before any record that uses it,
+so a writer needn't know the chromosomes in advance.  All numbers are little-
+endian.  Intervals are always origin-zero, half-open.
+
+read_interval_arrays gives the records of a stream as a NumPy array, without
+any per-record python work;  NumPy is only needed for that function.
+"""
+
+from struct import Struct,pack
+
+INTERVALS_MAGIC   = "IVLB"
+INTERVALS_VERSION = 1
+
+headerStruct = Struct("<4sBcBx")	# magic,version,value type,number of values
+frameStruct  = Struct("<cxxxI")		# kind,count
+nameLengthStruct = Struct("<H")
+
+RECORDS_PER_FRAME = 4096
+
+
+class IntervalStreamError(Exception): pass
+
+
+def record_format(valueType,numValues):
+	return "<iii" + (valueType * numValues)
+
+
+# IntervalWriter--
+#	Writes intervals to a binary stream.  Records are buffered and written in
+#	frames;  close() writes whatever is still buffered (but doesn't close the
+#	underlying file).
+
+class IntervalWriter:
+
+	def __init__(self,f,valueType="i",numValues=0):
+		if (valueType not in ["i","d"]):
+			raise IntervalStreamError("unsupported value type \"%s\"" % valueType)
+		self.f          = f
+		self.chromToNum = {}
+		self.pending    = []
+		self.pack       = Struct(record_format(valueType,numValues)).pack
+		self.numValues  = numValues
+		f.write(headerStruct.pack(INTERVALS_MAGIC,INTERVALS_VERSION,valueType,numValues))
+
+	def write(self,chrom,start,end,*values):
+		try:
+			chromNum = self.chromToNum[chrom]
+		except KeyError:
+			chromNum = self.new_chrom(chrom)
+		self.pending.append(self.pack(chromNum,start,end,*values))
+		if (len(self.pending) >= RECORDS_PER_FRAME): self.flush()
+
+	def new_chrom(self,chrom):
+		self.flush()
+		chromNum = len(self.chromToNum)
+		self.chromToNum[chrom] = chromNum
+		self.f.write(frameStruct.pack("D",1) + nameLengthStruct.pack(len(chrom)) + chrom)
+		return chromNum
+
+	def flush(self):
+		if (self.pending == []): return
+		self.f.write(frameStruct.pack("R",len(self.pending)))
+		self.f.write("".join(self.pending))
+		self.pending = []
+
+	def close(self):
+		self.flush()
+		self.f.flush()
+
+
+# read_binary_intervals--
+#	Yield (chrom,start,end,value1,value2,...) for each record in a binary
+#	stream.  If the caller has already read the first bytes of the stream
+#	(e.g. to decide whether it is binary), it passes them as prefix.
+
+def read_binary_intervals(f,prefix=""):
+	(_,valueType,numValues) = read_stream_header(f,prefix)
+	recordStruct = Struct(record_format(valueType,numValues))
+	recordSize   = recordStruct.size
+	unpack_from  = recordStruct.unpack_from
+
+	chroms = []
+	for (kind,count,payload) in read_frames(f,recordSize):
+		if (kind == "D"):
+			chroms += parse_names(count,payload)
+			continue
+		for ix in xrange(0,count*recordSize,recordSize):
+			record = unpack_from(payload,ix)
+			yield (chroms[record[0]],) + record[1:]
+
+
+# read_interval_arrays--
+#	Read a binary stream into a NumPy structured array, returning
+#	(chroms,records);  the records' fields are chrom (the index of the
+#	chromosome name in chroms), start, end, and value (or value1, value2, ...
+#	if there is more than one).
+
+def read_interval_arrays(f,prefix=""):
+	import numpy
+
+	(_,valueType,numValues) = read_stream_header(f,prefix)
+	valueDtype = {"i":"<i4", "d":"<f8"}[valueType]
+	fields = [("chrom","<i4"),("start","<i4"),("end","<i4")]
+	if (numValues == 1):
+		fields += [("value",valueDtype)]
+	else:
+		for valueNum in xrange(numValues):
+			fields += [("value%d" % (valueNum+1),valueDtype)]
+	dtype = numpy.dtype(fields)
+	recordSize = Struct(record_format(valueType,numValues)).size
+	assert (dtype.itemsize == recordSize)
+
+	chroms   = []
+	payloads = []
+	for (kind,count,payload) in read_frames(f,recordSize):
+		if (kind == "D"): chroms += parse_names(count,payload)
+		else:             payloads += [payload]
+
+	records = numpy.frombuffer("".join(payloads),dtype=dtype)
+	return (chroms,records)
+
+
+def read_stream_header(f,prefix=""):
+	header = prefix + f.read(headerStruct.size-len(prefix))
+	if (len(header) < headerStruct.size) or (not header.startswith(INTERVALS_MAGIC)):
+		raise IntervalStreamError("input is not a binary interval stream")
+	(_,version,valueType,numValues) = headerStruct.unpack(header)
+	if (version != INTERVALS_VERSION):
+		raise IntervalStreamError("unsupported binary interval stream version (%d)" % version)
+	if (valueType not in ["i","d"]):
+		raise IntervalStreamError("unsupported value type \"%s\"" % valueType)
+	return (version,valueType,numValues)
+
+
+def read_frames(f,recordSize):
+	while (True):
+		frameHeader = f.read(frameStruct.size)
+		if (frameHeader == ""): break
+		if (len(frameHeader) < frameStruct.size):
+			raise IntervalStreamError("binary interval stream is truncated")
+		(kind,count) = frameStruct.unpack(frameHeader)
+		if (kind == "D"):
+			payload = ""
+			for _ in xrange(count):
+				nameLength = f.read(nameLengthStruct.size)
+				if (len(nameLength) < nameLengthStruct.size):
+					raise IntervalStreamError("binary interval stream is truncated")
+				(nameLength,) = nameLengthStruct.unpack(nameLength)
+				payload += pack("<H",nameLength) + f.read(nameLength)
+		elif (kind == "R"):
+			payload = f.read(count*recordSize)
+			if (len(payload) < count*recordSize):
+				raise IntervalStreamError("binary interval stream is truncated")
+		else:
+			raise IntervalStreamError("bad frame kind (\"%s\") in binary interval stream" % kind)
+		yield (kind,count,payload)
+
+
+def parse_names(count,payload):
+	names = []
+	ix = 0
+	for _ in xrange(count):
+		(nameLength,) = nameLengthStruct.unpack_from(payload,ix)
+		ix += nameLengthStruct.size
+		names += [payload[ix:ix+nameLength]]
+		ix += nameLength
+	return names
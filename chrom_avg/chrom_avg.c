@@ -46,6 +46,8 @@ int   precision        = 0;
 int   originOne        = false;
 int   reportBatches    = false;
 int   reportChroms     = false;
+int   binaryIn         = false;
+int   binaryOut        = false;
 
 // counting parameters
 // $$$ eventually I'd like to let the user set these to 1, 2 or 4 bytes
@@ -104,6 +106,31 @@ static int   read_interval        (FILE* f,
                                    char* buffer, int bufferLen, int valCol,
                                    char** chrom, u32* start, u32* end,
                                    double* val);
+static int   read_binary_interval (FILE* f, int valCol,
+                                   char** chrom, u32* start, u32* end,
+                                   double* val);
+static void  write_interval       (char* chrom, u32 start, u32 end, double val);
+static void  flush_binary_records (void);
+static u32   get_le32             (unsigned char* p);
+static u64   get_le64             (unsigned char* p);
+static void  put_le32             (unsigned char* p, u32 v);
+static void  put_le64             (unsigned char* p, u64 v);
+
+//----------
+//
+// binary interval streams--
+//	(see binary_intervals.py for the format;  all numbers are little-endian)
+//
+//----------
+
+#define binaryHeaderBytes  8
+#define binaryFrameBytes   8
+#define binaryMaxValues    255
+#define binaryMaxRecords   4096
+#define binaryOutRecordBytes (12+8)	// (our output has a single double value)
+
+static const char binaryMagic[4] = { 'I', 'V', 'L', 'B' };
+#define binaryVersion 1
 
 //----------
 //
@@ -137,6 +164,10 @@ static void usage
 	fprintf (stderr, "  --origin=one             input/output intervals are origin-one, closed\n");
 	fprintf (stderr, "  --origin=zero            input/output intervals are origin-zero, half-open\n");
 	fprintf (stderr, "                           (this is the default)\n");
+	fprintf (stderr, "  --in=binary              input is a binary interval stream (see\n");
+	fprintf (stderr, "                           binary_intervals.py);  --value=<col> counts the\n");
+	fprintf (stderr, "                           record's values as columns 4, 5, etc.\n");
+	fprintf (stderr, "  --out=binary             write output as a binary interval stream\n");
 	fprintf (stderr, "  --progress               report each batch of the chromosome encountered\n");
 	fprintf (stderr, "  --progress=chromosome    report each chromosome as we encounter it\n");
 	fprintf (stderr, "  --version                report the program version and quit\n");
@@ -231,6 +262,20 @@ static void parse_options
 		 || (strcmp (arg, "--origin=0")   == 0))
 			{ originOne = false;  goto next_arg; }
 
+		// --in=binary, --in=text, --out=binary, --out=text
+
+		if (strcmp (arg, "--in=binary") == 0)
+			{ binaryIn = true;  goto next_arg; }
+
+		if (strcmp (arg, "--in=text") == 0)
+			{ binaryIn = false;  goto next_arg; }
+
+		if (strcmp (arg, "--out=binary") == 0)
+			{ binaryOut = true;  goto next_arg; }
+
+		if (strcmp (arg, "--out=text") == 0)
+			{ binaryOut = false;  goto next_arg; }
+
 		// --progress and --progress=chromosome
 
 		if (strcmp (arg, "--progress")  == 0)
@@ -315,6 +360,11 @@ static void parse_options
 	if (chromsOfInterest == NULL)
 		chastise ("gotta give me some chromosome names\n");
 
+	// binary intervals are always origin-zero
+
+	if ((originOne) && ((binaryIn) || (binaryOut)))
+		chastise ("binary intervals are always origin-zero, so --origin=one can't be used\n");
+
 	// assign default chromosome lengths
 
 	if (allChromLength == 0)
@@ -384,8 +434,11 @@ int main
 
 	while (true)
 		{
-		ok = read_interval (stdin, lineBuffer, sizeof(lineBuffer), valColumn,
-	                        &chrom, &start, &end, &val);
+		if (binaryIn)
+			ok = read_binary_interval (stdin, valColumn, &chrom, &start, &end, &val);
+		else
+			ok = read_interval (stdin, lineBuffer, sizeof(lineBuffer), valColumn,
+		                        &chrom, &start, &end, &val);
 		if (!ok) break;
 
 		//fprintf (stderr, "%s %u %u %f\n", chrom, start, end, val);
@@ -478,9 +531,8 @@ int main
 			if (cv32[ix] == 0)
 				{
 				if ((active) && (ix != start))
-					printf ("%s\t%d\t%d\t%.*f\n",
-					        chromSpec->chrom, chromSpec->start+start+o, chromSpec->start+ix,
-					        precision, val);
+					write_interval (chromSpec->chrom, chromSpec->start+start+o,
+					                chromSpec->start+ix, val);
 				active = false;  start = 0;  val = 0.0;
 				continue;
 				}
@@ -495,20 +547,21 @@ int main
 			if (newVal != val)
 				{
 				if (ix != start)
-					printf ("%s\t%d\t%d\t%.*f\n",
-					        chromSpec->chrom, chromSpec->start+start+o, chromSpec->start+ix,
-					        precision, val);
+					write_interval (chromSpec->chrom, chromSpec->start+start+o,
+					                chromSpec->start+ix, val);
 				active = true;  start = ix;  val = newVal;
 				continue;
 				}
 			}
 
 		if ((active) && (chromSpec->length != start))
-			printf ("%s\t%d\t%d\t%.*f\n",
-			        chromSpec->chrom, chromSpec->start+start+o, chromSpec->start+chromSpec->length,
-			        precision, val);
+			write_interval (chromSpec->chrom, chromSpec->start+start+o,
+			                chromSpec->start+chromSpec->length, val);
 		}
 
+	if (binaryOut)
+		flush_binary_records ();
+
 	//////////
 	// success
 	//////////
@@ -717,3 +770,316 @@ no_value:
 	exit (EXIT_FAILURE);
 	}
 
+
+//----------
+//
+// read_binary_interval--
+//	Read the next interval from a binary interval stream.
+//
+//----------
+//
+// Arguments:
+//	FILE*	f:			File to read from.
+//	int		valCol:		The column that contains interval value;  the
+//						.. record's values are columns 4, 5, etc.
+//	char**	chrom:		Place to return a pointer to the chromosome.  The
+//						.. returned value will point into our chromosome
+//						.. dictionary, which persists for the life of the
+//						.. program.
+//	u32*	start:		Place to return the start.
+//	u32*	end:		Place to return the end.
+//	double*	val:		Place to return the value.
+//
+// Returns:
+//	true if we were successful;  false if there are no more records in the
+//	file.
+//
+//----------
+
+static int read_binary_interval
+   (FILE*		f,
+	int			valCol,
+	char**		_chrom,
+	u32*		_start,
+	u32*		_end,
+	double*		_val)
+	{
+	static int		headerRead  = false;
+	static char		valueType   = 'i';
+	static int		valueBytes  = 4;
+	static int		recordBytes = 12;
+	static char**	names       = NULL;
+	static u32		numNames    = 0;
+	static u32		namesLen    = 0;
+	static u32		recordsLeft = 0;
+	static u32		recordNumber = 0;
+	unsigned char	header[binaryHeaderBytes];
+	unsigned char	record[12+8*binaryMaxValues];
+	unsigned char	lengthBytes[2];
+	u32				count, nameNum, nameLen, chromNum;
+	int				numValues, valIx;
+	size_t			bytesRead;
+	u64				bits;
+	double			val;
+
+	valIx = valCol - 3;
+
+	// read the stream header
+
+	if (!headerRead)
+		{
+		bytesRead = fread (header, 1, binaryHeaderBytes, f);
+		if ((bytesRead != binaryHeaderBytes)
+		 || (memcmp (header, binaryMagic, sizeof(binaryMagic)) != 0))
+			goto not_binary;
+		if (header[4] != binaryVersion) goto bad_version;
+		valueType = (char) header[5];
+		if      (valueType == 'i') valueBytes = 4;
+		else if (valueType == 'd') valueBytes = 8;
+		else goto bad_value_type;
+		numValues   = header[6];
+		recordBytes = 12 + numValues*valueBytes;
+		if (valIx >= numValues) goto no_value;
+		headerRead = true;
+		}
+
+	// read frames until we have a record;  any chromosome names are added
+	// to the dictionary
+
+	while (recordsLeft == 0)
+		{
+		bytesRead = fread (header, 1, binaryFrameBytes, f);
+		if (bytesRead == 0) return false;
+		if (bytesRead != binaryFrameBytes) goto truncated;
+		count = get_le32 (header+4);
+
+		if (header[0] == 'R')
+			{ recordsLeft = count;  continue; }
+
+		if (header[0] != 'D') goto bad_frame;
+
+		for (nameNum=0 ; nameNum<count ; nameNum++)
+			{
+			if (fread (lengthBytes, 1, 2, f) != 2) goto truncated;
+			nameLen = lengthBytes[0] + (((u32) lengthBytes[1]) << 8);
+			if (numNames == namesLen)
+				{
+				namesLen = (namesLen == 0)? 100 : 2*namesLen;
+				names = (char**) realloc (names, namesLen * sizeof(char*));
+				if (names == NULL) goto cant_allocate_names;
+				}
+			names[numNames] = (char*) malloc (nameLen+1);
+			if (names[numNames] == NULL) goto cant_allocate_names;
+			if (fread (names[numNames], 1, nameLen, f) != nameLen) goto truncated;
+			names[numNames][nameLen] = 0;
+			numNames++;
+			}
+		}
+
+	// read the record
+
+	if (fread (record, 1, recordBytes, f) != (size_t) recordBytes) goto truncated;
+	recordsLeft--;
+	recordNumber++;
+
+	chromNum = get_le32 (record);
+	if (chromNum >= numNames) goto bad_chrom;
+
+	if (valueType == 'i')
+		val = (s32) get_le32 (record+12+valIx*valueBytes);
+	else
+		{
+		bits = get_le64 (record+12+valIx*valueBytes);
+		memcpy (&val, &bits, sizeof(val));
+		}
+
+	if (_chrom != NULL) *_chrom = names[chromNum];
+	if (_start != NULL) *_start = get_le32 (record+4);
+	if (_end   != NULL) *_end   = get_le32 (record+8);
+	if (_val   != NULL) *_val   = val;
+
+	return true;
+
+	//////////
+	// failure exits
+	//////////
+
+not_binary:
+	fprintf (stderr, "input is not a binary interval stream\n");
+	exit (EXIT_FAILURE);
+
+bad_version:
+	fprintf (stderr, "unsupported binary interval stream version (%d)\n",
+			 header[4]);
+	exit (EXIT_FAILURE);
+
+bad_value_type:
+	fprintf (stderr, "unsupported value type in binary interval stream (\"%c\")\n",
+			 valueType);
+	exit (EXIT_FAILURE);
+
+no_value:
+	fprintf (stderr, "binary interval stream records have only %d values, no column %d\n",
+			 numValues, valCol+1);
+	exit (EXIT_FAILURE);
+
+truncated:
+	fprintf (stderr, "binary interval stream is truncated (after record %u)\n",
+			 recordNumber);
+	exit (EXIT_FAILURE);
+
+bad_frame:
+	fprintf (stderr, "bad frame kind (\"%c\") in binary interval stream (after record %u)\n",
+			 header[0], recordNumber);
+	exit (EXIT_FAILURE);
+
+bad_chrom:
+	fprintf (stderr, "problem at record %u, chromosome %u is not in the dictionary\n",
+			 recordNumber, chromNum);
+	exit (EXIT_FAILURE);
+
+cant_allocate_names:
+	fprintf (stderr, "failed to allocate chromosome dictionary (%u names)\n",
+			 numNames+1);
+	exit (EXIT_FAILURE);
+	}
+
+//----------
+//
+// write_interval--
+//	Write an interval, with its value, to stdout;  as text, or with
+//	--out=binary, as a record in a binary interval stream.  In the latter case
+//	the value is rounded to the precision that would have been printed, and
+//	records are buffered;  the caller must call flush_binary_records() after
+//	the last interval.
+//
+// Note that we expect all of a chromosome's intervals to be written
+// consecutively (and each chromosome is only given a new dictionary entry
+// when the chromosome changes).
+//
+//----------
+
+static unsigned char binaryRecords[binaryMaxRecords*binaryOutRecordBytes];
+static u32           numBinaryRecords = 0;
+
+static void write_interval
+   (char*	chrom,
+	u32		start,
+	u32		end,
+	double	val)
+	{
+	static int		headerWritten = false;
+	static char*	prevChrom     = NULL;
+	static u32		chromNum      = (u32) -1;
+	unsigned char	header[binaryHeaderBytes];
+	unsigned char	lengthBytes[2];
+	unsigned char*	record;
+	char			valText[100];
+	u64				bits;
+	size_t			nameLen;
+
+	if (!binaryOut)
+		{
+		printf ("%s\t%d\t%d\t%.*f\n", chrom, start, end, precision, val);
+		return;
+		}
+
+	if (!headerWritten)
+		{
+		memcpy (header, binaryMagic, sizeof(binaryMagic));
+		header[4] = binaryVersion;
+		header[5] = 'd';
+		header[6] = 1;
+		header[7] = 0;
+		fwrite (header, 1, binaryHeaderBytes, stdout);
+		headerWritten = true;
+		}
+
+	if ((prevChrom == NULL) || (strcmp (chrom, prevChrom) != 0))
+		{
+		flush_binary_records ();
+		nameLen = strlen (chrom);
+		memset (header, 0, binaryFrameBytes);
+		header[0] = 'D';
+		put_le32 (header+4, 1);
+		lengthBytes[0] = (unsigned char) nameLen;
+		lengthBytes[1] = (unsigned char) (nameLen >> 8);
+		fwrite (header,      1, binaryFrameBytes, stdout);
+		fwrite (lengthBytes, 1, 2,                stdout);
+		fwrite (chrom,       1, nameLen,          stdout);
+		prevChrom = chrom;
+		chromNum++;
+		}
+
+	sprintf (valText, "%.*f", precision, val);
+	val = string_to_double (valText);
+	memcpy (&bits, &val, sizeof(bits));
+
+	record = binaryRecords + numBinaryRecords*binaryOutRecordBytes;
+	put_le32 (record,   chromNum);
+	put_le32 (record+4, start);
+	put_le32 (record+8, end);
+	put_le64 (record+12, bits);
+	if (++numBinaryRecords == binaryMaxRecords)
+		flush_binary_records ();
+	}
+
+//----------
+//
+// flush_binary_records--
+//	Write any buffered binary records to stdout, as a single frame.
+//
+//----------
+
+static void flush_binary_records
+   (void)
+	{
+	unsigned char	header[binaryFrameBytes];
+
+	if (numBinaryRecords == 0) return;
+
+	memset (header, 0, binaryFrameBytes);
+	header[0] = 'R';
+	put_le32 (header+4, numBinaryRecords);
+	fwrite (header,        1, binaryFrameBytes,                       stdout);
+	fwrite (binaryRecords, 1, numBinaryRecords*binaryOutRecordBytes, stdout);
+	numBinaryRecords = 0;
+	}
+
+//----------
+//
+// get_le32, get_le64, put_le32, put_le64--
+//	Read or write little-endian numbers, regardless of our own byte order.
+//
+//----------
+
+static u32 get_le32
+   (unsigned char*	p)
+	{
+	return ((u32) p[0])       + (((u32) p[1]) << 8)
+	     + (((u32) p[2]) << 16) + (((u32) p[3]) << 24);
+	}
+
+static u64 get_le64
+   (unsigned char*	p)
+	{
+	return ((u64) get_le32 (p)) + (((u64) get_le32 (p+4)) << 32);
+	}
+
+static void put_le32
+   (unsigned char*	p,
+	u32				v)
+	{
+	p[0] = (unsigned char) v;
+	p[1] = (unsigned char) (v >> 8);
+	p[2] = (unsigned char) (v >> 16);
+	p[3] = (unsigned char) (v >> 24);
+	}
+
+static void put_le64
+   (unsigned char*	p,
+	u64				v)
+	{
+	put_le32 (p,   (u32) v);
+	put_le32 (p+4, (u32) (v >> 32));
+	}
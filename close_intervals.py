@@ -5,8 +5,9 @@
 see en.wikipedia.org/wiki/Closing_(morphology)
 """
 
-from sys  import argv,stdin,stderr,exit
+from sys  import argv,stdin,stdout,stderr,exit
 from math import ceil
+from binary_intervals import IntervalWriter,read_binary_intervals
 
 
 def usage(s=None):
@@ -16,6 +17,8 @@ usage: cat intervals_file | close_intervals <length> [options] > intervals_file
   --origin=one   intervals are origin-one, closed
   --origin=zero  intervals are origin-zero, half-open
                  (this is the default)
+  --in=binary    input is a binary interval stream (see binary_intervals.py)
+  --out=binary   write the output as a binary interval stream
 
   Note that we allow incoming intervals to extend beyond the end of a
   chromosome (and thus output intervals might also)."""
@@ -31,6 +34,8 @@ def main():
 
 	closingLength = None
 	origin        = "zero"
+	inputFormat   = "text"
+	outputFormat  = "text"
 	debug         = []
 
 	for arg in argv[1:]:
@@ -42,6 +47,10 @@ def main():
 			if (origin == "0"): origin = "zero"
 			if (origin == "1"): origin = "one"
 			assert (origin in ["zero","one"]), "can't understand %s" % arg
+		elif (arg in ["--in=binary","--in=text"]):
+			inputFormat = argVal
+		elif (arg in ["--out=binary","--out=text"]):
+			outputFormat = argVal
 		elif (arg == "--debug"):
 			debug += ["debug"]
 		elif (arg.startswith("--debug=")):
@@ -57,12 +66,20 @@ def main():
 	if (closingLength == None):
 		usage("you must provide the length")
 
+	if (origin == "one") and ("binary" in [inputFormat,outputFormat]):
+		usage("binary intervals are always origin-zero, so --origin=one can't be used")
+
 	# collect the intervals
 
 	chromToIntervals = {}
 	chroms = []
 
-	for (chrom,start,end) in read_intervals(stdin,origin=origin):
+	if (inputFormat == "binary"):
+		intervals = (record[:3] for record in read_binary_intervals(stdin))
+	else:
+		intervals = read_intervals(stdin,origin=origin)
+
+	for (chrom,start,end) in intervals:
 		if (chrom not in chromToIntervals):
 			chromToIntervals[chrom] = []
 			chroms += [chrom]
@@ -73,6 +90,9 @@ def main():
 	dilationLength = (closingLength+1) / 2
 	erosionLength  = dilationLength
 
+	if (outputFormat == "binary"):
+		writer = IntervalWriter(stdout)
+
 	for chrom in chroms:
 		intervals = [(start-dilationLength,end+dilationLength)
 		                  for (start,end) in chromToIntervals[chrom]]
@@ -80,9 +100,15 @@ def main():
 		for (start,end) in non_overlapping_intervals(intervals):
 			start += erosionLength
 			end   -= erosionLength
+			if (outputFormat == "binary"):
+				writer.write(chrom,start,end)
+				continue
 			if (origin == "one"): start += 1
 			print "%s %d %d" % (chrom,start,end)
 
+	if (outputFormat == "binary"):
+		writer.close()
+
 
 def read_intervals(f,origin="zero"):
 	numFields = None
@@ -18,6 +18,8 @@ usage: create_script_depth [options] > depth.sh
                              refer to this path
   --bam=<filename>           (required) bam file to process
   --namesorted               the bam file has been sorted by read names
+  --directbam                have filtered_sam_to_intervals read the bam file
+                             directly, rather than through samtools view
   --chromosomes=<filename>   read chromosome names and lengths from a file
                              (default is {base}/data/hg19.chrom_lengths)
   --track=<filename>         (required) track file to create
@@ -58,6 +60,7 @@ def main():
 	basePath             = None
 	bamFilename          = None
 	isNameSorted         = False
+	readBamDirectly      = False
 	chromsFilename       = None
 	trackName            = None
 	tempFilename         = None
@@ -82,6 +85,8 @@ def main():
 			bamFilename = argVal
 		elif (arg == "--namesorted"):
 			isNameSorted = True
+		elif (arg == "--directbam"):
+			readBamDirectly = True
 		elif (arg.startswith("--chromosomes=")) or (arg.startswith("--chroms=")):
 			chromsFilename = argVal
 		elif (arg.startswith("--track=")):
@@ -251,25 +256,22 @@ def main():
 
 	commands =  []
 
-	command  =  ["time samtools view %s" % bamFilename]
-	commands += [command]
-
-	command  =  ["filtered_sam_to_intervals"]
+	if (readBamDirectly):
+		command  =  ["time filtered_sam_to_intervals %s" % bamFilename]
+	else:
+		command  =  ["time samtools view %s" % bamFilename]
+		commands += [command]
+		command  =  ["filtered_sam_to_intervals"]
 	if (isNameSorted):      command += ["--namesorted"]
 	if (headLimit != None): command += ["--head=%s" % headLimit]
 	command  += ["--requiremates"]
 	command  += ["--prohibit:\"(CIGAR == *)\""]
 	command  += ["--require:\" (RNEXT == =)\""]
 	command  += ["--require:\" (PORIENT==%s)\"" % pOrient]
-	command  += ["--nonames"]
+	command  += ["--depth=%s" % chromsFilename]
 	command  += ["--progress=2M"]
 	commands += [command]
 
-	command  =  ["genodsp"]
-	command  += ["--chromosomes=%s" % chromsFilename]
-	command  += ["--novalue --show:uncovered"]
-	commands += [command]
-
 	if (gzipOutput):
 		if (tempFilename != None):
 			command  =  ["tee %s" % tempFilename]
@@ -20,7 +20,9 @@ usage: create_script_discordant_mates_dense [options] > discordant_mates_dense.s
                              refer to this path
   --chromosomes=<filename>   read chromosome names and lengths from a file
                              (default is {base}/data/hg19.chrom_lengths)
-  --input=<filename>         (required) track file to process
+  --input=<filename>         (required) track file to process;  this is the
+                             discordant mates bedGraph, e.g. as written by
+                             create_script_insert_depth --discordant
   --track=<filename>         (required) track file to create
                              (default is {base}/tracks/{run}.discordant_mates.dense)
   --tempinput=<filename>     temporary file to hold input track file, if
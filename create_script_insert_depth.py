@@ -22,6 +22,8 @@ usage: create_script_insert_depth [options] > insert_depth.sh
                              refer to this path
   --bam=<filename>           (required) bam file to process
   --namesorted               the bam file has been sorted by read names
+  --directbam                have filtered_sam_to_intervals read the bam file
+                             directly, rather than through samtools view
   --chromosomes=<filename>   read chromosome names and lengths from a file
                              (default is {base}/data/hg19.chrom_lengths)
   --track=<filename>         (required) track file to create
@@ -44,6 +46,25 @@ usage: create_script_insert_depth [options] > insert_depth.sh
                              "shebang:bash" is mapped "#!/usr/bin/env bash"
                              other commands are copied "as is"
   --head=<number>            limit the number of bam records
+  --insertlength[=<filename>] also create the average insert length track (as
+                             create_script_insert_length would, but without a
+                             bigwig), in the same pass over the bam file
+                             (default is {base}/tracks/{run}.insert_length)
+  --discordant[=<filename>]  also create the discordant mates bedGraph, the
+                             number of discordant mates covering each position
+                             (pairs on different chromosomes, in the wrong
+                             orientation, or outside the insert length range),
+                             counting only pairs with both mates' MAPQ at
+                             least 40 and at most 40% of each read clipped,
+                             and discarding duplicate pairs;  this is written
+                             in the same pass over the bam file (and isn't
+                             compressed)
+                             (default is {base}/discordant/{run}.BDB.MMQ40.MCP40.rmdup.bedgraph)
+  --separate                 make a separate pass over the bam file for each
+                             class;  by default all classes are handled in a
+                             single pass, with filtered_sam_to_intervals writing
+                             each class's track (to a fifo, if it is to be
+                             compressed)
 
 values read from control file:
   avgInsertLen.{run}
@@ -70,6 +91,7 @@ def main():
 	basePath             = None
 	bamFilename          = None
 	isNameSorted         = False
+	readBamDirectly      = False
 	chromsFilename       = None
 	trackName            = None
 	tempFilename         = None
@@ -82,6 +104,9 @@ def main():
 	bigWigPosition       = None
 	bashInitializers     = ["set -eu"]
 	headLimit            = None
+	insertLengthName     = None
+	discordantName       = None
+	separatePasses       = False
 	debug                = []
 
 	for arg in argv[1:]:
@@ -101,6 +126,8 @@ def main():
 			bamFilename = argVal
 		elif (arg == "--namesorted"):
 			isNameSorted = True
+		elif (arg == "--directbam"):
+			readBamDirectly = True
 		elif (arg.startswith("--chromosomes=")) or (arg.startswith("--chroms=")):
 			chromsFilename = argVal
 		elif (arg.startswith("--track=")):
@@ -131,6 +158,17 @@ def main():
 			bashInitializers += [argVal]
 		elif (arg.startswith("--head=")):
 			headLimit = argVal
+		elif (arg == "--insertlength"):
+			insertLengthName = "{base}/tracks/{run}.insert_length"
+		elif (arg.startswith("--insertlength=")):
+			insertLengthName = argVal
+		elif (arg == "--discordant"):
+			discordantName = "{base}/discordant/{run}.BDB.MMQ%d.MCP%d.rmdup.bedgraph" \
+			               % (discordantMinMapQ,100*discordantMaxClip)
+		elif (arg.startswith("--discordant=")):
+			discordantName = argVal
+		elif (arg == "--separate"):
+			separatePasses = True
 		elif (arg == "--debug"):
 			debug += ["debug"]
 		elif (arg.startswith("--debug=")):
@@ -163,6 +201,12 @@ def main():
 	if (trackName == None):
 		trackName = "{base}/tracks/{run}.{kind}_inserts.depth"
 
+	if (insertLengthName != None) and (separatePasses):
+		usage("--insertlength can't be used with --separate")
+
+	if (discordantName != None) and (separatePasses):
+		usage("--discordant can't be used with --separate")
+
 	if (tempFilename == None) and (bigWigFilename != None) and (gzipOutput):
 		tempFilename = trackName + ".temp"
 
@@ -199,6 +243,24 @@ def main():
 	if (tempFilename != None):
 		tempFilename = do_filename_substitutition(tempFilename)
 
+	fifoName = trackName + ".fifo"
+
+	# insert length track name
+
+	if (insertLengthName != None):
+		insertLengthName = do_filename_substitutition(insertLengthName)
+		insertLengthFilename = insertLengthName
+		if (gzipOutput):
+			if (not insertLengthFilename.endswith(".gz")): insertLengthFilename += ".gz"
+		else:
+			if (not insertLengthFilename.endswith(".dat")): insertLengthFilename += ".dat"
+		insertLengthFifo = insertLengthName + ".fifo"
+
+	# discordant mates bedGraph name
+
+	if (discordantName != None):
+		discordantFilename = do_filename_substitutition(discordantName)
+
 	# big wig name
 
 	if (bigWigFilename != None):
@@ -328,6 +390,131 @@ def main():
 			bigWigClassFilename = bigWigFilename.replace("{kind}",insertClass)
 			print "echo \"will write bigwig file to    %s\"" % bigWigClassFilename
 
+	if (insertLengthName != None):
+		print "echo \"will write track file to     %s\"" % insertLengthFilename
+
+	if (discordantName != None):
+		print "echo \"will write bedgraph file to  %s\"" % discordantFilename
+
+	# write command(s) to create all the track files in a single pass;
+	# filtered_sam_to_intervals computes each class's depth itself, and
+	# writes it to the track file, or (if it is to be compressed) to a fifo,
+	# read by a pipeline running in the background;  we wait for each of those
+	# pipelines, so that if one fails so does the job, and if the job ends
+	# early the trap kills them (they'd otherwise wait forever for their fifo
+	# to be opened) and removes the fifos;  the discordant mates
+	# fail the requirements on RNEXT and PORIENT, so if they are wanted those
+	# requirements apply to each class rather than to all the input
+
+	if (not separatePasses):
+		print
+		print "echo \"=== creating tracks %s ===\"" \
+		    % ", ".join([trackId.replace("{kind}",insertClass) for (insertClass,_,_) in insertClasses])
+
+		fifos = []
+		if (gzipOutput):
+			fifos += [fifoName.replace("{kind}",insertClass) for (insertClass,_,_) in insertClasses]
+		if (gzipOutput) and (insertLengthName != None): fifos += [insertLengthFifo]
+
+		if (fifos != []):
+			print
+			print "rm -f %s" % " ".join(fifos)
+			print "mkfifo %s" % " ".join(fifos)
+			print "fifoReaders=\"\""
+			print "trap 'kill $fifoReaders 2>/dev/null || true; rm -f %s' EXIT" % " ".join(fifos)
+
+		for (insertClass,_,_) in insertClasses:
+			if (not gzipOutput): break
+			trackClassFilename = trackFilename.replace("{kind}",insertClass)
+			if (tempFilename != None): tempClassFilename = tempFilename.replace("{kind}",insertClass)
+			else:                      tempClassFilename = None
+
+			commands =  []
+			if (tempClassFilename != None):
+				command  =  ["tee %s" % tempClassFilename]
+				command  += ["< %s" % fifoName.replace("{kind}",insertClass)]
+				commands += [command]
+				command  =  ["gzip"]
+				commands += [command]
+			else:
+				command  =  ["gzip"]
+				command  += ["< %s" % fifoName.replace("{kind}",insertClass)]
+				commands += [command]
+
+			command  =  ["> %s &" % trackClassFilename]
+			commands += [command]
+
+			print
+			print commands_to_pipeline(commands)
+			print "fifoReaders=\"$fifoReaders $!\""
+
+		if (insertLengthName != None) and (gzipOutput):
+			commands =  []
+			command  =  ["gzip"]
+			command  += ["< %s" % insertLengthFifo]
+			commands += [command]
+
+			command  =  ["> %s &" % insertLengthFilename]
+			commands += [command]
+
+			print
+			print commands_to_pipeline(commands)
+			print "fifoReaders=\"$fifoReaders $!\""
+
+		commands =  []
+
+		if (readBamDirectly):
+			command  =  ["time filtered_sam_to_intervals %s" % bamFilename]
+		else:
+			command  =  ["time samtools view %s" % bamFilename]
+			commands += [command]
+			command  =  ["filtered_sam_to_intervals"]
+		if (isNameSorted):      command += ["--namesorted"]
+		if (headLimit != None): command += ["--head=%s" % headLimit]
+		command  += ["--prohibit:\"(CIGAR == *)\""]
+		if (discordantName == None):
+			command  += ["--require:\" (RNEXT == =)\""]
+			command  += ["--require:\" (PORIENT==%s)\"" % pOrient]
+		command  += ["--progress=2M"]
+		for (insertClass,shortLength,longLength) in insertClasses:
+			if (gzipOutput): classOutput = fifoName.replace("{kind}",insertClass)
+			else:            classOutput = trackFilename.replace("{kind}",insertClass)
+			command  += ["--output:%s=%s --mergemates=%s --depth=%s" \
+			           % (insertClass,classOutput,class_range(shortLength,longLength),
+			              chromsFilename)]
+			if (discordantName != None):
+				command  += ["  --require:\" (RNEXT == =)\" --require:\" (PORIENT==%s)\"" % pOrient]
+		if (insertLengthName != None):
+			if (gzipOutput): lengthOutput = insertLengthFifo
+			else:            lengthOutput = insertLengthFilename
+			if (minInsertLen == None) and (maxInsertLen == None):
+				lengthRange = ""
+			else:
+				lengthRange = "=%s" % class_range(minInsertLen,maxInsertLen)
+			command  += ["--output:length=%s --mergemates%s --mean:LENGTH-%d=%s" \
+			           % (lengthOutput,lengthRange,avgInsertLen,chromsFilename)]
+			if (discordantName != None):
+				command  += ["  --require:\" (RNEXT == =)\" --require:\" (PORIENT==%s)\"" % pOrient]
+		if (discordantName != None):
+			if (minInsertLen == None) and (maxInsertLen == None):
+				discordantRange = ""
+			else:
+				discordantRange = ":%s" % class_range(minInsertLen,maxInsertLen)
+			command  += ["--output:discordant=%s --discordant=%s%s --rmdup --depth=%s" \
+			           % (discordantFilename,pOrient,discordantRange,chromsFilename)]
+			command  += ["  --require:\" (MAPQ >= %d)\" --prohibit:\" (UNCLIP > RLEN*%.2f)\"" \
+			           % (discordantMinMapQ,discordantMaxClip)]
+		commands += [command]
+
+		print
+		print commands_to_pipeline(commands)
+
+		if (fifos != []):
+			print
+			print "for pid in $fifoReaders; do wait $pid; done"
+			print "rm -f %s" % " ".join(fifos)
+			print "trap - EXIT"
+
 	# loop over insert classes
 
 	for (insertClass,shortLength,longLength) in insertClasses:
@@ -336,52 +523,48 @@ def main():
 		if (tempFilename != None): tempClassFilename = tempFilename.replace("{kind}",insertClass)
 		else:                      tempClassFilename = None
 
-		if (shortLength != None): classRange =  "%d.." % shortLength
-		else:                     classRange =  ".."
-		if (longLength  != None): classRange += "%d"   % longLength
+		classRange = class_range(shortLength,longLength)
 
 		if   (longLength  == None): classRangeText =  ">%d" % shortLength
 		elif (shortLength == None): classRangeText =  "<%d" % longLength
 		else:                       classRangeText =  "%d..%d" % (shortLength,longLength)
 
-		# write command(s) to create track files
-
-		print
-		print "echo \"=== creating track %s (range %s) ===\"" % (trackClassId,classRange)
-
-		commands =  []
+		# write command(s) to create track files (for separate passes)
 
-		command  =  ["time samtools view %s" % bamFilename]
-		commands += [command]
-
-		command  =  ["filtered_sam_to_intervals"]
-		if (isNameSorted):      command += ["--namesorted"]
-		if (headLimit != None): command += ["--head=%s" % headLimit]
-		command  += ["--mergemates=%s" % classRange]
-		command  += ["--prohibit:\"(CIGAR == *)\""]
-		command  += ["--require:\" (RNEXT == =)\""]
-		command  += ["--require:\" (PORIENT==%s)\"" % pOrient]
-		command  += ["--nonames"]
-		command  += ["--progress=2M"]
-		commands += [command]
+		if (separatePasses):
+			print
+			print "echo \"=== creating track %s (range %s) ===\"" % (trackClassId,classRange)
 
-		command  =  ["genodsp"]
-		command  += ["--chromosomes=%s" % chromsFilename]
-		command  += ["--novalue --show:uncovered"]
-		commands += [command]
+			commands =  []
 
-		if (gzipOutput):
-			if (tempClassFilename != None):
-				command  =  ["tee %s" % tempClassFilename]
+			if (readBamDirectly):
+				command  =  ["time filtered_sam_to_intervals %s" % bamFilename]
+			else:
+				command  =  ["time samtools view %s" % bamFilename]
 				commands += [command]
-			command  =  ["gzip"]
+				command  =  ["filtered_sam_to_intervals"]
+			if (isNameSorted):      command += ["--namesorted"]
+			if (headLimit != None): command += ["--head=%s" % headLimit]
+			command  += ["--mergemates=%s" % classRange]
+			command  += ["--prohibit:\"(CIGAR == *)\""]
+			command  += ["--require:\" (RNEXT == =)\""]
+			command  += ["--require:\" (PORIENT==%s)\"" % pOrient]
+			command  += ["--depth=%s" % chromsFilename]
+			command  += ["--progress=2M"]
 			commands += [command]
 
-		command  =  ["> %s" % trackClassFilename]
-		commands += [command]
+			if (gzipOutput):
+				if (tempClassFilename != None):
+					command  =  ["tee %s" % tempClassFilename]
+					commands += [command]
+				command  =  ["gzip"]
+				commands += [command]
 
-		print
-		print commands_to_pipeline(commands)
+			command  =  ["> %s" % trackClassFilename]
+			commands += [command]
+
+			print
+			print commands_to_pipeline(commands)
 
 		# write command(s) to convert track file to bigwig
 
@@ -455,6 +638,20 @@ def main():
 				print "echo \"track URL is %s\"" % (infoUrl)
 
 
+# thresholds for the discordant mates bedGraph (these are the "MMQ40" and
+# "MCP40" in its name)
+
+discordantMinMapQ = 40		# minimum MAPQ of either mate
+discordantMaxClip = 0.40	# maximum fraction of either read that's clipped
+
+
+def class_range(shortLength,longLength):
+	if (shortLength != None): classRange =  "%d.." % shortLength
+	else:                     classRange =  ".."
+	if (longLength  != None): classRange += "%d"   % longLength
+	return classRange
+
+
 def commands_to_pipeline(commands):
 	pipeline = []
 	for (cmdNum,cmd) in enumerate(commands):
@@ -19,6 +19,8 @@ usage: create_script_insert_length [options] > insert_length.sh
                              refer to this path
   --bam=<filename>           (required) bam file to process
   --namesorted               the bam file has been sorted by read names
+  --directbam                have filtered_sam_to_intervals read the bam file
+                             directly, rather than through samtools view
   --chromosomes=<filename>   read chromosome names and lengths from a file
                              (default is {base}/data/hg19.chrom_lengths)
   --track=<filename>         (required) track file to create
@@ -65,6 +67,7 @@ def main():
 	basePath             = None
 	bamFilename          = None
 	isNameSorted         = False
+	readBamDirectly      = False
 	chromsFilename       = None
 	trackName            = None
 	tempFilename         = None
@@ -91,6 +94,8 @@ def main():
 			bamFilename = argVal
 		elif (arg == "--namesorted"):
 			isNameSorted = True
+		elif (arg == "--directbam"):
+			readBamDirectly = True
 		elif (arg.startswith("--chromosomes=")) or (arg.startswith("--chroms=")):
 			chromsFilename = argVal
 		elif (arg.startswith("--track=")):
@@ -298,15 +303,14 @@ def main():
 	print
 	print "echo \"=== creating track %s ===\"" % trackId
 
-	print
-	print "chrSizes=`cat %s | awk '{ print $1\":\"$2 }'`" % chromsFilename
-
 	commands =  []
 
-	command  =  ["time samtools view %s" % bamFilename]
-	commands += [command]
-
-	command  =  ["filtered_sam_to_intervals"]
+	if (readBamDirectly):
+		command  =  ["time filtered_sam_to_intervals %s" % bamFilename]
+	else:
+		command  =  ["time samtools view %s" % bamFilename]
+		commands += [command]
+		command  =  ["filtered_sam_to_intervals"]
 	if (isNameSorted):      command += ["--namesorted"]
 	if (headLimit != None): command += ["--head=%s" % headLimit]
 	if (minInsertLen == None) and (maxInsertLen == None):
@@ -320,22 +324,10 @@ def main():
 	command  += ["--prohibit:\"(CIGAR == *)\""]
 	command  += ["--require:\" (RNEXT == =)\""]
 	command  += ["--require:\" (PORIENT==%s)\"" % pOrient]
-	command  += ["--nonames"]
+	command  += ["--mean:LENGTH-%d=%s" % (avgInsertLen,chromsFilename)]
 	command  += ["--progress=2M"]
 	commands += [command]
 
-	command  =  ["awk '{ print $0,$3-$2 }'"]
-	commands += [command]
-
-	command  =  ["chrom_avg L=0 ${chrSizes} --precision=0"]
-	commands += [command]
-
-	command  =  ["awk '{ print $1,$2,$3,($4-%d) }'" % avgInsertLen]
-	commands += [command]
-
-	command  =  ["tr \" \" \"\\t\""]
-	commands += [command]
-
 	if (gzipOutput):
 		if (tempFilename != None):
 			command  =  ["tee %s" % tempFilename]
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
-from sys import argv,stdin,stderr,exit
+from sys import argv,stdin,stdout,stderr,exit
+from binary_intervals import IntervalWriter,read_binary_intervals
 
 
 def usage(s=None):
@@ -8,7 +9,11 @@ def usage(s=None):
 usage: cat intervals | fill_genomic_interval_gaps [options] > intervals
   --chromosomes=<filename>  read chromosome names and lengths from a file
   --origin=0                intervals are origin-zero, half-open (default)
-  --origin=1                intervals are origin-one, closed"""
+  --origin=1                intervals are origin-one, closed
+  --in=binary               input is a binary interval stream (see
+                            binary_intervals.py);  the value is the first value
+                            of each record (or 1 if records have no values)
+  --out=binary              write the output as a binary interval stream"""
 
 	if (s == None): exit (message)
 	else:           exit ("%s\n%s" % (s,message))
@@ -21,6 +26,8 @@ def main():
 
 	chromsFilename = None
 	origin         = "zero"
+	inputFormat    = "text"
+	outputFormat   = "text"
 	debug          = []
 
 	for arg in argv[1:]:
@@ -34,6 +41,10 @@ def main():
 			if (origin == "0"): origin = "zero"
 			if (origin == "1"): origin = "one"
 			assert (origin in ["zero","one"]), "can't understand %s" % arg
+		elif (arg in ["--in=binary","--in=text"]):
+			inputFormat = argVal
+		elif (arg in ["--out=binary","--out=text"]):
+			outputFormat = argVal
 		elif (arg == "--debug"):
 			debug += ["debug"]
 		elif (arg.startswith("--debug=")):
@@ -46,6 +57,9 @@ def main():
 	if (chromsFilename == None):
 		usage("you have to give me a chromosome lengths file")
 
+	if (origin == "one") and ("binary" in [inputFormat,outputFormat]):
+		usage("binary intervals are always origin-zero, so --origin=1 can't be used")
+
 	# read the chromosome lengths file
 
 	chromToLength = {}
@@ -64,18 +78,30 @@ def main():
 
 	chromToIntervals = {}
 
-	for (chrom,start,end,val) in read_intervals(stdin,origin=origin):
+	if (inputFormat == "binary"):
+		intervals = read_binary_values(stdin)
+	else:
+		intervals = read_intervals(stdin,origin=origin)
+
+	for (chrom,start,end,val) in intervals:
 		if (chrom not in chromToIntervals):
 			assert (chrom in chromToLength), \
 			       "%s is in input but not in %s" % (chrom,lengthsFile)
 			chromToIntervals[chrom] = []
 		chromToIntervals[chrom] += [(start,end,val)]
 
+	if (outputFormat == "binary"):
+		writer = IntervalWriter(stdout,"d",1)
+		def write_interval(chrom,start,end,val):
+			writer.write(chrom,start,end,float(val))
+	else:
+		def write_interval(chrom,start,end,val):
+			if (origin == "one"): start += 1
+			print "%s\t%d\t%d\t%s" % (chrom,start,end,val)
+
 	for chrom in chroms:
 		if (chrom not in chromToIntervals):
-			start = 0
-			if (origin == "one"): start += 1
-			print "%s\t%d\t%d\t%s" % (chrom,start,chromToLength[chrom],"0")
+			write_interval(chrom,0,chromToLength[chrom],"0")
 			continue
 
 		intervals = chromToIntervals[chrom]
@@ -89,16 +115,16 @@ def main():
 				              % (chrom,prevEnd,start,end)
 
 			if (prevEnd < start):
-				if (origin == "one"): prevEnd += 1
-				print "%s\t%d\t%d\t%s" % (chrom,prevEnd,start,"0")
+				write_interval(chrom,prevEnd,start,"0")
 
-			if (origin == "one"): start += 1
-			print "%s\t%d\t%d\t%s" % (chrom,start,end,val)
+			write_interval(chrom,start,end,val)
 			prevEnd = end
 
 		if (prevEnd < chromToLength[chrom]):
-			if (origin == "one"): prevEnd += 1
-			print "%s\t%d\t%d\t%s" % (chrom,prevEnd,chromToLength[chrom],"0")
+			write_interval(chrom,prevEnd,chromToLength[chrom],"0")
+
+	if (outputFormat == "binary"):
+		writer.close()
 
 
 # returns the next interval as (chrom,start,end)
@@ -140,6 +166,14 @@ def read_intervals(f,origin="zero"):
 		yield (chrom,start,end,val)
 
 
+# returns the next interval as (chrom,start,end,val), from a binary stream
+
+def read_binary_values(f):
+	for record in read_binary_intervals(f):
+		if (len(record) > 3): yield record[:4]
+		else:                 yield record + (1,)
+
+
 # yields the next name,length pair
 
 def name_and_length(f):
@@ -5,25 +5,73 @@ Filter and convert a SAM file to a list of intervals/reads
 References:
   [1] The SAM Format Specification (samtools.github.io/hts-specs/SAMv1.pdf)
   [2] Using eval() safely in python (lybniz2.sourceforge.net/safeeval.html)
+  [3] Python abstract syntax trees (docs.python.org/2/library/ast.html)
 """
 
-from sys        import argv,stdin,stderr,exit
+from sys        import argv,stdin,stdout,stderr,exit
 from math       import *
-from re         import compile
+from re         import compile as re_compile
+from operator   import itemgetter
+from heapq      import heappush,heappop
+from multiprocessing import Pool
+from tempfile   import mkstemp,mkdtemp
+from shutil     import copyfileobj,rmtree
+from os         import fdopen,remove,times as process_times
+from os.path    import exists,basename
+from marshal    import dump as marshal_dump,load as marshal_load
+from array      import array
+import ast,linecache,signal,cProfile
+from itertools  import chain,izip,islice,repeat
+from zlib       import crc32
+from time       import time as wall_clock,clock as cpu_clock
+from json       import dump as json_dump
+from collections import OrderedDict
 from sam_reader import samFieldToColumn,SAM_MIN_COLUMNS,SAM_QNAME_COLUMN
+from bam_reader import BgzfReader,ThreadedBgzfReader,read_bam_header, \
+                       read_bam_index,bam_index_filename,index_chunks,index_end_offset, \
+                       header_sq_lines,sniff_bgzf, \
+                       unpack_bam_core,record_name,cigar_ops,seq_to_string, \
+                       qual_to_string,tag_values,record_to_sam,BamError
+from binary_intervals import IntervalWriter
 try:                from hashlib import md5 as md5_new
 except ImportError: from md5     import new as md5_new
+numpy = None	# (imported only if a BatchFilter is needed)
 
 
 def usage(s=None):
 	message = """
 usage: cat sam_file | filtered_sam_to_intervals [options]
+   or: filtered_sam_to_intervals [options] <sam_or_bam_file>
   --namesorted             the sam file has been sorted by read names
+  --coordsorted            the sam file has been sorted by position (as for an
+                           indexed BAM file);  with --mergemates or
+                           --requiremates, mates on the same chromosome are
+                           paired as soon as both have been seen, so memory is
+                           proportional to the insert length rather than to
+                           the whole file
   --mergemates[=[<min>..<max>] merge the intervals that have the same name,
                            and discard any singletons, multi-chromosomal, or
                            that are outside the expected insert length
   --requiremates[=[<min>..<max>] same as --mergemates, in that mated pairs are
                            required, but intervals are still output separately
+  --discordant=<orient>[:[<min>]..[<max>]] pair mates as for --requiremates,
+                           but keep only the discordant pairs;  a pair is
+                           concordant if its mates are on the same chromosome,
+                           in the <orient> orientation (H2H or T2T), and (if a
+                           range is given) within that insert length;  any
+                           other pair with both mates mapped is discordant, and
+                           its mates are output separately (so with --depth,
+                           the output is the number of discordant mates
+                           covering each position);  a pair is only kept if
+                           both mates satisfy the criteria
+  --rmdup                  with --mergemates, discard duplicate pairs (e.g.
+                           PCR or optical duplicates), those with the same
+                           chromosome, start, end and orientation as an
+                           earlier pair;  with --discordant, those whose mates
+                           have the same intervals and strands;  with
+                           --coordsorted only the pairs that span the current
+                           position are remembered, otherwise every pair is;
+                           --stats reports how many were discarded
   --require:<criterion>    (cumulative) ignore any input lines that don't
                            satisfy the specified criterion;  this is a
                            statement that evaluates to true if the line should
@@ -35,24 +83,191 @@ usage: cat sam_file | filtered_sam_to_intervals [options]
                            to <N>;  the split utilizes a hash code of the query
                            name, so all records with the same name are in the
                            same subset (this means pairs will remain paired)
+  --partition=<key>:<N>:<prefix> write the output to <N> files, <prefix>1
+                           through <prefix><N>, in one pass;  <key> decides
+                           which file each record goes to, and is one of
+                             qname: a hash of the read name (so mates stay
+                               together)
+                             qname-md5: the (slower) hash --subset uses, so
+                               file <K> gets what --subset:qname=<K>/<N> would
+                             rname: the reference name
+                             readgroup: the read group (RG tag)
+                             <variable>: the variable's value
+                           for keys other than qname, each value goes to the
+                           next file in turn, as it is first seen (--stats
+                           reports which);
+                           with --mergemates or --requiremates, only qname,
+                           qname-md5 or rname (that of the leftmost mate) can
+                           be used
   --chromosome[s]=<names>  (cumulative) only output intervals on the specified
                            chromosomes;  <names> is a comma-separated list
                            (default is to report intervals on all chromosomes)
+  --region=<chrom>:<start>-<end> (cumulative) only output intervals for records
+                           that overlap the specified region;  <start> and
+                           <end> are origin-one, closed (as for samtools);
+                           --region=<chrom> is the whole chromosome
+  --index=<filename>       BAI index for the input BAM file;  with --region or
+                           --chromosomes, only the parts of the file that can
+                           contain those regions are read
+                           (default is <sam_or_bam_file>.bai, if it exists)
   --origin=one             output intervals as origin-one, closed
   --origin=zero            output intervals as origin-zero, half-open
                            (this is the default)
+  --out=binary             write the output as a packed binary interval stream
+                           (see binary_intervals.py) rather than as text;
+                           this requires --nonames (or --depth or --mean),
+                           and intervals are origin-zero, half-open;
+                           unmapped reads are not written
+  --out=text               write the output as text (this is the default)
   --nonames                don't output <read_name> as 4th column
   --samrecords             output entire sam record starting at our 4th column
   --justsamrecords         only output sam records
   --report:<variable>      (cumulative) report additional fields
+  --depth=<chrom_lengths>  rather than intervals, output the depth of coverage
+                           of the intervals, as a bedGraph of <chrom> <start>
+                           <end> <depth> covering every position of each
+                           chromosome in <chrom_lengths> (in that order), as
+                           "genodsp --novalue --show:uncovered" would;  the
+                           output is written after all the input is read
+  --mean:<value>[-<constant>]=<chrom_lengths> rather than intervals, output
+                           the mean of <value> over the intervals covering each
+                           position, less <constant>, as a bedGraph of <chrom>
+                           <start> <end> <mean> (positions with no intervals
+                           are not reported);  <value> is LENGTH (the length of
+                           the interval, or of the merged mates) or, without
+                           --mergemates, a variable;  as for --depth, the
+                           output is written after all the input is read
+  --breakpoints[:<window>]=<chrom_lengths> rather than intervals, output the
+                           number of clipped-read breakpoints (CLIPBRK) in
+                           each window of <window> bases, as a bedGraph of
+                           <chrom> <start> <end> <count> covering every
+                           position of each chromosome in <chrom_lengths> (in
+                           that order), joining adjacent windows with the same
+                           count;  records that aren't clipped are ignored, and
+                           criteria such as (UNCLIP > RLEN*0.10) choose how
+                           much clipping counts;  as for --depth, the output
+                           is written after all the input is read
+                           (default <window> is 10)
+  --meanwidth=<bytes>      bytes used to keep each interval's value for --mean;
+                           2 or 4 keep integers, 8 keeps any number
+                           (default is 4)
+  --precision=<digits>     number of digits after the decimal point for --mean
+                           (default is 0)
   --head=<number>          limit the number of input records;  note that
                            records are counted *before* filtering is performed
   --progress=<number>      periodically report how many records we've read
   --progress=output:<number> periodically report how many records we've written
+  --stats=<file>           at the end of the run, write a report (as JSON) of
+                           how many records were read, how many each criterion
+                           evaluated and rejected, how many mates each output
+                           merged or discarded (and why), how many intervals
+                           it wrote, and the time spent in each phase of the
+                           run;  within the record loop, one record in 64 is
+                           timed (see RunStats)
+  --profile=<kind>:<file>  profile the run, writing the profile to <file>;
+                           <kind> is one of
+                             cprofile: cProfile, for the whole run (the file
+                               is for pstats)
+                             sample: the python stack, sampled every 5ms of
+                               cpu time, written as collapsed stacks (one
+                               "<frame>;<frame>;... <count>" line per
+                               distinct stack), as flamegraph.pl takes them
+                             phases: the time spent in each phase of the run,
+                               as for --stats but timing every record, written
+                               as a table
+                           with --jobs, cprofile and sample only profile the
+                           main process;  phases includes the workers
+  --jobs=<number>[:<batch>] process the input with a pool of <number>
+                           processes;  the input is distributed in batches of
+                           about <batch> lines, keeping records with the same
+                           name in the same batch;  output is in the same
+                           order as it would be for a single process (except
+                           for merged mates of unsorted input, which are in an
+                           order that depends on the batch size)
+                           (default is one process, and 10K lines per batch)
+  --jobs=<number>:chromosomes process each reference sequence of an indexed
+                           BAM file as a separate job, in a pool of <number>
+                           processes;  output is concatenated in header order,
+                           which is the same as for a single process (except
+                           for merged mates);  this is the default for an
+                           indexed BAM file, unless <batch> is given
+  --threads:decompress=<number> for BAM input, decompress blocks in a pool of
+                           <number> threads;  0 means decompress them as they
+                           are needed, in the main thread;  --debug=decompress
+                           reports blocks per second and the time spent
+                           waiting for blocks
+                           (default is 0)
+  --readahead=<blocks>     with --threads:decompress, the maximum number of
+                           blocks to read ahead
+                           (default is four per thread)
+  --cigarcache=<number>    number of distinct parsed cigar strings to keep
+                           (in each of two generations);  --debug=cigarcache
+                           reports the cache's hit rate
+                           (default is 10K)
+  --batchfilter=<number>   for SAM input, read records in batches of up to
+                           <number> (and up to a megabyte), and evaluate any
+                           criteria that only involve POS, MAPQ, PNEXT, TLEN
+                           and FLAG for the whole batch at once (this
+                           requires NumPy);  only the records that pass are
+                           processed one by one (this isn't done if all the
+                           criteria only involve FLAG, which are checked more
+                           cheaply record by record);
+                           0 means evaluate every criterion record by record;
+                           --debug=batchfilter reports how many records the
+                           batches rejected
+                           (default is 64K, if NumPy is available)
+  --reorder=<number>       evaluate the criteria in the order that is
+                           expected to be cheapest, judging from how often
+                           each rejected the first <number> records and what
+                           it cost;  0 means evaluate them in the given
+                           order;  --debug=evaluation reports the order
+                           (default is 10K)
+  --memory=<bytes>         for --mergemates or --requiremates without
+                           --namesorted, a budget for the mates waiting to be
+                           paired (in each process);  beyond this they are
+                           spilled to temporary files (in $TMPDIR),
+                           partitioned by read name, and each partition is
+                           paired separately at the end;  --debug=memory
+                           reports the spills
+                           (default is no limit)
+  --output:<name>=<filename> (cumulative) write a separate output file, in the
+                           same pass over the input;  the output options
+                           (--mergemates, --requiremates, --discordant,
+                           --rmdup, --require, --prohibit, --nonames,
+                           --samrecords, --justsamrecords, --report, --depth,
+                           --mean, --breakpoints, --meanwidth and --precision)
+                           that follow apply only to this output, and add to
+                           or override any given before the first --output;
+                           <filename> can be "-" for stdout;  more than one
+                           --output can't yet be combined with --jobs or
+                           --memory
 
   By default, the output file is a list of <chrom> <start> <end> <read_name>,
   but if --nonames is used, it is just a list of <chrom> <start> <end>
 
+  For example, to write short, normal and long inserts to separate files:
+    filtered_sam_to_intervals --namesorted --nonames \\
+        --prohibit:"(CIGAR == *)" --require:"(PORIENT==T2T)" \\
+        --output:short=short.dat   --mergemates=..6000 \\
+        --output:normal=normal.dat --mergemates=6000..10000 \\
+        --output:long=long.dat     --mergemates=10000..
+
+  or, in the same pass, to write the depth of normal inserts and the number of
+  (deduplicated) discordant mates covering each position:
+    filtered_sam_to_intervals --namesorted --prohibit:"(CIGAR == *)" \\
+        --output:normal=normal.dat --mergemates=6000..10000 \\
+          --require:"(RNEXT == =)" --require:"(PORIENT==T2T)" \\
+          --depth=hg19.chrom_lengths \\
+        --output:discordant=discordant.bedgraph --discordant=T2T:..10000 \\
+          --require:"(MAPQ >= 40)" --prohibit:"(UNCLIP > RLEN*0.40)" \\
+          --rmdup --depth=hg19.chrom_lengths
+
+  or to count clipped-read breakpoints in 10-base windows, ignoring reads with
+  no more than 10% of their bases clipped (as for clipThreshold and
+  clipped_breakpoints.windowSize in control.dat):
+    filtered_sam_to_intervals --prohibit:"(CIGAR == *)" \\
+        --require:"(UNCLIP > RLEN*0.10)" --breakpoints:10=hg19.chrom_lengths
+
   Criteria for requirements and prohibitions are something like python
   expressions.  Some examples are
     (CIGAR == *)
@@ -76,9 +291,13 @@ usage: cat sam_file | filtered_sam_to_intervals [options]
     RNEXT  PNEXT  TLEN   SEQ    QUAL
     POS1    POS for first read in a pair   (when --mergemates or
     POS2    POS for second read in a pair   .. --requiremates is used) 
+  (the first read is the leftmost;  a criterion involving POS1 or POS2 is
+  evaluated once for each pair, and can't involve any other variables;  pairs
+  with an unmapped read are discarded if there are any such criteria)
   Second, they can be aliases for tags:
 	SCORE   alias for AS tag
 	SUBOPT  alias for XS tag
+	READGROUP alias for RG tag
   Third, they can be names we compute from the SAM record:
     RLEN    length of the the read
     BESTBY  difference of alignment score minus suboptimal score
@@ -101,12 +320,16 @@ usage: cat sam_file | filtered_sam_to_intervals [options]
 
 
 def main():
-	global subsetN,subsetK
+	global subsetN,subsetK,partitionKey,partitionN,partitionVariable
 	global knownCriteria,computedVariables,tagToVariable,knownVariables,pairVariables
 	global variablesNeeded,tagsNeeded,requirements,prohibitions
+	global samFieldsNeeded,splitLimit,criteria
 	global headLimit,reportProgress,progressId,writtenProgress
-	global outputWhat,mergeEm,mergeDistanceMin,mergeDistanceMax
-	global origin
+	global outputSpecs,outputFiles,outputWhat,mergeEm
+	global isNameSorted,isCoordSorted,chromsOfInterest,regionsOfInterest
+	global origin,outputFormat,cigarCache,numJobs,splitByChrom,memoryLimit,runTempDir
+	global batchFilter,numpy,flagRejects,runStats
+	global inputFormat,inputFilename,bamHeader,inflateThreads,readahead
 	global debug
 
 	knownCriteria = { \
@@ -120,20 +343,21 @@ def main():
 
 	tagToVariable = { \
 		"AS" : "SCORE",		# primary alignment score
-		"XS" : "SUBOPT"		# next best alignment score
+		"XS" : "SUBOPT",	# next best alignment score
+		"RG" : "READGROUP"	# read group
 		}
 
 	computedVariables = { \
-		"RLEN"    : (read_length,       []),
-		"MAPCLIP" : (after_clip_length, []),
-		"UNCLIP"  : (clip_length,       []),
-		"LUNCLIP" : (left_clip_length,  []),
-		"RUNCLIP" : (right_clip_length, []),
-		"MINCLIP" : (min_clip_length,   []),
-		"CLIPBRK" : (clip_breakpoint,   []),
+		"RLEN"    : (read_length,       ["SEQ"]),
+		"MAPCLIP" : (after_clip_length, ["CIGARINFO","SEQ"]),
+		"UNCLIP"  : (clip_length,       ["CIGARINFO"]),
+		"LUNCLIP" : (left_clip_length,  ["CIGARINFO"]),
+		"RUNCLIP" : (right_clip_length, ["CIGARINFO"]),
+		"MINCLIP" : (min_clip_length,   ["CIGARINFO"]),
+		"CLIPBRK" : (clip_breakpoint,   ["CIGARINFO","POS"]),
 		"BESTBY"  : (score_best_by,     ["SCORE","SUBOPT"]),
-		"MORIENT" : (mate_orientation,  []),
-		"PORIENT" : (pair_orientation,  [])
+		"MORIENT" : (mate_orientation,  ["FLAG"]),
+		"PORIENT" : (pair_orientation,  ["FLAG","TLEN"])
 		}
 
 	knownVariables = ["QNAME", "FLAG" , "RNAME", "POS"  , "MAPQ" , "CIGAR",
@@ -150,85 +374,178 @@ def main():
 	# parse the command line
 
 	isNameSorted     = False
-	mergeEm          = False
-	mergeDistanceMin = None
-	mergeDistanceMax = None
-	mergeButSeparate = False
+	isCoordSorted    = False
+	defaultSpec      = new_output_spec(None,None)
+	outputSpecs      = []
 	requirements     = []
 	prohibitions     = []
 	subsetN          = None
 	subsetK          = None
+	partitionKey     = None
 	chromsOfInterest = None
+	regionsOfInterest = None
+	indexFilename    = None
 	origin           = "zero"
-	outputWhat       = ["interval","name"]
+	outputFormat     = "text"
 	headLimit        = None
 	reportProgress   = None
 	writtenProgress  = None
 	progressId       = None
+	cigarCacheSize   = 10*1000
+	batchFilterSize  = 64*1024
+	reorderWindow    = 10*1000
+	statsFilename    = None
+	profileKind      = None
+	profileFilename  = None
+	memoryLimit      = None
+	inputFilename    = None
+	inflateThreads   = 0
+	readahead        = None
+	numJobs          = 1
+	batchSize        = 10*1000
+	jobSplit         = None
 	debug            = []
 
+	spec = defaultSpec
+
 	for arg in argv[1:]:
 		if ("=" in arg):
 			argVal = arg.split("=",1)[1]
 
 		if (arg == "--namesorted"):
 			isNameSorted = True
+		elif (arg == "--coordsorted"):
+			isCoordSorted = True
 		elif (arg == "--mergemates") \
 		  or (arg == "--requiremates"):
-			mergeEm          = True
-			mergeButSeparate = (arg == "--requiremates")
-			mergeDistanceMin = None
-			mergeDistanceMax = None
+			spec.mergeEm          = True
+			spec.mergeButSeparate = (arg == "--requiremates")
+			spec.mergeDistanceMin = None
+			spec.mergeDistanceMax = None
+			spec.discordant       = None
 		elif (arg.startswith("--mergemates=")) \
 		  or (arg.startswith("--requiremates=")):
-			mergeEm          = True
-			mergeButSeparate = (arg.startswith("--requiremates="))
+			spec.mergeEm          = True
+			spec.mergeButSeparate = (arg.startswith("--requiremates="))
+			spec.discordant       = None
 			if (".." not in argVal):
-				mergeDistanceMin = None
-				mergeDistanceMax = int_with_unit(argVal)
+				spec.mergeDistanceMin = None
+				spec.mergeDistanceMax = int_with_unit(argVal)
 			else:
 				(argMin,argMax) = argVal.split("..",1)
 				if (argMax == ""):
-					mergeDistanceMin = int_with_unit(argMin)
-					mergeDistanceMax = None
+					spec.mergeDistanceMin = int_with_unit(argMin)
+					spec.mergeDistanceMax = None
 				elif (argMin == ""):
-					mergeDistanceMin = None
-					mergeDistanceMax = int_with_unit(argMax)
+					spec.mergeDistanceMin = None
+					spec.mergeDistanceMax = int_with_unit(argMax)
 				else:
-					mergeDistanceMin = int_with_unit(argMin)
-					mergeDistanceMax = int_with_unit(argMax)
+					spec.mergeDistanceMin = int_with_unit(argMin)
+					spec.mergeDistanceMax = int_with_unit(argMax)
+		elif (arg.startswith("--discordant=")):
+			spec.mergeEm          = True
+			spec.mergeButSeparate = True
+			spec.mergeDistanceMin = None
+			spec.mergeDistanceMax = None
+			if (":" in argVal):
+				(spec.discordant,argVal) = argVal.split(":",1)
+				if (".." not in argVal):
+					usage("can't understand %s (the range is <min>..<max>)" % arg)
+				(argMin,argMax) = argVal.split("..",1)
+				if (argMin != ""): spec.mergeDistanceMin = int_with_unit(argMin)
+				if (argMax != ""): spec.mergeDistanceMax = int_with_unit(argMax)
+			else:
+				spec.discordant = argVal
+			if (spec.discordant not in ["H2H","T2T"]):
+				usage("--discordant orientation must be H2H or T2T: %s" % arg)
+		elif (arg == "--rmdup"):
+			spec.rmdup = True
 		elif (arg.startswith("--require:")):
 			argVal = arg.split(":",1)[1]
-			requirements += [argVal.strip()]
+			if (spec == defaultSpec): requirements      += [argVal.strip()]
+			else:                     spec.requirements += [argVal.strip()]
 		elif (arg.startswith("--prohibit:")):
 			argVal = arg.split(":",1)[1]
-			prohibitions += [argVal.strip()]
+			if (spec == defaultSpec): prohibitions      += [argVal.strip()]
+			else:                     spec.prohibitions += [argVal.strip()]
+		elif (arg.startswith("--output:")):
+			if ("=" not in arg): usage("--output requires a filename: %s" % arg)
+			(name,filename) = arg.split(":",1)[1].split("=",1)
+			if (name in [spec.name for spec in outputSpecs]):
+				usage("output \"%s\" is given more than once" % name)
+			spec = new_output_spec(name,filename,defaultSpec)
+			outputSpecs += [spec]
 		elif (arg.startswith("--subset:qname=")) or (arg.startswith("--subset:name=")):
 			assert ("/" in argVal)
 			(subsetK,subsetN) = argVal.split("/",1)
 			subsetN = int(subsetN)
 			subsetK = int(subsetK)
 			assert (0 < subsetK <= subsetN)
+		elif (arg.startswith("--partition=")):
+			if (argVal.count(":") < 2):
+				usage("--partition requires a key, a number of files and a prefix (e.g. \"--partition=qname:8:shard.\")")
+			(partitionKey,partitionN,partitionPrefix) = argVal.split(":",2)
+			partitionN = int_with_unit(partitionN)
+			if (partitionN < 1): usage("number of partitions must be positive")
+			if (partitionKey in partitionKeyToVariable):
+				partitionVariable = partitionKeyToVariable[partitionKey]
+			elif (partitionKey in knownVariables):
+				partitionVariable = partitionKey
+			else:
+				usage("unrecognized partition key: \"%s\"" % partitionKey)
 		elif (arg.startswith("--chromosome=")) or (arg.startswith("--chromosomes=")) \
 		  or (arg.startswith("--chrom="))      or (arg.startswith("--chroms=")):
 			if (chromsOfInterest == None): chromsOfInterest = []
 			chromsOfInterest += argVal.split(",")
+		elif (arg.startswith("--region=")):
+			if (regionsOfInterest == None): regionsOfInterest = []
+			try:
+				regionsOfInterest += [parse_region(argVal)]
+			except ValueError:
+				usage("can't understand %s" % arg)
+		elif (arg.startswith("--index=")):
+			indexFilename = argVal
 		elif (arg.startswith("--origin=")):
 			origin = argVal
 			if (origin == "0"): origin = "zero"
 			if (origin == "1"): origin = "one"
 			assert (origin in ["zero","one"]), "can't understand %s" % arg
+		elif (arg in ["--out=binary","--out=text"]):
+			outputFormat = argVal
 		elif (arg == "--nonames"):
-			outputWhat = [x for x in outputWhat if (x != "name")]
+			spec.outputWhat = [x for x in spec.outputWhat if (x != "name")]
 		elif (arg == "--samrecords"):
-			outputWhat =  [x for x in outputWhat if (x not in ["name","sam record"])]
-			outputWhat += ["sam record"]
+			spec.outputWhat =  [x for x in spec.outputWhat if (x not in ["name","sam record"])]
+			spec.outputWhat += ["sam record"]
 		elif (arg == "--justsamrecords") or (arg == "--justsam"):
-			outputWhat = ["sam record"]
+			spec.outputWhat = ["sam record"]
 		elif (arg.startswith("--report:")):
 			argVal = arg.split(":",1)[1]
 			for variable in argVal.split(","):
-				outputWhat += [variable.strip()]
+				spec.outputWhat += [variable.strip()]
+		elif (arg.startswith("--depth=")):
+			spec.depthChroms = argVal
+		elif (arg.startswith("--mean:")):
+			if ("=" not in arg): usage("--mean requires a chromosome lengths filename: %s" % arg)
+			(value,spec.meanChroms) = arg.split(":",1)[1].split("=",1)
+			spec.meanConstant = 0
+			if ("-" in value):
+				(value,constant) = value.split("-",1)
+				try:               spec.meanConstant = int(constant)
+				except ValueError: spec.meanConstant = float(constant)
+			spec.meanValue = value.strip()
+		elif (arg.startswith("--breakpoints=")) or (arg.startswith("--breakpoints:")):
+			if ("=" not in arg): usage("--breakpoints requires a chromosome lengths filename: %s" % arg)
+			(window,spec.breakpointChroms) = arg[len("--breakpoints"):].split("=",1)
+			if (window != ""):
+				spec.breakpointWindow = int_with_unit(window[1:])
+				if (spec.breakpointWindow < 1): usage("--breakpoints window must be positive")
+		elif (arg.startswith("--meanwidth=")):
+			spec.meanWidth = int(argVal)
+			if (spec.meanWidth not in [2,4,8]): usage("--meanwidth must be 2, 4 or 8")
+		elif (arg.startswith("--precision=")):
+			spec.meanPrecision = int(argVal)
+			if (spec.meanPrecision < 0): usage("--precision can't be negative")
 		elif (arg.startswith("--head=")):
 			headLimit = int_with_unit(argVal)
 		elif (arg.startswith("--progress=output:")) or  (arg.startswith("--progress=written:")):
@@ -239,63 +556,218 @@ def main():
 				reportProgress = int_with_unit(reportProgress)
 			else:
 				reportProgress = int_with_unit(argVal)
+		elif (arg.startswith("--jobs=")):
+			if (":" in argVal):
+				(numJobs,batchSize) = argVal.split(":",1)
+				if (batchSize in ["chromosomes","chromosome","chroms","chrom"]):
+					jobSplit  = "chromosomes"
+					batchSize = 10*1000
+				else:
+					jobSplit  = "batches"
+					batchSize = int_with_unit(batchSize)
+					if (batchSize < 1): usage("batch size must be positive")
+			else:
+				numJobs = argVal
+			numJobs = int(numJobs)
+			if (numJobs < 1): usage("number of jobs must be positive")
+		elif (arg.startswith("--threads:decompress=")) or (arg.startswith("--threads:inflate=")):
+			inflateThreads = int(argVal)
+			if (inflateThreads < 0): usage("number of threads can't be negative")
+		elif (arg.startswith("--readahead=")):
+			readahead = int_with_unit(argVal)
+			if (readahead < 1): usage("readahead must be positive")
+		elif (arg.startswith("--cigarcache=")):
+			cigarCacheSize = int_with_unit(argVal)
+			if (cigarCacheSize < 1): usage("cigar cache size must be positive")
+		elif (arg.startswith("--batchfilter=")):
+			batchFilterSize = int_with_unit(argVal)
+			if (batchFilterSize < 0): usage("batch filter size can't be negative")
+		elif (arg.startswith("--reorder=")):
+			reorderWindow = int_with_unit(argVal)
+			if (reorderWindow < 0): usage("reorder window can't be negative")
+		elif (arg.startswith("--stats=")):
+			statsFilename = argVal
+		elif (arg.startswith("--profile=")):
+			if (":" not in argVal): usage("--profile requires a kind and a file (e.g. \"--profile=sample:run.folded\")")
+			(profileKind,profileFilename) = argVal.split(":",1)
+			if (profileKind == "flamegraph"): profileKind = "sample"
+			if (profileKind not in ["cprofile","sample","phases"]):
+				usage("unrecognized profile kind: \"%s\"" % profileKind)
+			if (profileFilename == ""): usage("--profile requires a file")
+		elif (arg.startswith("--memory=")):
+			memoryLimit = int_with_unit(argVal)
+			if (memoryLimit < 1): usage("memory budget must be positive")
 		elif (arg == "--debug"):
 			debug += ["debug"]
 		elif (arg.startswith("--debug=")):
 			debug += argVal.split(",")
 		elif (arg.startswith("--")):
 			usage("unrecognized option: %s" % arg)
+		elif (inputFilename == None):
+			inputFilename = arg
 		else:
 			usage("unrecognized option: %s" % arg)
 
-	if (mergeEm) and (not mergeButSeparate):
-		extras = [x for x in outputWhat if (x not in ["interval","name","sam record"])]
-		if (extras != []):
-			usage("--report with --mergemates is not implemented yet")
-
-	# preprocess any requirements, changing them into python statements
+	if (outputSpecs == []): outputSpecs = [defaultSpec]
+
+	profiler = None
+	if   (profileKind == "cprofile"): profiler = cProfile.Profile()
+	elif (profileKind == "sample"):   profiler = StackSampler()
+	if (profiler != None): profiler.enable()
+
+	runStats = None
+	if (statsFilename != None) or (profileKind == "phases"):
+		if (profileKind == "phases"): runStats = RunStats(sampleRate=1)
+		else:                         runStats = RunStats()
+		runStats.begin("setup")
+
+	if (partitionKey != None):
+		if (len(outputSpecs) > 1):
+			usage("--partition with more than one --output is not implemented yet")
+		if (numJobs > 1):
+			usage("--partition with --jobs is not implemented yet")
+		if (outputFormat == "binary"):
+			usage("--partition with --out=binary is not implemented yet")
+		spec = outputSpecs[0]
+		if (spec.depthChroms != None) or (spec.meanChroms != None) or (spec.breakpointChroms != None):
+			usage("--partition can't be used with --depth, --mean or --breakpoints")
+		if (spec.mergeEm) and (partitionVariable not in ["QNAME","RNAME"]):
+			usage("--partition by %s with --mergemates or --requiremates is not implemented yet" % partitionKey)
+
+	if (outputFormat == "binary"):
+		if (origin == "one"):
+			usage("--out=binary can't be used with --origin=one")
+		if (numJobs > 1):
+			usage("--out=binary with --jobs is not implemented yet")
+		for spec in outputSpecs:
+			if (spec.depthChroms != None) or (spec.meanChroms != None): continue
+			if (spec.breakpointChroms != None): continue
+			if (spec.outputWhat != ["interval"]):
+				usage("--out=binary requires --nonames (and can't be used with --samrecords, --justsamrecords or --report)")
+			spec.binaryIntervals = True
+
+	for spec in outputSpecs:
+		if (spec.mergeEm) and (not spec.mergeButSeparate):
+			extras = [x for x in spec.outputWhat if (x not in ["interval","name","sam record"])]
+			if (extras != []):
+				usage("--report with --mergemates is not implemented yet")
+		if (spec.rmdup):
+			if (not spec.mergeEm):
+				usage("--rmdup requires --mergemates (or --discordant)")
+			if (spec.mergeButSeparate) and (spec.discordant == None):
+				usage("--rmdup with --requiremates is not implemented yet")
+			if (numJobs > 1):
+				usage("--rmdup with --jobs is not implemented yet")
+		if (spec.depthChroms != None):
+			extras = [x for x in spec.outputWhat if (x not in ["interval","name"])]
+			if ("interval" not in spec.outputWhat) or (extras != []):
+				usage("--depth can't be used with --samrecords, --justsamrecords or --report")
+			if (numJobs > 1):
+				usage("--depth with --jobs is not implemented yet")
+			spec.outputWhat = ["interval"]
+			spec.depth = DepthCoverage(read_chrom_lengths(spec.depthChroms))
+		if (spec.meanChroms != None):
+			extras = [x for x in spec.outputWhat if (x not in ["interval","name"])]
+			if ("interval" not in spec.outputWhat) or (extras != []):
+				usage("--mean can't be used with --samrecords, --justsamrecords or --report")
+			if (spec.depthChroms != None):
+				usage("--mean can't be used with --depth")
+			if (numJobs > 1):
+				usage("--mean with --jobs is not implemented yet")
+			if (spec.discordant != None):
+				usage("--mean with --discordant is not implemented yet")
+			if (spec.mergeEm) and (spec.mergeButSeparate):
+				usage("--mean with --requiremates is not implemented yet")
+			if (spec.mergeEm) and (spec.meanValue != "LENGTH"):
+				usage("--mean with --mergemates can only average LENGTH")
+			if (spec.meanValue != "LENGTH") and (spec.meanValue not in knownVariables):
+				usage("--mean of unknown variable: \"%s\"" % spec.meanValue)
+			spec.outputWhat = ["interval"]
+			spec.mean = MeanCoverage(read_chrom_lengths(spec.meanChroms),spec.meanConstant,
+			                         width=spec.meanWidth,precision=spec.meanPrecision)
+		if (spec.breakpointChroms != None):
+			extras = [x for x in spec.outputWhat if (x not in ["interval","name"])]
+			if ("interval" not in spec.outputWhat) or (extras != []):
+				usage("--breakpoints can't be used with --samrecords, --justsamrecords or --report")
+			if (spec.depthChroms != None) or (spec.meanChroms != None):
+				usage("--breakpoints can't be used with --depth or --mean")
+			if (spec.mergeEm):
+				usage("--breakpoints with --mergemates, --requiremates or --discordant is not implemented yet")
+			if (numJobs > 1):
+				usage("--breakpoints with --jobs is not implemented yet")
+			spec.outputWhat = ["interval"]
+			spec.breakpoints = BreakpointCounts(read_chrom_lengths(spec.breakpointChroms),
+			                                    spec.breakpointWindow)
+
+	mergeEm    = (True in [spec.mergeEm for spec in outputSpecs])
+	outputWhat = outputSpecs[0].outputWhat	# (for progress reports)
+
+	if (len(outputSpecs) > 1):
+		if (numJobs > 1):
+			usage("--jobs with more than one --output is not implemented yet")
+		if (memoryLimit != None):
+			usage("--memory with more than one --output is not implemented yet")
+
+	if (isNameSorted) and (isCoordSorted):
+		usage("--namesorted and --coordsorted can't both be used")
+
+	# preprocess any requirements, changing them into python statements;
+	# those given with an --output apply only to that output
 
 	variablesNeeded = set()
 
-	incoming = requirements
-	requirements = {}
-	for criterion in incoming:
-		alias = criterion
-		if (criterion in knownCriteria):
-			alias = knownCriteria[criterion]
-			if (alias == None):
-				usage("requirement no longer supported: \"%s\"" % criterion)
-			elif (type(alias) != str):
-				assert (alias[0] == None)
-				usage("requirement no longer supported: \"%s\"%s" % (criterion,alias[1]))
-		try:
-			(expression,variables) = criterion_to_python(alias)
-			requirements[criterion] = (expression,variables)
-			for name in variables: variablesNeeded.add(name)
-		except ValueError:
-			usage("uninterpretable requirement: \"%s\"" % criterion)
+	requirements = preprocess_criteria(requirements,"requirement",variablesNeeded)
+	prohibitions = preprocess_criteria(prohibitions,"prohibition",variablesNeeded)
+	for spec in outputSpecs:
+		spec.requirements = preprocess_criteria(spec.requirements,"requirement",variablesNeeded)
+		spec.prohibitions = preprocess_criteria(spec.prohibitions,"prohibition",variablesNeeded)
 
-	incoming = prohibitions
-	prohibitions = {}
-	for criterion in incoming:
-		alias = criterion
-		if (criterion in knownCriteria):
-			alias = knownCriteria[criterion]
-			if (alias == None):
-				usage("prohibition no longer supported: \"%s\"" % criterion)
-			elif (type(alias) != str):
-				assert (alias[0] == None)
-				usage("prohibition no longer supported: \"%s\"%s" % (criterion,alias[1]))
-		try:
-			(expression,variables) = criterion_to_python(alias)
-			prohibitions[criterion] = (expression,variables)
-			for name in variables: variablesNeeded.add(name)
-		except ValueError:
-			usage("uninterpretable prohibition: \"%s\"" % criterion)
+	# compile the requirements and prohibitions;  this may discover names
+	# that criterion_to_python didn't report
 
-	for variable in outputWhat:
-		if (variable in ["interval","name","sam record"]): continue
-		variablesNeeded.add(variable)
+	try:
+		criteria = compile_criteria(requirements,prohibitions)
+		for spec in outputSpecs:
+			spec.criteria = compile_criteria(spec.requirements,spec.prohibitions)
+	except ValueError, ex:
+		usage("uninterpretable criterion: %s" % ex)
+
+	# criteria that involve pair variables are evaluated once for each pair,
+	# when its mates are written (see generate_pair_writer);  the rest are
+	# evaluated for each record
+
+	pairCriteria = [criterion for criterion in criteria if (criterion.isPair)]
+	criteria     = [criterion for criterion in criteria if (not criterion.isPair)]
+	for spec in outputSpecs:
+		spec.pairCriteria = pairCriteria + [criterion for criterion in spec.criteria
+		                                              if (criterion.isPair)]
+		spec.criteria     = [criterion for criterion in spec.criteria
+		                               if (not criterion.isPair)]
+		if (spec.pairCriteria != []) and (not spec.mergeEm):
+			usage("pair variables can't be used without --mergemates or --requiremates\n  in %s" \
+			    % ", ".join(["\"%s\"" % criterion.text for criterion in spec.pairCriteria]))
+
+	for criterion in criteria + sum([spec.criteria for spec in outputSpecs],[]):
+		for name in criterion.names: variablesNeeded.add(name)
+
+	for spec in outputSpecs:
+		for variable in spec.outputWhat:
+			if (variable in ["interval","name","sam record"]): continue
+			variablesNeeded.add(variable)
+		if (spec.meanChroms != None) and (spec.meanValue != "LENGTH"):
+			variablesNeeded.add(spec.meanValue)
+		if (spec.breakpointChroms != None):
+			variablesNeeded.add("CLIPBRK")
+
+	if ("flags" in debug):
+		variablesNeeded.add("FLAGS")
+
+	if (partitionKey != None):
+		variablesNeeded.add(partitionVariable)
+
+	for spec in outputSpecs:
+		if (spec.rmdup) or (spec.discordant != None):
+			variablesNeeded.add("FLAG")	# (for each mate's strand)
 
 	for variable in computedVariables:
 		if (variable not in variablesNeeded): continue
@@ -303,23 +775,12 @@ def main():
 		for name in dependencies:
 			variablesNeeded.add(name)
 
-	variablesNeeded = list(variablesNeeded)
-	variablesNeeded.sort()
+	if ("CIGARINFO" in variablesNeeded):	# (the parsed cigar is internal)
+		variablesNeeded.remove("CIGARINFO")
 
-	if (not mergeEm) and (not mergeButSeparate):
-		pairVariablesNeeded = [variable for variable in variablesNeeded
-		                                if (variable in pairVariables)]
-		assert (pairVariablesNeeded == []), \
-		       "pair variables can't be used without --mergemates or --requiremates\n" \
-		     + "  pair variables: %s" \
-		     % ",".join(pairVariablesNeeded)
-	else:
-		pairVariablesNeeded = [variable for variable in variablesNeeded
-		                                if (variable in pairVariables)]
-		assert (pairVariablesNeeded == []), \
-		       "sorry, pair variables aren't implemented yet\n" \
-		     + "  pair variables: %s" \
-		     % ",".join(pairVariablesNeeded)
+	variablesNeeded = [variable for variable in variablesNeeded
+	                            if (variable not in pairVariables)]
+	variablesNeeded.sort()
 
 	tagsNeeded = []
 	for tag in tagToVariable:
@@ -328,11 +789,31 @@ def main():
 			tagsNeeded += [tag]
 	tagsNeeded.sort()
 
+	# figure out how much of each SAM line we need to look at;  QNAME, RNAME,
+	# POS and CIGAR are always needed, to create intervals (and RNEXT and PNEXT
+	# to pair coordinate-sorted mates);  we only need to split the line out to
+	# the last column we need, unless tags are needed
+
+	samFieldsNeeded = set(["QNAME","RNAME","POS","CIGAR"])
+	if (mergeEm) and (isCoordSorted): samFieldsNeeded.update(["RNEXT","PNEXT"])
+	for name in variablesNeeded:
+		if (name == "FLAGS"): name = "FLAG"
+		if (name in samFieldToColumn): samFieldsNeeded.add(name)
+
+	samFieldsNeeded = [(samFieldToColumn[name],name) for name in samFieldsNeeded]
+	samFieldsNeeded.sort()
+	samFieldsNeeded = [(name,col) for (col,name) in samFieldsNeeded]
+
+	if (tagsNeeded != []): splitLimit = -1
+	else:                  splitLimit = 1 + max([col for (_,col) in samFieldsNeeded])
+
+	pairTexts = set([criterion.text for criterion in pairCriteria])
+
 	if ("evaluation" in debug) and (requirements != {}):
 		print >>stderr, "=== requirements ==="
 		for criterionStr in requirements:
-			(criterion,vars) = requirements[criterionStr]
-			if ([var for var in vars if (var in pairVariables)] == []):
+			(criterion,_) = requirements[criterionStr]
+			if (criterionStr not in pairTexts):
 				print >>stderr, "  \"%s\" evaluated as \"%s\"" % (criterionStr,criterion)
 			else:
 				print >>stderr, "  \"%s\" pair-evaluated as \"%s\"" % (criterionStr,criterion)
@@ -340,12 +821,26 @@ def main():
 	if ("evaluation" in debug) and (prohibitions != {}):
 		print >>stderr, "=== prohibitions ==="
 		for criterionStr in prohibitions:
-			(criterion,vars) = prohibitions[criterionStr]
-			if ([var for var in vars if (var in pairVariables)] == []):
+			(criterion,_) = prohibitions[criterionStr]
+			if (criterionStr not in pairTexts):
 				print >>stderr, "  \"%s\" evaluated as \"%s\"" % (criterionStr,criterion)
 			else:
 				print >>stderr, "  \"%s\" pair-evaluated as \"%s\"" % (criterionStr,criterion)
 
+	if ("evaluation" in debug):
+		for spec in outputSpecs:
+			specCriteria = spec.criteria + [criterion for criterion in spec.pairCriteria
+			                                          if (criterion not in pairCriteria)]
+			if (specCriteria == []): continue
+			print >>stderr, "=== criteria for output %s ===" % spec.name
+			for criterion in specCriteria:
+				if (not criterion.isPair):
+					print >>stderr, "  %s \"%s\" evaluated as \"%s\"" \
+					              % (criterion.kind,criterion.text,criterion.expression)
+				else:
+					print >>stderr, "  %s \"%s\" pair-evaluated as \"%s\"" \
+					              % (criterion.kind,criterion.text,criterion.expression)
+
 	if ("context" in debug):
 		print >>stderr, "=== variables needed ==="
 		for name in variablesNeeded:
@@ -356,349 +851,1931 @@ def main():
 		for tag in tagsNeeded:
 			print >>stderr, "  %s" % tag
 
-	# process the SAM file
+	if ("context" in debug):
+		print >>stderr, "=== sam fields needed ==="
+		for (name,col) in samFieldsNeeded:
+			print >>stderr, "  %-5s (column %d)" % (name,col+1)
 
-	readIntervals   = None
-	readToIntervals = None
-	if (mergeEm):
-		if (isNameSorted): prevQName = None
-		else:              readToIntervals = {}
+	cigarCache = CigarCache(cigarCacheSize)
 
-	for sam in read_sam_simple(stdin):
-		(lineNumber,samRecord,context) = sam
+	# open the input;  we read BAM directly (if the input is BGZF compressed),
+	# otherwise it's SAM text
 
-		if ("input" in debug):
-			print >>stderr, lineNumber,context["QNAME"],context["RNAME"]
+	if (inputFilename == None): f = stdin
+	else:                       f = file(inputFilename,"rb")
 
-		rName = context["RNAME"]
-		if (chromsOfInterest != None) and (rName not in chromsOfInterest):
-			continue
+	# an index (for BAM input) lets us read only the parts of the file we
+	# need, and lets us split the work into a job per reference sequence
 
-		cigar = context["CIGAR"]
-		if (cigar == "*"):
-			rName = rPos = start = end = "*"
+	splitByChrom = False
+
+	(isBgzf,magic) = sniff_bgzf(f)
+	if (isBgzf):
+		inputFormat = "bam"
+		bgzf = new_bgzf_reader(f,prefix=magic)
+		try:
+			bamHeader = read_bam_header(bgzf)
+		except BamError, ex:
+			assert (False), "%s (%s)" % (ex,inputFilename if (inputFilename != None) else "stdin")
+
+		index = None
+		if (inputFilename != None) and (not isNameSorted):
+			if (indexFilename == None):
+				indexFilename = bam_index_filename(inputFilename)
+			if (indexFilename != None) \
+			   and ((regionsOfInterest != None) or (chromsOfInterest != None) \
+			     or ((numJobs > 1) and (jobSplit != "batches"))):
+				index = read_index(indexFilename)
+
+		splitByChrom = (numJobs > 1) and (index != None) and (jobSplit != "batches") \
+		           and (headLimit == None)
+		if (jobSplit == "chromosomes") and (numJobs > 1) and (not splitByChrom):
+			if (headLimit != None):
+				usage("--jobs=<number>:chromosomes can't be used with --head")
+			usage("--jobs=<number>:chromosomes requires an indexed BAM file (not name-sorted)")
+
+		if (splitByChrom):
+			chromJobs = chromosome_jobs(index,bgzf.tell())
+			if ("index" in debug):
+				print >>stderr, "=== index chunks (%s) ===" % indexFilename
+				for (chrom,chunks) in chromJobs:
+					print >>stderr, "  %s" % chrom
+					report_chunks(chunks,indent="    ")
+		elif (index != None) \
+		   and ((regionsOfInterest != None) or (chromsOfInterest != None)):
+			chunks = index_chunks(index,indexed_regions())
+			if ("index" in debug):
+				print >>stderr, "=== index chunks (%s) ===" % indexFilename
+				report_chunks(chunks)
+			samInput = chain.from_iterable(bgzf.chunk_records(chunks))
 		else:
-			extent = cigar_to_extent(cigar,lineNumber=lineNumber)
-			if (extent == None): continue
-			rPos  = context["POS"]
-			(left,right) = extent
-			start = rPos - left
-			end   = rPos + right
-			if (start < 0): start = 0
-			assert (end >= start), "start > end (%d > %d) at line %d" \
-								 % (start,end,lineNumber)
-			if (origin == "one"): start += 1
-
-		qName = context["QNAME"]
-		if (not mergeEm):
-			write_interval(rName,start,end,qName,context,samRecord,rPos,cigar)
-			continue
-
-		if (isNameSorted):
-			if (prevQName == None):
-				readIntervals = []
-				prevQName = qName
-			elif (qName != prevQName):
-				write_merged_interval(prevQName,readIntervals,reportSeparate=mergeButSeparate)
-				readIntervals = []
-				prevQName = qName
-			readIntervals += [(rName,start,end,context,samRecord)]
-			continue
-
-		if (qName not in readToIntervals):
-			readToIntervals[qName] =  [(rName,start,end,context,samRecord)]
+			samInput = bgzf.records()
+	else:
+		if (jobSplit == "chromosomes") and (numJobs > 1):
+			usage("--jobs=<number>:chromosomes requires an indexed BAM file (not SAM)")
+		inputFormat = "sam"
+		bamHeader = None
+
+	if (isCoordSorted) and (mergeEm) and (numJobs > 1) and (not splitByChrom):
+		usage("--coordsorted with --mergemates and --jobs requires an indexed BAM file")
+
+	# criteria that only involve numeric fields can be evaluated for a batch
+	# of SAM records at once (see BatchFilter);  this doesn't apply when the
+	# whole context is shown for each record, or if all the criteria only
+	# involve FLAG (the flag prefilter, below, is cheaper for those)
+
+	batchFilter = None
+	if (batchFilterSize > 0) and (inputFormat == "sam") \
+	   and ("evaluation" not in debug) and ("context" not in debug) and ("flags" not in debug):
+		batchCriteria = [criterion for criterion in criteria
+		                           if (criterion.vectorSource != None)]
+		if ([criterion for criterion in batchCriteria if (not criterion.flagOnly)] == []):
+			batchCriteria = []
+		if (batchCriteria != []):
+			try:                import numpy
+			except ImportError: numpy = None
+		if (batchCriteria != []) and (numpy != None):
+			batchFilter = BatchFilter(batchCriteria,batchFilterSize)
+		elif (batchCriteria != []) and ("batchfilter" in debug):
+			print >>stderr, "(NumPy is not available, so criteria are evaluated record by record)"
+
+	# criteria that can be decided from FLAG alone are checked before the rest
+	# of the record is looked at (see flag_rejects), unless the batch filter
+	# has already checked them
+
+	flagRejects  = None
+	flagCriteria = []
+	if ("evaluation" not in debug) and ("context" not in debug) and ("flags" not in debug):
+		flagCriteria = [criterion for criterion in criteria if (criterion.flagOnly)]
+		if (batchFilter != None):
+			flagCriteria = [criterion for criterion in flagCriteria
+			                          if (criterion not in batchFilter.criteria)]
+		if (flagCriteria != []):
+			flagRejects = flag_rejects(flagCriteria)
+			if ("flagfilter" in debug):
+				print >>stderr, "flag prefilter: %s of %s FLAG values rejected by %s" \
+				              % (commatize(len(flagRejects)),commatize(flagValuesLimit),
+				                 " and ".join(["\"%s\"" % criterion.text for criterion in flagCriteria]))
+
+	# (a batch filter reads SAM text in large blocks, rather than by lines)
+
+	if (inputFormat == "sam"):
+		if (batchFilter != None) and (numJobs == 1): samInput = SamText(f,prefix=magic)
+		elif (magic == ""):                          samInput = f
+		else:                                        samInput = chain([magic + f.readline()],f)
+
+	# choose the order in which to evaluate the criteria, from what they cost
+	# and how often they reject over the first records (see reorder_criteria);
+	# those records are read ahead and then processed as usual
+
+	orderedCriteria = [criterion for criterion in criteria
+	                             if (batchFilter == None) or (criterion not in batchFilter.criteria)]
+	if (reorderWindow > 0) and (len(orderedCriteria) > 1) and (not splitByChrom):
+		if (isinstance(samInput,SamText)):
+			warmup = samInput.read_ahead(reorderWindow)
 		else:
-			readToIntervals[qName] += [(rName,start,end,context,samRecord)]
+			warmup = list(islice(samInput,reorderWindow))
+			samInput = chain(warmup,samInput)
+		criteria = [criterion for criterion in criteria if (criterion not in orderedCriteria)] \
+		         + reorder_criteria(orderedCriteria,warmup)
 
-	# output merged intervals
+	# generate the code to process the SAM file
 
-	if (readIntervals != None):
-		write_merged_interval(prevQName,readIntervals,reportSeparate=mergeButSeparate)
-	elif (readToIntervals != None):
-		for qName in readToIntervals:
-			write_merged_interval(qName,readToIntervals[qName],reportSeparate=mergeButSeparate)
+	source = generate_sam_processor()
 
+	if ("codegen" in debug):
+		print >>stderr, "=== generated code ==="
+		for (lineNum,line) in enumerate(source.split("\n")):
+			print >>stderr, "%4d  %s" % (lineNum+1,line)
 
-def write_merged_interval(qName,intervals,reportSeparate=False):
-	if (len(intervals) == 1): return
+	outputFiles = []
+	for spec in outputSpecs:
+		if (partitionKey != None):         outputFiles += [PartitionFiles(partitionPrefix,partitionN)]
+		elif (spec.filename in [None,"-"]): outputFiles += [stdout]
+		elif (outputFormat == "binary"):   outputFiles += [file(spec.filename,"wb")]
+		else:                              outputFiles += [file(spec.filename,"wt")]
 
-	if (not reportSeparate):
-		rNames = {}
-		for (rName,_,_,_,_) in intervals:
-			rNames[rName] = True
-		if (len(list(rNames)) != 1): return
+	for (spec,outF) in zip(outputSpecs,outputFiles):
+		if (spec.binaryIntervals): spec.binaryWriter = IntervalWriter(outF)
 
-	intervals.sort()
-	(rName1,start1,end1,context1,samRecord1) = intervals[0]
-	end = max([e for (_,_,e,_,_) in intervals])
-	if (reportSeparate):
-		intervals = [(e,s,rName,context,samRecord) for (rName,s,e,context,samRecord) in intervals[1:]]
-		intervals.sort()
-		(end2,start2,rName2,context2,samRecord2) = intervals[-1]
+	samProcessor = compile_sam_processor(source,[outF.write for outF in outputFiles])
+	if (partitionKey != None):
+		samProcessor["shardWrites"]  = [shardF.write for shardF in outputFiles[0].shards]
+		samProcessor["shardWriteOf"] = outputFiles[0].writeOf
+		samProcessor["new_shard"]    = outputFiles[0].new_shard
 
-	if (mergeDistanceMin != None) and (end-start1 < mergeDistanceMin):
-		return
-	if (mergeDistanceMax != None) and (end-start1 > mergeDistanceMax):
-		return
+	# process the SAM file
+
+	if (runStats != None): runStats.end()
+
+	if (inputFormat == "bam"):
+		for (spec,outF) in zip(outputSpecs,outputFiles):
+			if (spec.outputWhat != ["sam record"]): continue
+			for line in header_sq_lines(bamHeader):
+				outF.write(line + "\n")
 
-	if (reportSeparate):
-		write_interval(rName1,start1,end1,qName,context1,samRecord1)
-		write_interval(rName2,start2,end2,qName,context2,samRecord2)
+	# temporary files (mate spills, see MateSpill, and the output of the jobs
+	# of process_sam_chromosome) go in a directory of their own;  if the run
+	# fails, the spills are removed, along with any file a worker process left
+	# behind
+
+	if (memoryLimit != None) or (splitByChrom):
+		runTempDir = mkdtemp(prefix="filtered_sam_to_intervals.",suffix=".tmp")
+
+	try:
+		if (splitByChrom):
+			process_sam_in_parallel(chromJobs,process_sam_chromosome,samProcessor,numJobs)
+		elif (numJobs == 1):
+			samProcessor["process_sam"](samInput)
+		else:
+			process_sam_in_parallel(sam_batches(samInput,batchSize),process_sam_batch,
+			                        samProcessor,numJobs)
+	except:
+		remove_mate_spills()
+		if (runTempDir != None): rmtree(runTempDir,ignore_errors=True)
+		raise
+
+	if (runTempDir != None): rmtree(runTempDir,ignore_errors=True)
+
+	if (runStats != None): runStats.begin("write")
+
+	if (inputFormat == "bam"): bgzf.close()
+	if (f != stdin): f.close()
+	for (spec,outF) in zip(outputSpecs,outputFiles):
+		if (spec.depthChroms != None): spec.depth.write(outF)
+		if (spec.meanChroms  != None): spec.mean.write(outF)
+		if (spec.breakpointChroms != None): spec.breakpoints.write(outF)
+		if (spec.binaryIntervals):    spec.binaryWriter.close()
+		if (outF != stdout): outF.close()
+
+	if (runStats != None):
+		runStats.end()
+		if (statsFilename != None): write_stats(statsFilename,flagCriteria)
+		if (profileKind == "phases"): write_phase_profile(profileFilename)
+
+	if (profiler != None):
+		profiler.disable()
+		profiler.dump_stats(profileFilename)
+
+	if ("decompress" in debug) and (inputFormat == "bam"):
+		bgzf.report(stderr)
+
+	if ("cigarcache" in debug):
+		cigarCache.report(stderr)
+
+	if ("batchfilter" in debug) and (batchFilter != None):
+		batchFilter.report(stderr)
+
+
+# output specs--
+#	Each output (see --output) is described by an OutputSpec, holding what it
+#	writes (outputWhat, or depth of coverage, mean value, or breakpoint
+#	counts), how it merges mates, and the criteria that apply to it alone.
+#	Options given before the first --output are the defaults for all of them.
+
+class OutputSpec: pass
+
+def new_output_spec(name,filename,like=None):
+	spec = OutputSpec()
+	spec.name     = name
+	spec.filename = filename
+	spec.binaryIntervals = False	# (set once all the options are known)
+	spec.binaryWriter    = None
+	if (like == None):
+		spec.outputWhat       = ["interval","name"]
+		spec.mergeEm          = False
+		spec.mergeButSeparate = False
+		spec.mergeDistanceMin = None
+		spec.mergeDistanceMax = None
+		spec.rmdup            = False
+		spec.discordant       = None
+		spec.depthChroms      = None
+		spec.meanChroms       = None
+		spec.breakpointChroms = None
+		spec.breakpointWindow = 10
+		spec.meanValue        = None
+		spec.meanConstant     = 0
+		spec.meanWidth        = 4
+		spec.meanPrecision    = 0
 	else:
-		write_interval(rName,start1,end,qName)
+		spec.outputWhat       = list(like.outputWhat)
+		spec.mergeEm          = like.mergeEm
+		spec.mergeButSeparate = like.mergeButSeparate
+		spec.mergeDistanceMin = like.mergeDistanceMin
+		spec.mergeDistanceMax = like.mergeDistanceMax
+		spec.rmdup            = like.rmdup
+		spec.discordant       = like.discordant
+		spec.depthChroms      = like.depthChroms
+		spec.meanChroms       = like.meanChroms
+		spec.breakpointChroms = like.breakpointChroms
+		spec.breakpointWindow = like.breakpointWindow
+		spec.meanValue        = like.meanValue
+		spec.meanConstant     = like.meanConstant
+		spec.meanWidth        = like.meanWidth
+		spec.meanPrecision    = like.meanPrecision
+	spec.requirements = []
+	spec.prohibitions = []
+	spec.criteria     = []
+	return spec
+
+
+# preprocess_criteria--
+#	Change a list of requirements or prohibitions (kind tells which) into a
+#	dict mapping each criterion to (expression,variables), with the expression
+#	as python;  the variables are also added to variablesNeeded.
+
+def preprocess_criteria(incoming,kind,variablesNeeded):
+	criteria = {}
+	for criterion in incoming:
+		alias = criterion
+		if (criterion in knownCriteria):
+			alias = knownCriteria[criterion]
+			if (alias == None):
+				usage("%s no longer supported: \"%s\"" % (kind,criterion))
+			elif (type(alias) != str):
+				assert (alias[0] == None)
+				usage("%s no longer supported: \"%s\"%s" % (kind,criterion,alias[1]))
+		try:
+			(expression,variables) = criterion_to_python(alias)
+			criteria[criterion] = (expression,variables)
+			for name in variables: variablesNeeded.add(name)
+		except ValueError:
+			usage("uninterpretable %s: \"%s\"" % (kind,criterion))
+	return criteria
+
+
+# generated record processor--
+#	Rather than having one generic loop decide, for every SAM record, which
+#	fields to parse, which variables to compute, and what to output, we write
+#	python source for a loop specialized to the current options, and exec it.
+#	Use --debug=codegen to see the generated source.
+#
+#	The generated process_sam(f) reads SAM lines from f and writes output lines
+#	with write_output() (which is bound when the code is compiled).  With
+#	--mergemates or --requiremates we also generate write_pair(qName,mates),
+#	which is given all the records with the same name;  each "mate" is
+#	(rName,start,end,text), where text is the mate's output line (or None if
+#	the mates are merged into a single line, or with --rmdup, the mate's
+#	strand).
+#
+#	With more than one --output, each output spec has its own numbered copy of
+#	these (write_output1, write_pair1, mates1, etc.), and its part of the loop
+#	is guarded by its own criteria.  Parsing and the shared criteria are done
+#	once per record.
+#
+#	When f is only part of the input (see --jobs), lineNumber and recordNumber
+#	tell process_sam how many lines and records precede it.  Unsorted mates
+#	can't be paired until all the input has been seen, so in that case the
+#	caller passes a dict as pending, and process_sam collects the mates into it
+#	rather than writing them.  With --memory, mates beyond the budget are
+#	spilled to disk (see MateSpill), and process_sam returns the spill (or
+#	None) along with whatever is left in pending.
+#
+#	Each variable is computed just before the first criterion that uses it, so
+#	a record rejected by an early criterion doesn't pay for variables that only
+#	later criteria need.  The debugging options that show the whole context
+#	(evaluation, context and flags) instead compute everything up front.
+#
+#	With --stats, the processor also counts the records it discards (at each
+#	point where it discards them) and what it writes, and times a sample of
+#	the records (see RunStats);  without it, none of that code is generated.
+
+samIntFields = ["FLAG","POS","MAPQ","PNEXT","TLEN"]
+
+def generate_sam_processor():
+	showContext = ("evaluation" in debug) or ("context" in debug) or ("flags" in debug)
+	specSuffixes = [spec_suffix(specNum) for specNum in range(len(outputSpecs))]
+
+	src = []
+	src += ["def process_sam(f,lineNumber=0,recordNumber=0,pending=None):"]
+	if (writtenProgress != None) \
+	   and (False in [spec.mergeEm for spec in outputSpecs]):
+		src += ["	global numberWritten"]
+	for (spec,sfx) in zip(outputSpecs,specSuffixes):
+		src += ["	write%s = write_output%s" % (sfx,sfx)]
+	if (mergeEm) and (isNameSorted):
+		src += ["	prevQName = None"]
+	for (spec,sfx) in zip(outputSpecs,specSuffixes):
+		if (not spec.mergeEm) or (isNameSorted): continue
+		if (isCoordSorted):	# (qNameToMates holds mates on other chromosomes)
+			src += ["	if (pending == None): qNameToMates%s = {}" % sfx]
+			src += ["	else:                 qNameToMates%s = pending" % sfx]
+			src += ["	nearMates%s = {}" % sfx]
+			src += ["	matePositions%s = []" % sfx]
+			src += ["	scanChrom%s = scanPos%s = None" % (sfx,sfx)]
+		else:
+			src += ["	if (pending == None): qNameToMates%s = {}" % sfx]
+			src += ["	else:                 qNameToMates%s = pending" % sfx]
+			if (memoryLimit != None):
+				src += ["	(pendingBytes,spill) = (0,None)"]
+	if (runStats != None) and (batchFilter == None):
+		src += ["	firstRecordNumber = recordNumber"]
+	if (inputFormat == "bam"):
+		src += ["	for rec in f:"]
+		src += ["		lineNumber += 1"]	# (for BAM, we count records as lines)
+	elif (batchFilter != None):	# (batchFilter counts lines and records)
+		src += ["	for (lineNumber,recordNumber,line,batchChecked) in batchFilter.lines(f,lineNumber,recordNumber):"]
+	else:
+		src += ["	for line in f:"]
+		src += ["		lineNumber += 1"]
+	if (inputFormat != "bam"):
+		src += ["		if (line.startswith(\"@\")):"]
+		for (spec,sfx) in zip(outputSpecs,specSuffixes):
+			if (spec.outputWhat != ["sam record"]): continue # (nothing but sam is being output)
+			src += ["			if (line.startswith(\"@SQ\")): write%s(line.strip() + \"\\n\")" % sfx]
+		src += ["			continue"]
+	if (batchFilter == None):
+		src += ["		recordNumber += 1"]
+		if (reportProgress != None):
+			src += ["		if (recordNumber %% %d == 0): report_records_read(recordNumber)" % reportProgress]
+		if (headLimit != None):
+			src += ["		if (recordNumber > %d):" % headLimit]
+			src += ["			print >>stderr, \"limit of %d sam records reached\"" % headLimit]
+			src += ["			break"]
+	if (runStats != None):
+		if (runStats.sampleRate == 1):
+			src += ["		sampled = True"]
+		else:
+			src += ["		sampled = (recordNumber %% %d == 0)" % runStats.sampleRate]
+		src += ["		if (sampled): runStats.mark(\"parse\")"]
+
+	emitted = set()
+	def emit_variable(name):
+		if (name in emitted): return
+		(dependencies,lines) = variable_source(name)
+		for dependency in dependencies: emit_variable(dependency)
+		for line in lines: src.append("\t\t" + line)
+		emitted.add(name)
+		if (name in tagToVariable.values()):
+			for tag in tagsNeeded: emitted.add(tagToVariable[tag])
+
+	# split the line (or for BAM, unpack the record's fixed-length fields);
+	# records with a FLAG that the criteria reject are discarded first, for
+	# SAM before the rest of the line is split
+
+	if (inputFormat == "bam"):
+		src += ["		(%s) = unpack_bam_core(rec)" % ",".join(bamCoreNames)]
+		for name in bamCoreNames: emitted.add(name)
+		if (flagRejects != None):
+			src += discard_source("(FLAG in flagRejects)","flagRejects[FLAG]")
+	else:
+		if (flagRejects != None):
+			src += ["		flagFields = line.split(None,2)"]
+			src += discard_source("(len(flagFields) > 1) and (flagFields[1] in flagRejects)",
+			                      "flagRejects[flagFields[1]]")
+		if (splitLimit < 0):
+			src += ["		fields = line.split()"]
+		else:
+			src += ["		fields = line.split(None,%d)" % splitLimit]
+		if (splitLimit < 0) or (splitLimit+1 >= SAM_MIN_COLUMNS):
+			src += ["		if (len(fields) < %d): too_few_columns(lineNumber,len(fields),%d)" \
+			      % (SAM_MIN_COLUMNS,SAM_MIN_COLUMNS)]
+		else:	# (the line isn't split out to the last required column, so we count tabs)
+			src += ["		if (line.count(\"\\t\") < %d): too_few_columns(lineNumber,len(line.split()),%d)" \
+			      % (SAM_MIN_COLUMNS-1,SAM_MIN_COLUMNS)]
+
+	if ("evaluation" in debug) and (inputFormat == "bam"):
+		for name in ["QNAME","RNAME"]: emit_variable(name)
+		src += ["		print >>stderr"]
+		src += ["		print >>stderr, \"line %d: \\\"%s %d %s %d\\\"\" % (lineNumber,QNAME,FLAG,RNAME,POS+1)"]
+	elif ("evaluation" in debug):
+		src += ["		print >>stderr"]
+		src += ["		print >>stderr, \"line %d: \\\"%s\\\"\" % (lineNumber,\" \".join(fields[:4]))"]
+
+	if (runStats != None):
+		src += ["		if (sampled): runStats.mark(\"filter\")"]
+
+	# if we are only to process a named-based subset, filter out any reads
+	# not in that subset
+
+	if (subsetN != None):
+		emit_variable("QNAME")
+		src += discard_source("(1 + (int(md5_new(QNAME).hexdigest()[:25],16) %% %d) != %d)" \
+		                    % (subsetN,subsetK),stats_counter("subset"))
+
+	# compute variables and evaluate criteria
+
+	emit_variable("RNAME")
+	if (chromsOfInterest != None):
+		src += discard_source("(RNAME not in chromsOfInterest)",stats_counter("chromosomes"))
+	if (regionsOfInterest != None):
+		src += discard_source("(RNAME not in regionsByChrom)",stats_counter("regions"))
+		for name in ["POS","CIGARINFO"]: emit_variable(name)
+		src += discard_source("(not in_regions(regionsByChrom[RNAME],POS,CIGARINFO))",stats_counter("regions"))
+
+	if (showContext):
+		contextNames = ["LINENUMBER"] + variablesNeeded
+		for name in ["QNAME","RNAME","POS","CIGAR"]:
+			if (name not in contextNames): contextNames += [name]
+		for name in contextNames: emit_variable(name)
+		src += ["		context = { %s }" % ", ".join(["\"%s\":%s" % (name,name) for name in contextNames])]
+		if ("context" in debug) or ("flags" in debug):
+			src += ["		print_context(lineNumber,context)"]
+
+	if (inputFormat == "bam"): lineSource = "record_to_sam(rec,refNames)"
+	else:                      lineSource = "line"
+
+	if ("evaluation" in debug):
+		src += discard_source("(not evaluate_criteria_verbosely(context,lineNumber,%s))" % lineSource,None)
+	else:
+		for criterion in criteria:
+			for name in criterion.names: emit_variable(name)
+			if (batchFilter != None) and (criterion in batchFilter.criteria):
+				if (criterion.kind == "requirement"):
+					condition = "(not batchChecked) and (not %s)" % criterion.source
+				else:
+					condition = "(not batchChecked) and %s" % criterion.source
+			elif (criterion.kind == "requirement"):
+				condition = "(not %s)" % criterion.source
+			else:
+				condition = criterion.source
+			src += discard_source(condition,stats_counter(criterion))
+
+	if (runStats != None):
+		src += ["		if (sampled): runStats.mark(\"context\")"]
+
+	lineFormats = [output_line_format(spec) for spec in outputSpecs]
+
+	needInterval = (mergeEm) or (True in ["interval" in spec.outputWhat for spec in outputSpecs])
+	if (needInterval):
+		for name in ["RNAME","POS","CIGARINFO"]: emit_variable(name)
+	if (mergeEm) or ("input" in debug):
+		emit_variable("QNAME")
+	if (mergeEm) and (isCoordSorted):
+		for name in ["RNEXT","PNEXT"]: emit_variable(name)
+	for spec in outputSpecs:
+		for criterion in spec.criteria:
+			for name in criterion.names: emit_variable(name)
+	for (lineFormat,lineArgs) in lineFormats:
+		for name in lineArgs:
+			if (name in knownVariables): emit_variable(name)
+	if (partitionKey != None):
+		emit_variable(partitionVariable)
+	for spec in outputSpecs:
+		if (spec.rmdup) or (spec.discordant != None): emit_variable("FLAG")
+
+	if ("input" in debug):
+		src += ["		print >>stderr, lineNumber,QNAME,RNAME"]
+
+	# compute the interval
+
+	if (needInterval):
+		src += ["		if (CIGARINFO == None):"]
+		src += ["			rName = start = end = \"*\""]
+		src += ["		else:"]
+		src += ["			(left,right) = CIGARINFO.extent or cigar_info_to_extent(CIGARINFO,lineNumber)"]
+		src += ["			rName = RNAME"]
+		src += ["			start = POS - left"]
+		src += ["			end   = POS + right"]
+		src += ["			if (start < 0): start = 0"]
+		src += ["			if (end < start): start_after_end(start,end,lineNumber)"]
+		if (origin == "one"):
+			src += ["			start += 1"]
+
+	# with name-sorted input, a change of name completes each output's group of
+	# mates
+
+	mergingSpecs = [(spec,sfx) for (spec,sfx) in zip(outputSpecs,specSuffixes)
+	                           if (spec.mergeEm)]
+
+	if (mergeEm) and (isNameSorted):
+		if (runStats != None):
+			src += ["		if (sampled): runStats.mark(\"merge\")"]
+		src += ["		if (QNAME != prevQName):"]
+		src += ["			if (prevQName != None):"]
+		for (spec,sfx) in mergingSpecs:
+			src += ["				write_pair%s(prevQName,mates%s)" % (sfx,sfx)]
+		src += ["			prevQName = QNAME"]
+		for (spec,sfx) in mergingSpecs:
+			src += ["			mates%s = []" % sfx]
+
+	# format the output line(s);  each output has its own criteria, if any
+
+	finalSrc = []
+	for (specNum,spec,sfx,(lineFormat,lineArgs)) \
+	      in zip(range(len(outputSpecs)),outputSpecs,specSuffixes,lineFormats):
+		specSrc = []
+		if (not spec.mergeEm):
+			if (spec.depthChroms != None):
+				specSrc += ["depth%s.add(rName,start,end)" % sfx]
+			elif (spec.meanChroms != None):
+				specSrc += ["mean%s.add(rName,start,end,%s)" % (sfx,mean_value_source(spec,"start","end"))]
+			elif (spec.breakpointChroms != None):	# (unclipped records aren't written)
+				specSrc += ["if (CLIPBRK != \"(NO_CLIPBRK)\"):"]
+				specSrc += ["	breakpoints%s.add(RNAME,CLIPBRK)" % sfx]
+			elif (spec.binaryIntervals):
+				specSrc += ["if (rName != \"*\"): intervals%s.write(rName,start,end)" % sfx]
+			elif (partitionKey != None):
+				specSrc += ["%s(\"%s\\n\" %% (%s,))" \
+				          % (partition_write_source(partitionVariable),lineFormat,",".join(lineArgs))]
+			else:
+				specSrc += ["write%s(\"%s\\n\" %% (%s,))" % (sfx,lineFormat,",".join(lineArgs))]
+			if (spec.breakpointChroms != None): indent = "\t"
+			else:                               indent = ""
+			if (writtenProgress != None):
+				specSrc += written_progress_source(indent)
+			if (runStats != None):
+				specSrc += [indent + "statsCounts[%d] += 1" % stats_counter(("written",spec))]
+		else:
+			if (spec.discordant != None) and (lineFormat != ""):
+				specSrc += ["mate = (rName,start,end,(\"R\" if (FLAG & 0x10) else \"F\") + \"%s\\n\" %% (%s,))" \
+				          % (lineFormat,",".join(lineArgs))]
+			elif (spec.discordant != None):
+				specSrc += ["mate = (rName,start,end,\"R\" if (FLAG & 0x10) else \"F\")"]
+			elif (spec.mergeButSeparate) and (lineFormat != ""):
+				specSrc += ["mate = (rName,start,end,\"%s\\n\" %% (%s,))" % (lineFormat,",".join(lineArgs))]
+			elif (spec.rmdup):
+				specSrc += ["mate = (rName,start,end,\"R\" if (FLAG & 0x10) else \"F\")"]
+			else:
+				specSrc += ["mate = (rName,start,end,None)"]
+
+			if (isNameSorted):
+				specSrc += ["mates%s.append(mate)" % sfx]
+				finalSrc += ["	if (prevQName != None): write_pair%s(prevQName,mates%s)" % (sfx,sfx)]
+			elif (isCoordSorted):
+				(loopSrc,endSrc) = coord_sorted_pairing_source(spec,sfx)
+				specSrc  += loopSrc
+				finalSrc += endSrc
+			else:
+				specSrc += ["if (QNAME in qNameToMates%s): qNameToMates%s[QNAME].append(mate)" % (sfx,sfx)]
+				specSrc += ["else:                       qNameToMates%s[QNAME] = [mate]" % sfx]
+				if (splitByChrom):
+					specSrc += ["if (nextRefID != refID): remoteQNames.add(QNAME)"]
+				if (memoryLimit == None):
+					finalSrc += ["	if (pending != None): return"]
+					finalSrc += ["	for qName in qNameToMates%s:" % sfx]
+					finalSrc += ["		write_pair%s(qName,qNameToMates%s[qName])" % (sfx,sfx)]
+				else:
+					if (spec.mergeButSeparate) and (lineFormat != ""):
+						specSrc += ["pendingBytes += %d + len(QNAME) + len(mate[3])" % MATE_OVERHEAD]
+					else:
+						specSrc += ["pendingBytes += %d + len(QNAME)" % MATE_OVERHEAD]
+					specSrc += ["if (pendingBytes > %d):" % memoryLimit]
+					specSrc += ["	spill = spill_mates(qNameToMates,spill)"]
+					specSrc += ["	pendingBytes = 0"]
+					finalSrc += ["	if (pending != None): return spill"]
+					finalSrc += ["	for (qName,mates) in mate_groups(qNameToMates,[spill]):"]
+					finalSrc += ["		write_pair(qName,mates)"]
+
+		if (runStats != None):
+			src += ["		if (sampled): runStats.mark(\"%s\")" % ("merge" if (spec.mergeEm) else "write")]
+		if (spec.criteria == []):
+			src += ["\t\t" + line for line in specSrc]
+		else:
+			if ("evaluation" in debug):
+				src += ["		if evaluate_criteria_verbosely(context,lineNumber,%s,%d):" % (lineSource,specNum)]
+			else:
+				src += ["		if %s:" % criteria_condition(spec.criteria)]
+			src += ["\t\t\t" + line for line in specSrc]
+			if (runStats != None):
+				src += ["		else:"]
+				src += ["			statsCounts[%d] += 1" % stats_counter(("rejected",spec))]
+
+	# with --stats, the records read are counted after the loop (a batch
+	# filter counts them itself), and pairing whatever mates remain is timed
+
+	if (runStats != None):
+		src += ["		if (sampled): runStats.mark(None)"]
+		if (batchFilter == None) and (headLimit != None):
+			src += ["	statsCounts[%d] += min(recordNumber,%d) - firstRecordNumber" \
+			      % (stats_counter("records read"),headLimit)]
+		elif (batchFilter == None):
+			src += ["	statsCounts[%d] += recordNumber - firstRecordNumber" % stats_counter("records read")]
+		if (mergeEm):
+			src += ["	runStats.begin(\"merge\")"]
+
+	src += finalSrc
+
+	for (spec,sfx) in mergingSpecs:
+		src += [""]
+		if (spec.discordant != None): src += generate_discordant_writer(spec,sfx)
+		else:                         src += generate_pair_writer(spec,sfx)
+
+	return "\n".join(src) + "\n"
+
+
+# partition_write_source--
+#	Returns the source for the function that writes a record or pair to its
+#	file, with --partition, given the source for the value of the partition
+#	key.  Read names are hashed, normally with crc32;  qname-md5 is the hash
+#	used for --subset (which is several times slower).  Other keys have too
+#	few distinct values to hash evenly, so each value is given the next file
+#	in turn when it is first seen (see PartitionFiles).
+
+partitionKeyToVariable = {"qname":"QNAME", "qname-md5":"QNAME", "rname":"RNAME",
+                          "readgroup":"READGROUP"}
+
+def partition_write_source(keySource):
+	if (partitionKey == "qname-md5"):
+		return "shardWrites[int(md5_new(%s).hexdigest()[:25],16) %% %d]" % (keySource,partitionN)
+	if (partitionKey == "qname"):
+		return "shardWrites[(crc32(%s) & 0xFFFFFFFF) %% %d]" % (keySource,partitionN)
+	return "(shardWriteOf.get(%s) or new_shard(%s))" % (keySource,keySource)
+
+
+# discard_source--
+#	Returns the source that discards a record (at the top level of the record
+#	loop) if condition is true.  With --stats, counter is the source for the
+#	slot (see RunStats) that counts the records discarded here (or None if
+#	they aren't counted), and any sampled timing is stopped.
+
+def discard_source(condition,counter):
+	if (runStats == None): return ["		if %s: continue" % condition]
+	src = ["		if %s:" % condition]
+	if (counter != None): src += ["			statsCounts[%s] += 1" % counter]
+	src += ["			if (sampled): runStats.mark(None)"]
+	src += ["			continue"]
+	return src
+
+
+# spec_suffix--
+#	Returns the suffix for the names (write_output, write_pair, etc.) that
+#	belong to the specNum'th output spec in the generated record processor;
+#	with a single output the names have no suffix.
+
+def spec_suffix(specNum):
+	if (len(outputSpecs) == 1): return ""
+	return str(specNum+1)
+
+
+# criteria_condition--
+#	Returns the source for a condition that is true if a record satisfies all
+#	of the criteria (see compile_criteria).
+
+def criteria_condition(criteria):
+	terms = []
+	for criterion in criteria:
+		if (criterion.kind == "requirement"): terms += [criterion.source]
+		else:                                 terms += ["(not %s)" % criterion.source]
+	if (len(terms) == 1): return terms[0]
+	return "(%s)" % " and ".join(terms)
+
+
+# reorder_criteria--
+#	Choose the order in which the record processor evaluates criteria.  We
+#	measure each criterion over a warm-up window of records (the rate at which
+#	it rejects and the cost of evaluating it), and each variable it needs (the
+#	cost of computing it), with a profiler generated for the purpose (see
+#	generate_criteria_profiler).  Every criterion is evaluated for every
+#	warm-up record, so the rates don't depend on the given order.
+#
+#	The order is chosen greedily;  next is whichever criterion has the lowest
+#	cost per rejection, where the cost includes computing the variables that
+#	no earlier criterion has needed.  For independent criteria this gives the
+#	lowest expected cost per record.  Criteria that reject nothing go last.
+#	The cost of the timing itself (measured by timing nothing) is deducted.
+#
+#	A criterion that might raise an exception (see cant_raise) stays after
+#	every criterion given before it, since one of those may be what protects
+#	it from the records it would fail on, even if no such record turns up
+#	during the warm-up.  And if any criterion fails on a warm-up record, we
+#	keep the given order.
+
+def reorder_criteria(criteria,records):
+	source = generate_criteria_profiler(criteria)
+	if ("codegen" in debug):
+		print >>stderr, "=== generated code (criteria profiler) ==="
+		for (lineNum,line) in enumerate(source.split("\n")):
+			print >>stderr, "%4d  %s" % (lineNum+1,line)
+
+	profiler = compile_sam_processor(source,[])
+	(numRecords,numFailed,rejects,criterionCost,variableCost,timingCost) = \
+	    profiler["profile_criteria"](records)
+
+	if (numRecords == 0): return criteria
+	if (numFailed > 0):
+		if ("evaluation" in debug):
+			print >>stderr, "=== criteria order ==="
+			print >>stderr, "  (as given, since criteria failed on %s of the first %s records)" \
+			              % (commatize(numFailed),commatize(numRecords+numFailed))
+		return criteria
+
+	# variables that are computed before any criterion is evaluated are free
+
+	computed = set(["RNAME"])
+	if (subsetN != None):          computed.add("QNAME")
+	if (regionsOfInterest != None): computed.update(["POS","CIGARINFO"])
+	if (batchFilter != None):
+		for criterion in batchFilter.criteria: computed.update(variable_closure(criterion.names))
+
+	criterionCost = [max(0.0,cost-timingCost) for cost in criterionCost]
+	for name in variableCost:
+		variableCost[name] = max(0.0,variableCost[name]-timingCost)
+
+	canMove = [cant_raise(criterion) for criterion in criteria]
+
+	order = []
+	remaining = range(len(criteria))
+	while (remaining != []):
+		bestCost = None
+		for ix in remaining:
+			if (not canMove[ix]) and (ix != remaining[0]): continue
+			variables = variable_closure(criteria[ix].names) - computed
+			cost = criterionCost[ix] + sum([variableCost.get(name,0.0) for name in variables])
+			if (rejects[ix] == 0): costPerReject = (1,cost)
+			else:                  costPerReject = (0,cost/rejects[ix])
+			if (bestCost == None) or (costPerReject < bestCost):
+				(bestIx,bestCost,bestVariables) = (ix,costPerReject,variables)
+		order += [(bestIx,criterionCost[bestIx] + sum([variableCost.get(name,0.0) for name in bestVariables]))]
+		computed.update(bestVariables)
+		remaining.remove(bestIx)
+
+	if ("evaluation" in debug):
+		print >>stderr, "=== criteria order (from the first %s records) ===" % commatize(numRecords)
+		for (ix,cost) in order:
+			print >>stderr, "  %s \"%s\" rejects %.1f%%, %.2fus per record" \
+			              % (criteria[ix].kind,criteria[ix].text,
+			                 100.0*rejects[ix]/numRecords,1e6*cost/numRecords)
+
+	return [criteria[ix] for (ix,_) in order]
+
+
+# cant_raise--
+#	Returns true if evaluating a criterion can't raise an exception, whatever
+#	the record.  That's so for comparisons, and "in" tests against a list, of
+#	plain fields and constants;  arithmetic, function calls, tags and computed
+#	variables can fail for some records.
+
+def cant_raise(criterion):
+	plainFields = set(samFieldToColumn.keys() + ["FLAGS","LINENUMBER"])
+	if (inputFormat == "bam"): plainFields -= set(["CIGAR","SEQ","QUAL"])
+	return node_cant_raise(criterion_to_ast(criterion.expression),plainFields)
+
+
+def node_cant_raise(node,plainFields):
+	nodeType = type(node)
+	if (nodeType == ast.Num) or (nodeType == ast.Str):
+		return True
+	if (nodeType == ast.Name):
+		return (node.id in plainFields) or (node.id == "None")
+	if (nodeType == ast.Tuple) or (nodeType == ast.List):
+		return ([item for item in node.elts if (not node_cant_raise(item,plainFields))] == [])
+	if (nodeType == ast.UnaryOp) and (type(node.op) == ast.Not):
+		return node_cant_raise(node.operand,plainFields)
+	if (nodeType == ast.BoolOp):
+		return ([val for val in node.values if (not node_cant_raise(val,plainFields))] == [])
+	if (nodeType == ast.Compare):
+		for (op,right) in zip(node.ops,node.comparators):
+			if (type(op) in [ast.In,ast.NotIn]) \
+			  and (type(right) != ast.Tuple) and (type(right) != ast.List):
+				return False
+		operands = [node.left] + node.comparators
+		return ([val for val in operands if (not node_cant_raise(val,plainFields))] == [])
+	return False
+
+
+# variable_closure--
+#	The set of variables that must be computed to evaluate a criterion that
+#	uses the named variables (this follows variable_source).
+
+def variable_closure(names):
+	closure = set()
+	pending = list(names)
+	while (pending != []):
+		name = pending.pop()
+		if (name in closure): continue
+		closure.add(name)
+		if (name in tagToVariable.values()):
+			pending += [tagToVariable[tag] for tag in tagsNeeded]
+		(dependencies,_) = variable_source(name)
+		pending += dependencies
+	return closure
+
+
+# generate_criteria_profiler--
+#	Generate profile_criteria(records), which evaluates every one of the given
+#	criteria for each record, timing each criterion and each variable (apart
+#	from the variables it depends on);  returns (numRecords,numFailed,rejects,
+#	criterionCost,variableCost,timingCost), costs in seconds, where timingCost
+#	is what it costs to time nothing.  Records rejected by the
+#	flag prefilter or the batch filter are skipped, as are records for which
+#	a criterion fails (these are counted in numFailed).
+
+def generate_criteria_profiler(criteria):
+	src = []
+	src += ["def profile_criteria(records):"]
+	src += ["	(numRecords,numFailed) = (0,0)"]
+	src += ["	rejects       = [0]   * %d" % len(criteria)]
+	src += ["	criterionCost = [0.0] * %d" % len(criteria)]
+	src += ["	variableCost  = {}"]
+	src += ["	timingCost    = 0.0"]
+	if (inputFormat == "bam"):
+		src += ["	for rec in records:"]
+		src += ["		(%s) = unpack_bam_core(rec)" % ",".join(bamCoreNames)]
+		if (flagRejects != None):
+			src += ["		if (FLAG in flagRejects): continue"]
+	else:
+		src += ["	for line in records:"]
+		src += ["		if (line.startswith(\"@\")): continue"]
+		if (splitLimit < 0):
+			src += ["		fields = line.split()"]
+			minFields = SAM_MIN_COLUMNS
+		else:
+			src += ["		fields = line.split(None,%d)" % splitLimit]
+			minFields = min(splitLimit+1,SAM_MIN_COLUMNS)
+		src += ["		if (len(fields) < %d): continue" % minFields]
+		if (flagRejects != None):
+			src += ["		if (fields[1] in flagRejects): continue"]
+	src += ["		try:"]
+
+	emitted = set(bamCoreNames) if (inputFormat == "bam") else set()
+	def emit_variable(name,timed):
+		if (name in emitted): return
+		(dependencies,lines) = variable_source(name)
+		for dependency in dependencies: emit_variable(dependency,timed)
+		if (timed): src.append("\t\t\tclockStart = wall_clock()")
+		for line in lines: src.append("\t\t\t" + line)
+		if (timed): src.append("\t\t\tvariableCost[\"%s\"] = variableCost.get(\"%s\",0.0) + wall_clock() - clockStart" % (name,name))
+		emitted.add(name)
+		if (name in tagToVariable.values()):
+			for tag in tagsNeeded: emitted.add(tagToVariable[tag])
+
+	emit_variable("RNAME",False)
+	if (batchFilter != None):
+		for criterion in batchFilter.criteria:
+			for name in criterion.names: emit_variable(name,False)
+			src += ["			if (not %s): continue" % criteria_condition([criterion])]
+
+	src += ["			clockStart = wall_clock()"]
+	src += ["			timingCost += wall_clock() - clockStart"]
+	src += ["			passed = []"]
+	for (ix,criterion) in enumerate(criteria):
+		for name in criterion.names: emit_variable(name,True)
+		src += ["			clockStart = wall_clock()"]
+		src += ["			passed += [%s]" % criteria_condition([criterion])]
+		src += ["			criterionCost[%d] += wall_clock() - clockStart" % ix]
+
+	src += ["		except Exception:"]
+	src += ["			numFailed += 1"]
+	src += ["			continue"]
+	src += ["		numRecords += 1"]
+	src += ["		for (ix,val) in enumerate(passed):"]
+	src += ["			if (not val): rejects[ix] += 1"]
+	src += ["	return (numRecords,numFailed,rejects,criterionCost,variableCost,timingCost)"]
+	return "\n".join(src) + "\n"
+
+
+# coord_sorted_pairing_source--
+#	Generate the part of the record processor that pairs mates in coordinate-
+#	sorted input (see --coordsorted);  returns (loopSrc,endSrc), the source for
+#	inside the record loop (indented relative to the loop) and for after it.
+#
+#	A mate whose pair is on the same chromosome waits in nearMates until the
+#	other mate arrives, and the pair is written then.  matePositions is a heap
+#	of (position,qName), the position at which each waiting mate expects its
+#	pair (from PNEXT);  once the scan passes that position the pair can't be
+#	completed, and the group is written (which discards it, as a singleton).
+#	At each new chromosome whatever is still waiting is written.
+#
+#	A mate whose pair is on another chromosome waits in qNameToMates until the
+#	end, as for unsorted input.  With --mergemates (but not --requiremates) we
+#	only bother for a mate without an interval, since an unmapped pair can be
+#	placed on two chromosomes and is still written;  a group that spans
+#	chromosomes is otherwise always discarded.
+
+def coord_sorted_pairing_source(spec,sfx=""):
+	remoteSrc = []
+	remoteSrc += ["if (QNAME in qNameToMates%s): qNameToMates%s[QNAME].append(mate)" % (sfx,sfx)]
+	remoteSrc += ["else:                       qNameToMates%s[QNAME] = [mate]" % sfx]
+	if (splitByChrom):
+		remoteSrc += ["remoteQNames.add(QNAME)"]
+
+	src = []
+	src += ["if (RNEXT != \"=\") and (RNEXT != RNAME):"]
+	if (spec.mergeButSeparate):
+		src += ["\t" + line for line in remoteSrc]
+	else:
+		src += ["	if (rName == \"*\"):"]
+		src += ["\t\t" + line for line in remoteSrc]
+		if (runStats != None):
+			src += ["	else:"]
+			src += ["		statsCounts[%d] += 1" % stats_counter(("multi-chromosome",spec))]
+	src += ["else:"]
+	src += ["	if (RNAME != scanChrom%s):" % sfx]
+	src += ["		for qName in nearMates%s: write_pair%s(qName,nearMates%s[qName])" % (sfx,sfx,sfx)]
+	src += ["		nearMates%s = {}" % sfx]
+	src += ["		matePositions%s = []" % sfx]
+	src += ["		scanChrom%s = RNAME" % sfx]
+	src += ["	elif (POS < scanPos%s):" % sfx]
+	src += ["		not_coordinate_sorted(lineNumber)"]
+	src += ["	scanPos%s = POS" % sfx]
+	src += ["	while (matePositions%s != []) and (matePositions%s[0][0] < POS):" % (sfx,sfx)]
+	src += ["		qName = heappop(matePositions%s)[1]" % sfx]
+	src += ["		if (qName in nearMates%s): write_pair%s(qName,nearMates%s.pop(qName))" % (sfx,sfx,sfx)]
+	src += ["	if (QNAME in nearMates%s):" % sfx]
+	src += ["		mates = nearMates%s.pop(QNAME)" % sfx]
+	src += ["		mates.append(mate)"]
+	src += ["		write_pair%s(QNAME,mates)" % sfx]
+	src += ["	elif (PNEXT-1 >= POS):"]
+	src += ["		nearMates%s[QNAME] = [mate]" % sfx]
+	src += ["		heappush(matePositions%s,(PNEXT-1,QNAME))" % sfx]
+	if (runStats != None):	# (its mate has been passed, so it's a singleton)
+		src += ["	else:"]
+		src += ["		statsCounts[%d] += 1" % stats_counter(("singleton",spec))]
+
+	endSrc = []
+	endSrc += ["	for qName in nearMates%s: write_pair%s(qName,nearMates%s[qName])" % (sfx,sfx,sfx)]
+	endSrc += ["	if (pending != None): return"]
+	endSrc += ["	for qName in qNameToMates%s:" % sfx]
+	endSrc += ["		write_pair%s(qName,qNameToMates%s[qName])" % (sfx,sfx)]
+	return (src,endSrc)
+
+
+# generate_pair_writer--
+#	Generate write_pair(qName,mates), which is the specialized equivalent of
+#	merging the intervals for all the records with the same name.  We discard
+#	any singletons, multi-chromosomal (unless mates are to be reported
+#	separately), those outside the expected insert length, those the pair
+#	criteria reject, or (with --rmdup) duplicates (see PairDuplicates).  With
+#	--stats, the mates are counted as merged or by why they were discarded.
+#
+#	The pair variables are taken from the mates' intervals, which start at
+#	POS;  POS1 is for the leftmost mate and POS2 for the last.  A pair with an
+#	unmapped mate has no positions, so if there are pair criteria it is
+#	discarded.
+
+def generate_pair_writer(spec,sfx=""):
+	def discard(indent,condition,reason):
+		if (runStats == None): return [indent + "if %s: return" % condition]
+		return [indent + "if %s:" % condition,
+		        indent + "	statsCounts[%d] += numMates" % stats_counter((reason,spec)),
+		        indent + "	return"]
+
+	src = []
+	src += ["def write_pair%s(qName,mates):" % sfx]
+	if (writtenProgress != None):
+		src += ["	global numberWritten"]
+	if (runStats != None):
+		src += ["	numMates = len(mates)"]
+	src += discard("\t","(len(mates) < 2)","singleton")
+	if (partitionKey == None):
+		src += ["	write = write_output%s" % sfx]
+	if (not spec.mergeButSeparate):
+		src += ["	rName = mates[0][0]"]
+		src += ["	for mate in mates:"]
+		src += discard("\t\t","(mate[0] != rName)","multi-chromosome")
+	if (spec.rmdup):	# (the strand breaks ties, so duplicates sort alike)
+		src += ["	mates.sort()"]
+	else:
+		src += ["	mates.sort(key=interval_key)"]
+	src += ["	(rName1,start1,end1,text1) = mates[0]"]
+	src += ["	end = max([mate[2] for mate in mates])"]
+	if (spec.mergeButSeparate):
+		if (spec.pairCriteria != []):
+			src += ["	(lastRName,lastStart) = mates[-1][:2]"]
+		src += ["	mates = [(e,s,r,t) for (r,s,e,t) in mates[1:]]"]
+		src += ["	mates.sort(key=interval_key)"]
+		src += ["	(end2,start2,rName2,text2) = mates[-1]"]
+	if (spec.mergeDistanceMin != None):
+		src += discard("\t","(end-start1 < %d)" % spec.mergeDistanceMin,"shorter than min")
+	if (spec.mergeDistanceMax != None):
+		src += discard("\t","(end-start1 > %d)" % spec.mergeDistanceMax,"longer than max")
+	if (spec.binaryIntervals) and (not spec.mergeButSeparate):
+		src += discard("\t","(rName == \"*\")","unmapped")
+	if (spec.pairCriteria != []):
+		pairNames = set(sum([criterion.names for criterion in spec.pairCriteria],[]))
+		offset = " - 1" if (origin == "one") else ""
+		if (spec.mergeButSeparate):
+			src += discard("\t","(rName1 == \"*\") or (lastRName == \"*\")","unmapped")
+		elif (not spec.binaryIntervals):
+			src += discard("\t","(rName == \"*\")","unmapped")
+		if ("POS1" in pairNames):
+			src += ["	POS1 = start1%s" % offset]
+		if ("POS2" in pairNames) and (spec.mergeButSeparate):
+			src += ["	POS2 = lastStart%s" % offset]
+		elif ("POS2" in pairNames):
+			src += ["	POS2 = mates[-1][1]%s" % offset]
+		src += discard("\t","(not %s)" % criteria_condition(spec.pairCriteria),"pair criteria")
+	if (spec.rmdup):
+		dupKey = "(rName,start1,end,text1+mates[-1][3])"
+		if (isCoordSorted): isDuplicate = "duplicates%s.seen_near(%s,mates[-1][1])" % (sfx,dupKey)
+		else:               isDuplicate = "duplicates%s.seen(%s)" % (sfx,dupKey)
+		src += discard("\t","(rName != \"*\") and %s" % isDuplicate,"duplicate")
+	if (runStats != None):
+		src += ["	statsCounts[%d] += numMates" % stats_counter(("merged",spec))]
+		src += ["	statsCounts[%d] += %d" % (stats_counter(("written",spec)),2 if (spec.mergeButSeparate) else 1)]
+	if (partitionKey != None):
+		if   (partitionVariable == "QNAME"): keySource = "qName"
+		elif (spec.mergeButSeparate):        keySource = "rName1"
+		else:                                keySource = "rName"
+		src += ["	write = %s" % partition_write_source(keySource)]
+
+	if (spec.depthChroms != None) and (spec.mergeButSeparate):
+		src += ["	depth%s.add(rName1,start1,end1)" % sfx]
+		if (writtenProgress != None): src += written_progress_source("\t")
+		src += ["	depth%s.add(rName2,start2,end2)" % sfx]
+		if (writtenProgress != None): src += written_progress_source("\t")
+	elif (spec.depthChroms != None):
+		src += ["	depth%s.add(rName,start1,end)" % sfx]
+		if (writtenProgress != None): src += written_progress_source("\t")
+	elif (spec.meanChroms != None):
+		src += ["	mean%s.add(rName,start1,end,%s)" % (sfx,mean_value_source(spec,"start1","end"))]
+		if (writtenProgress != None): src += written_progress_source("\t")
+	elif (spec.binaryIntervals) and (spec.mergeButSeparate):
+		src += ["	if (rName1 != \"*\"): intervals%s.write(rName1,start1,end1)" % sfx]
+		if (writtenProgress != None): src += written_progress_source("\t")
+		src += ["	if (rName2 != \"*\"): intervals%s.write(rName2,start2,end2)" % sfx]
+		if (writtenProgress != None): src += written_progress_source("\t")
+	elif (spec.binaryIntervals):
+		src += ["	intervals%s.write(rName,start1,end)" % sfx]
+		if (writtenProgress != None): src += written_progress_source("\t")
+	elif (spec.mergeButSeparate):
+		src += ["	write(text1)"]
+		if (writtenProgress != None): src += written_progress_source("\t")
+		src += ["	write(text2)"]
+		if (writtenProgress != None): src += written_progress_source("\t")
+	else:
+		lineFormat = []
+		lineArgs   = []
+		if ("interval" in spec.outputWhat):
+			lineFormat += ["%s\\t%s\\t%s"]
+			lineArgs   += ["rName","start1","end"]
+		if ("name" in spec.outputWhat):
+			if ("cigar" not in debug):
+				lineFormat += ["%s"]
+			else:
+				lineFormat += ["%s\\t-1\\t(none)"]
+			lineArgs   += ["qName"]
+		if ("sam record" in spec.outputWhat):
+			lineFormat += ["(sam)"]
+		src += ["	write(\"%s\\n\" %% (%s,))" % ("\\t".join(lineFormat),",".join(lineArgs))]
+		if (writtenProgress != None): src += written_progress_source("\t")
+
+	return src
+
+
+# generate_discordant_writer--
+#	Generate write_pair(qName,mates) for --discordant, which keeps only the
+#	discordant pairs, and writes their mates separately (as for
+#	--requiremates).  A pair is concordant if its mates are on the same
+#	chromosome, in the expected orientation, and (if a range is given) its
+#	insert length is within that range;  any other pair with both mates mapped
+#	is discordant.  Each mate's text begins with its strand ("F" or "R").
+#
+#	With --rmdup a pair is a duplicate if an earlier pair had the same mate
+#	intervals and strands.  Discordant pairs are few, and those spanning
+#	chromosomes aren't completed in position order, so every key is kept even
+#	for coordinate-sorted input.
+
+def generate_discordant_writer(spec,sfx=""):
+	def discard(indent,condition,reason):
+		if (runStats == None): return [indent + "if %s: return" % condition]
+		return [indent + "if %s:" % condition,
+		        indent + "	statsCounts[%d] += numMates" % stats_counter((reason,spec)),
+		        indent + "	return"]
+
+	if (spec.discordant == "T2T"): concordantStrands = "RF"
+	else:                          concordantStrands = "FR"
+
+	src = []
+	src += ["def write_pair%s(qName,mates):" % sfx]
+	if (writtenProgress != None):
+		src += ["	global numberWritten"]
+	if (runStats != None):
+		src += ["	numMates = len(mates)"]
+	src += discard("\t","(len(mates) < 2)","singleton")
+	if (partitionKey == None):
+		src += ["	write = write_output%s" % sfx]
+	src += ["	mates.sort()"]
+	src += ["	(rName1,start1,end1,text1) = mates[0]"]
+	src += ["	(rName2,start2,end2,text2) = mates[-1]"]
+	src += discard("\t","(rName1 == \"*\") or (rName2 == \"*\")","unmapped")
+	concordant = ["(rName1 == rName2)","(text1[0] + text2[0] == \"%s\")" % concordantStrands]
+	if (spec.mergeDistanceMin != None):
+		concordant += ["(max(end1,end2)-start1 >= %d)" % spec.mergeDistanceMin]
+	if (spec.mergeDistanceMax != None):
+		concordant += ["(max(end1,end2)-start1 <= %d)" % spec.mergeDistanceMax]
+	src += discard("\t"," and ".join(concordant),"concordant")
+	if (spec.pairCriteria != []):
+		pairNames = set(sum([criterion.names for criterion in spec.pairCriteria],[]))
+		offset = " - 1" if (origin == "one") else ""
+		if ("POS1" in pairNames): src += ["	POS1 = start1%s" % offset]
+		if ("POS2" in pairNames): src += ["	POS2 = start2%s" % offset]
+		src += discard("\t","(not %s)" % criteria_condition(spec.pairCriteria),"pair criteria")
+	if (spec.rmdup):
+		dupKey = "(rName1,start1,end1,rName2,start2,end2,text1[0]+text2[0])"
+		src += discard("\t","duplicates%s.seen(%s)" % (sfx,dupKey),"duplicate")
+	if (runStats != None):
+		src += ["	statsCounts[%d] += numMates" % stats_counter(("merged",spec))]
+		src += ["	statsCounts[%d] += 2" % stats_counter(("written",spec))]
+	if (partitionKey != None):
+		if (partitionVariable == "QNAME"): keySource = "qName"
+		else:                              keySource = "rName1"
+		src += ["	write = %s" % partition_write_source(keySource)]
+
+	for mateNum in [1,2]:
+		if (spec.depthChroms != None):
+			src += ["	depth%s.add(rName%d,start%d,end%d)" % (sfx,mateNum,mateNum,mateNum)]
+		elif (spec.binaryIntervals):
+			src += ["	intervals%s.write(rName%d,start%d,end%d)" % (sfx,mateNum,mateNum,mateNum)]
+		else:
+			src += ["	write(text%d[1:])" % mateNum]
+		if (writtenProgress != None): src += written_progress_source("\t")
+
+	return src
+
+
+# variable_source--
+#	Returns the python source to compute a variable in the generated record
+#	processor, as (dependencies,lines);  the dependencies are variables that
+#	must be computed first.
+
+bamCoreNames = ["refID","POS","nameLen","MAPQ","_","numCigarOps","FLAG",
+                "seqLen","nextRefID","nextPos","TLEN"]
+
+def variable_source(name):
+	if (inputFormat == "bam"):
+		bamSource = bam_variable_source(name)
+		if (bamSource != None): return bamSource
+
+	if (name == "LINENUMBER"):
+		return ([],["LINENUMBER = lineNumber"])
+
+	if (name == "FLAGS"):
+		return (["FLAG"],["FLAGS = FLAG"])
+
+	if (name == "CIGARINFO"):
+		lines = []
+		if ("cigarcache" in debug): lines += ["cigarCache.lookups += 1"]
+		lines += ["CIGARINFO = cigarRecent.get(CIGAR) or cigar_lookup(CIGAR)"]
+		return (["CIGAR"],lines)
+
+	if (name == "POS"):
+		col = samFieldToColumn[name]
+		return ([],["try:               POS = int(fields[%d]) - 1" % col,
+		            "except ValueError: POS = fields[%d]" % col])
+
+	if (name in samIntFields):
+		col = samFieldToColumn[name]
+		return ([],["try:               %s = int(fields[%d])" % (name,col),
+		            "except ValueError: %s = fields[%d]" % (name,col)])
+
+	if (name in samFieldToColumn):
+		return ([],["%s = fields[%d]" % (name,samFieldToColumn[name])])
+
+	if (name in tagToVariable.values()):
+		variables = [tagToVariable[tag] for tag in tagsNeeded]
+		lines =  ["%s = None" % " = ".join(variables)]
+		lines += ["for field in fields[%d:]:" % SAM_MIN_COLUMNS]
+		lines += ["	tag = field[:2]"]
+		for (ix,tag) in enumerate(tagsNeeded):
+			if (ix == 0): lines += ["	if   (tag == \"%s\"): %s = tag_value(field)" % (tag,tagToVariable[tag])]
+			else:         lines += ["	elif (tag == \"%s\"): %s = tag_value(field)" % (tag,tagToVariable[tag])]
+		return ([],lines)
+
+	if (name in computedVariables):
+		(func,dependencies) = computedVariables[name]
+		return (dependencies,["%s = %s(%s)" % (name,func.__name__,",".join(dependencies))])
 
+	assert (False), "internal error: no source for variable \"%s\"" % name
 
-numberWritten = 0
 
-def write_interval(rName,start,end,qName,
-                   context=None,samRecord=None,rPos=None,cigar=None):
-	global numberWritten
+# bam_variable_source--
+#	Same as variable_source, for variables that are decoded differently from a
+#	BAM record;  returns None for variables that aren't.  The record's fixed-
+#	length fields (bamCoreNames) have already been unpacked, and the remaining
+#	fields are found from the offsets described in bam_reader.
 
-	line = []
+def bam_variable_source(name):
+	if (name == "RNAME"):
+		return ([],["RNAME = refNames[refID]"])	# (refNames[-1] is "*")
+
+	if (name == "QNAME"):
+		return ([],["QNAME = rec[32:31+nameLen]"])
+
+	if (name == "cigarStart"):
+		return ([],["cigarStart = 32 + nameLen"])
+	if (name == "seqStart"):
+		return (["cigarStart"],["seqStart = cigarStart + 4*numCigarOps"])
+	if (name == "qualStart"):
+		return (["seqStart"],["qualStart = seqStart + (seqLen+1)/2"])
+	if (name == "tagsStart"):
+		return (["qualStart"],["tagsStart = qualStart + seqLen"])
+
+	if (name == "CIGARINFO"):
+		lines = []
+		if ("cigarcache" in debug): lines += ["cigarCache.lookups += 1"]
+		lines += ["packedCigar = rec[cigarStart:seqStart]"]
+		lines += ["CIGARINFO = cigarRecent.get(packedCigar) or cigar_lookup_packed(packedCigar)"]
+		return (["seqStart"],lines)
+
+	if (name == "CIGAR"):
+		return (["CIGARINFO"],["CIGAR = CIGARINFO.cigar if (CIGARINFO != None) else \"*\""])
+
+	if (name == "RNEXT"):
+		return ([],["RNEXT = \"=\" if (nextRefID == refID) and (refID >= 0) else refNames[nextRefID]"])
+
+	if (name == "PNEXT"):
+		return ([],["PNEXT = nextPos + 1"])
+
+	if (name == "SEQ"):
+		return (["seqStart"],["SEQ = seq_to_string(rec,seqStart,seqLen)"])
+
+	if (name == "QUAL"):
+		return (["qualStart"],["QUAL = qual_to_string(rec,qualStart,seqLen)"])
+
+	if (name == "RLEN"):	# (avoids decoding SEQ;  SAM's "*" has length 1)
+		return ([],["RLEN = seqLen or 1"])
+
+	if (name in tagToVariable.values()):
+		variables = [tagToVariable[tag] for tag in tagsNeeded]
+		tags      = ["\"%s\"" % tag for tag in tagsNeeded]
+		return (["tagsStart"],["(%s,) = tag_values(rec,tagsStart,(%s,))" \
+		                       % (",".join(variables),",".join(tags))])
+
+	return None
+
+
+# output_line_format--
+#	Returns the format string and argument list (as source) for a record's
+#	output line for an output spec, in the generated record processor.
+
+def output_line_format(spec):
+	if (spec.depthChroms != None): return ("",[])
+	if (spec.breakpointChroms != None): return ("",["CLIPBRK"])
+	if (spec.binaryIntervals):     return ("",[])
+	if (spec.meanChroms  != None):
+		if (spec.meanValue == "LENGTH"): return ("",[])
+		else:                            return ("",[spec.meanValue])
+	outputWhat = spec.outputWhat
+	reportVariables = [variable for variable in outputWhat
+	                            if (variable not in ["interval","name","sam record"])]
+
+	lineFormat = []
+	lineArgs   = []
 
 	if ("interval" in outputWhat):
-		line += ["%s\t%s\t%s" % (rName,start,end)]
+		lineFormat += ["%s\\t%s\\t%s"]
+		lineArgs   += ["rName","start","end"]
 
 	if ("name" in outputWhat):
 		if ("cigar" not in debug):
-			line += [qName]
-		else:
-	 		if (rPos  == None): rPos  = -1
-	 		if (cigar == None): cigar = "(none)"
-			line += ["%s\t%d\t%s" % (qName,rPos,cigar)]
-
-	for variable in outputWhat:
-		if (variable in ["interval","name","sam record"]): continue
-		if (context == None) or (variable not in context):
-			line += ["(%s)" % variable]
-		elif (variable == "FLAGS"):
-			line += ["0x%03X" % context[variable]]
+			lineFormat += ["%s"]
+			lineArgs   += ["QNAME"]
+		elif (spec.mergeButSeparate):
+			lineFormat += ["%s\\t-1\\t(none)"]
+			lineArgs   += ["QNAME"]
 		else:
-			line += [str(context[variable])]
+			lineFormat += ["%s\\t%s\\t%s"]
+			lineArgs   += ["QNAME","POS","CIGAR"]
+
+	for variable in reportVariables:
+		if (variable == "FLAGS"): lineFormat += ["0x%03X"]
+		else:                     lineFormat += ["%s"]
+		lineArgs += [variable]
+
+	if ("sam record" in outputWhat) and (inputFormat == "bam"):
+		lineFormat += ["%s"]
+		lineArgs   += ["record_to_sam(rec,refNames)"]
+	elif ("sam record" in outputWhat):
+		lineFormat += ["%s"]
+		lineArgs   += ["line.strip()"]
+
+	return ("\\t".join(lineFormat),lineArgs)
+
+
+# mean_value_source--
+#	Returns the source for the value an interval contributes to --mean.
+
+def mean_value_source(spec,startName,endName):
+	if (spec.meanValue != "LENGTH"): return spec.meanValue
+	if (origin == "one"): return "%s-%s+1" % (endName,startName)
+	return "%s-%s" % (endName,startName)
+
+
+def written_progress_source(indent):
+	if (numJobs > 1): # (progress is reported by the main process)
+		return [indent + "numberWritten += 1"]
+	return [indent + "numberWritten += 1",
+	        indent + "if (numberWritten %% %d == 0): report_written(numberWritten)" % writtenProgress]
+
+
+# compile_sam_processor--
+#	Exec the generated source, returning the namespace that contains the
+#	generated functions;  each output spec's output will be written with the
+#	corresponding function in writes.  The source is registered with linecache
+#	so that tracebacks through the generated code are readable.
+
+def compile_sam_processor(source,writes):
+	filename = "<sam processor>"
+	linecache.cache[filename] = (len(source),None,source.splitlines(True),filename)
+
+	namespace = dict(globals())
+	namespace.update(safeDict)
+	for (specNum,write) in enumerate(writes):
+		namespace["write_output%s" % spec_suffix(specNum)] = write
+	for (specNum,spec) in enumerate(outputSpecs):
+		if (spec.depthChroms != None):
+			namespace["depth%s" % spec_suffix(specNum)] = spec.depth
+		if (spec.meanChroms != None):
+			namespace["mean%s" % spec_suffix(specNum)] = spec.mean
+		if (spec.breakpointChroms != None):
+			namespace["breakpoints%s" % spec_suffix(specNum)] = spec.breakpoints
+		if (spec.binaryIntervals):
+			namespace["intervals%s" % spec_suffix(specNum)] = spec.binaryWriter
+		if (spec.rmdup):
+			namespace["duplicates%s" % spec_suffix(specNum)] = PairDuplicates()
+	namespace["interval_key"]  = itemgetter(0,1,2)
+	namespace["batchFilter"]   = batchFilter
+	if (flagRejects != None):
+		if (inputFormat == "bam"): flagKey = lambda flag:flag
+		else:                      flagKey = str	# (SAM records are checked before FLAG is parsed)
+		if (runStats == None):
+			namespace["flagRejects"] = frozenset([flagKey(flag) for flag in flagRejects])
+		else:	# (with --stats, each maps to the counter for its criterion)
+			namespace["flagRejects"] = dict([(flagKey(flag),stats_counter(flagRejects[flag]))
+			                                  for flag in flagRejects])
+	if (runStats != None):
+		namespace["statsCounts"] = runStats.counts
+	namespace["numberWritten"] = 0
+	namespace["cigarRecent"]   = cigarCache.recent
+	namespace["cigar_lookup"]  = cigarCache.lookup
+	if (inputFormat == "bam"):
+		namespace["cigar_lookup_packed"] = cigarCache.lookup_packed
+		namespace["refNames"]            = bamHeader.refNames + ["*"]
+	if (chromsOfInterest != None):
+		namespace["chromsOfInterest"] = frozenset(chromsOfInterest)
+	if (regionsOfInterest != None):
+		regionsByChrom = {}
+		for (chrom,start,end) in regionsOfInterest:
+			if (chrom not in regionsByChrom): regionsByChrom[chrom] =  [(start,end)]
+			else:                             regionsByChrom[chrom] += [(start,end)]
+		namespace["regionsByChrom"] = regionsByChrom
+
+	exec compile(source,filename,"exec") in namespace
+	return namespace
+
+
+# process_sam_in_parallel--
+#	Distribute jobs to a pool of worker processes, each running the generated
+#	record processor, and write their output in job order.  A job is either a
+#	batch of SAM lines (see process_sam_batch) or a reference sequence of an
+#	indexed BAM file (see process_sam_chromosome).
+#
+#	The pool is forked after the record processor is compiled, so the workers
+#	inherit it.  A batch is only cut where the read name changes, so that a
+#	name-sorted batch contains every record of its pairs.  For unsorted input
+#	with --mergemates, the workers return the mates they couldn't pair (some of
+#	which may have been spilled to disk, see --memory) and those pairs are
+#	written here, once all jobs are in.
+#
+#	Each worker returns
+#	(text,textFilename,numberWritten,mates,mateSpill,cacheCounts,statsDelta);
+#	the output is either text or, for a long job, the name of a temporary file
+#	that holds it.  statsDelta is what the job added to the worker's RunStats
+#	(see --stats).
+
+def process_sam_in_parallel(jobs,worker,samProcessor,numJobs):
+	global workerProcessor
+	workerProcessor = samProcessor
+
+	if (mergeEm) and (not isNameSorted): qNameToMates = {}
+	else:                                qNameToMates = None
+	(pendingBytes,spill,spills) = (0,None,[])
+
+	pool = Pool(numJobs)
+	try:
+		numberWritten = 0
+		cacheCounts = [0] * 5
+
+		for (text,textFilename,jobWritten,mates,mateSpill,jobCacheCounts,statsDelta) \
+		       in pool.imap(worker,jobs):
+			if (textFilename == None):
+				samProcessor["write_output"](text)
+			else:
+				textF = file(textFilename,"rb")
+				copyfileobj(textF,outputFiles[0])
+				textF.close()
+				remove(textFilename)
+			if (writtenProgress != None):
+				report_written_through(numberWritten,numberWritten+jobWritten)
+				numberWritten += jobWritten
+			if (mates != None):
+				for qName in mates:
+					if (qName in qNameToMates): qNameToMates[qName] += mates[qName]
+					else:                       qNameToMates[qName] =  mates[qName]
+				if (memoryLimit != None):
+					pendingBytes += sum([mates_bytes(qName,mates[qName]) for qName in mates])
+					if (pendingBytes > memoryLimit):
+						spill = spill_mates(qNameToMates,spill)
+						pendingBytes = 0
+			if (mateSpill != None):
+				spills += [mateSpill]
+			if (jobCacheCounts != None):
+				cacheCounts = map(sum,zip(cacheCounts,jobCacheCounts))
+			if (statsDelta != None):
+				runStats.add(statsDelta)
+
+		pool.close()
+	except:
+		pool.terminate()
+		for mateSpill in spills + [spill]:
+			if (mateSpill != None): mateSpill.remove()
+		raise
+	pool.join()
+
+	if (runStats != None): runStats.begin("merge")
+
+	if (qNameToMates != None):
+		samProcessor["numberWritten"] = numberWritten
+		for (qName,mates) in mate_groups(qNameToMates,spills+[spill]):
+			samProcessor["write_pair"](qName,mates)
+			if (writtenProgress != None):
+				report_written_through(numberWritten,samProcessor["numberWritten"])
+				numberWritten = samProcessor["numberWritten"]
+
+	if ("cigarcache" in debug):
+		(cigarCache.lookups,cigarCache.misses,cigarCache.promotions,
+		 cigarCache.parses,cigarCache.turnovers) = cacheCounts
+
+
+# sam_batches--
+#	Yield (lineNumber,recordNumber,lines) for batches of the SAM input, where
+#	lineNumber and recordNumber are the counts preceding the batch.  We stop
+#	once the --head limit is exceeded (the batch with the first record over the
+#	limit is still processed, so that the limit is reported).
+
+def sam_batches(f,batchSize):
+	if (inputFormat == "bam"): name_of = record_name
+	else:                      name_of = lambda line:line.split(None,1)[0]
+
+	(lineNumber,recordNumber) = (0,0)
+	batch = []
+	prevQName = None
+	for line in f:
+		if (prevQName != None):
+			qName = name_of(line)
+			if (qName != prevQName):
+				(numLines,numRecords) = batch_counts(batch)
+				yield (lineNumber,recordNumber,batch)
+				(lineNumber,recordNumber) = (lineNumber+numLines,recordNumber+numRecords)
+				if (headLimit != None) and (recordNumber > headLimit): return
+				batch = []
+				prevQName = None
+
+		batch.append(line)
+		if (prevQName == None) and (len(batch) >= batchSize):
+			prevQName = name_of(line)
+
+	if (batch != []):
+		yield (lineNumber,recordNumber,batch)
+
+
+def batch_counts(batch):
+	numHeaders = 0
+	if (inputFormat == "sam") and (batch[0].startswith("@")):
+		numHeaders = len([line for line in batch if (line.startswith("@"))])
+	return (len(batch),len(batch)-numHeaders)
+
+
+# process_sam_batch--
+#	Run the record processor on one batch, in a worker process;  returns
+#	(text,None,numberWritten,mates,mateSpill,cacheCounts,statsDelta).
+
+def process_sam_batch((lineNumber,recordNumber,lines)):
+	output = []
+	workerProcessor["write_output"]  = output.append
+	workerProcessor["numberWritten"] = 0
+
+	if (mergeEm) and (not isNameSorted): mates = {}
+	else:                                mates = None
+
+	cacheCounts = None
+	if ("cigarcache" in debug):
+		cacheBefore = cigar_cache_counts()
+	statsDelta = None
+	if (runStats != None):
+		statsBefore = runStats.snapshot()
+
+	spillsBefore = len(mateSpills)
+	try:
+		spill = workerProcessor["process_sam"](lines,lineNumber,recordNumber,mates)
+	except:
+		remove_mate_spills(spillsBefore)
+		raise
+	if (spill != None): spill.close()
+
+	if ("cigarcache" in debug):
+		cacheCounts = [after-before for (before,after)
+		                            in zip(cacheBefore,cigar_cache_counts())]
+	if (runStats != None):
+		runStats.end()
+		statsDelta = [after-before for (before,after)
+		                           in zip(statsBefore,runStats.snapshot())]
+
+	return ("".join(output),None,workerProcessor["numberWritten"],mates,spill,cacheCounts,statsDelta)
+
+
+# process_sam_chromosome--
+#	Run the record processor on the chunks of an indexed BAM file for one
+#	reference sequence, in a worker process;  returns
+#	(None,textFilename,numberWritten,mates,mateSpill,cacheCounts,statsDelta).
+#
+#	Each worker opens the file for itself, and writes its output to a temporary
+#	file in runTempDir (so that if the run fails, it's removed along with that
+#	directory), since a whole chromosome's output can be large.  Line numbers
+#	in any error messages are counted from the start of the chromosome.
+#
+#	With --mergemates, pairs with both mates on this chromosome are written
+#	here.  A group of mates is returned to be paired in the main process if
+#	any of its records has its mate on another reference sequence (per its
+#	RNEXT), since some of the group's records are then in another job.
+
+def process_sam_chromosome((chrom,chunks)):
+	f = file(inputFilename,"rb")
+	bgzf = new_bgzf_reader(f)
+	(fd,textFilename) = mkstemp(prefix="filtered_sam_to_intervals.",suffix=".tmp",
+	                            dir=runTempDir)
+	textF = fdopen(fd,"wb")
+
+	workerProcessor["write_output"]  = textF.write
+	workerProcessor["numberWritten"] = 0
+	workerProcessor["remoteQNames"]  = remoteQNames = set()
+
+	if (mergeEm): mates = {}
+	else:         mates = None
+
+	cacheCounts = None
+	if ("cigarcache" in debug):
+		cacheBefore = cigar_cache_counts()
+	statsDelta = None
+	if (runStats != None):
+		statsBefore = runStats.snapshot()
+
+	spillsBefore = len(mateSpills)
+	try:
+		samInput = chain.from_iterable(bgzf.chunk_records(chunks))
+		spill = workerProcessor["process_sam"](samInput,0,0,mates)
+
+		(remoteMates,remoteSpill) = (None,None)
+		if (mates != None):
+			remoteMates  = {}
+			remoteBytes  = 0
+			for (qName,qMates) in mate_groups(mates,[spill]):
+				if (qName not in remoteQNames):
+					workerProcessor["write_pair"](qName,qMates)
+					continue
+				remoteMates[qName] = qMates
+				if (memoryLimit != None):
+					remoteBytes += mates_bytes(qName,qMates)
+					if (remoteBytes > memoryLimit):
+						remoteSpill = spill_mates(remoteMates,remoteSpill)
+						remoteBytes = 0
+			if (remoteSpill != None): remoteSpill.close()
+	except:
+		textF.close()
+		remove(textFilename)
+		remove_mate_spills(spillsBefore)
+		raise
+	finally:
+		bgzf.close()
+		f.close()
+
+	textF.close()
+
+	if ("cigarcache" in debug):
+		cacheCounts = [after-before for (before,after)
+		                            in zip(cacheBefore,cigar_cache_counts())]
+	if (runStats != None):
+		runStats.end()
+		statsDelta = [after-before for (before,after)
+		                           in zip(statsBefore,runStats.snapshot())]
+
+	return (None,textFilename,workerProcessor["numberWritten"],remoteMates,remoteSpill,cacheCounts,statsDelta)
+
+
+def cigar_cache_counts():
+	return [cigarCache.lookups,cigarCache.misses,cigarCache.promotions,
+	        cigarCache.parses,cigarCache.turnovers]
+
+
+def report_written_through(fromCount,toCount):
+	for count in xrange(fromCount-(fromCount%writtenProgress)+writtenProgress,
+	                    toCount+1,writtenProgress):
+		report_written(count)
+
+
+# new_bgzf_reader--
+#	Create a reader for a BAM file, decompressing in threads if the options
+#	call for that.
+
+def new_bgzf_reader(f,prefix=""):
+	if (inflateThreads == 0):
+		return BgzfReader(f,prefix=prefix)
+	else:
+		return ThreadedBgzfReader(f,prefix=prefix,
+		                          numThreads=inflateThreads,readahead=readahead)
+
+
+def read_index(indexFilename):
+	try:
+		return read_bam_index(indexFilename)
+	except (IOError,BamError), ex:
+		assert (False), "failed to read index: %s" % ex
+
+
+# chromosome_jobs--
+#	Split an indexed BAM file into a job for each reference sequence, in header
+#	order;  each job is (chrom,chunks).  Unless we are limited to some regions
+#	or chromosomes, the records with no reference sequence (which aren't in the
+#	index) are a final job, from the end of the last indexed chunk (or the end
+#	of the header) to the end of the file.
+
+def chromosome_jobs(index,headerEnd):
+	regions = indexed_regions()
+
+	jobs = []
+	for (refID,chrom) in enumerate(bamHeader.refNames):
+		chunks = index_chunks(index,[region for region in regions if (region[0] == refID)])
+		if (chunks != []): jobs += [(chrom,chunks)]
 
-	if ("sam record" in outputWhat):
- 		if (samRecord == None): samRecord = "(sam)"
-		line += [samRecord]
+	if (regionsOfInterest == None) and (chromsOfInterest == None):
+		unplacedStart = max(headerEnd,index_end_offset(index))
+		jobs += [("*",[(unplacedStart,None)])]
 
-	print "\t".join(line)
+	return jobs
 
-	numberWritten += 1
-	if (writtenProgress != None) and (numberWritten % writtenProgress == 0):
-		progressCount = commatize(numberWritten)
-		if (outputWhat == ["sam record"]): writingWhat = "sam records"
-		else:                              writingWhat = "intervals"
-		if (progressId == None):
-			print >>stderr, "progress: %s %s written" % (progressCount,writingWhat)
+
+def report_chunks(chunks,indent="  "):
+	for (startOffset,endOffset) in chunks:
+		if (endOffset == None):
+			print >>stderr, "%s%d:%d .. end" % (indent,startOffset>>16,startOffset&0xFFFF)
 		else:
-			print >>stderr, "progress: %s / %s %s written" % (progressId,progressCount,writingWhat)
+			print >>stderr, "%s%d:%d .. %d:%d" \
+			              % (indent,startOffset>>16,startOffset&0xFFFF,endOffset>>16,endOffset&0xFFFF)
+
+
+# indexed_regions--
+#	The regions or chromosomes of interest, as (refID,start,end) for the index;
+#	with neither, every whole reference sequence.
+
+def indexed_regions():
+	refNameToId = dict([(name,refID) for (refID,name) in enumerate(bamHeader.refNames)])
+	wholeChrom = 1 << 29	# (the largest position a BAI index can handle)
+
+	regions = []
+	if (regionsOfInterest != None):
+		for (chrom,start,end) in regionsOfInterest:
+			if (chrom not in refNameToId): continue
+			if (chromsOfInterest != None) and (chrom not in chromsOfInterest): continue
+			if (end == None): end = wholeChrom
+			regions += [(refNameToId[chrom],start,min(end,wholeChrom))]
+	elif (chromsOfInterest != None):
+		for chrom in chromsOfInterest:
+			if (chrom not in refNameToId): continue
+			regions += [(refNameToId[chrom],0,wholeChrom)]
+	else:
+		for refID in xrange(len(bamHeader.refNames)):
+			regions += [(refID,0,wholeChrom)]
+
+	return regions
+
 
+# read_chrom_lengths--
+#	Read a chromosome lengths file, returning a list of (chrom,length).
 
-def read_sam_simple(f):
-	lineNumber = recordNumber = 0
-	for line in stdin:
+def read_chrom_lengths(filename):
+	chromLengths = []
+	chromSeen = set()
+
+	f = file(filename,"rt")
+	lineNumber = 0
+	for line in f:
 		lineNumber += 1
 		line = line.strip()
-		if (line.startswith("@")):
-			if (outputWhat == ["sam record"]): # (nothing but sam is being output)
-				if (line.startswith("@SQ")): print line
-			continue
-
-		recordNumber += 1
-		if (reportProgress != None) and (recordNumber % reportProgress == 0):
-			progressCount = commatize(recordNumber)
-			if (progressId == None):
-				print >>stderr, "progress: %s sam records read" % progressCount
-			else:
-				print >>stderr, "progress: %s / %s sam records read" % (progressId,progressCount)
-
-		if (headLimit != None) and (recordNumber > headLimit):
-			print >>stderr, "limit of %d sam records reached" % headLimit
-			break
+		if (line == ""): continue
+		if (line.startswith("#")): continue
 
 		fields = line.split()
-		numFields = len(fields)
-		assert (numFields >= SAM_MIN_COLUMNS), \
-		      "not enough columns at line %d (%d, expected %d)" \
-		    % (lineNumber,numFields,SAM_MIN_COLUMNS)
+		assert (len(fields) == 2), \
+		      "inconsistent number of fields at line %d of %s (%d, expected %d)" \
+		    % (lineNumber,filename,len(fields),2)
 
-		if ("evaluation" in debug):
-			print >>stderr
-			print >>stderr, "line %d: \"%s\"" % (lineNumber," ".join(fields[:4]))
+		try:
+			name   =     fields[0]
+			length = int(fields[1])
+		except ValueError:
+			assert (False), "bad length at line %d of %s\n%s" % (lineNumber,filename,line)
 
-		# if we are only to process a named-based subset, filter out any reads
-		# not in that subset
+		assert (name not in chromSeen), \
+		       "%s occurs twice in %s" % (name,filename)
+		chromLengths += [(name,length)]
+		chromSeen.add(name)
 
-		if (subsetN != None):
-			hashVal = md5_new()
-			hashVal.update(fields[SAM_QNAME_COLUMN])
-			hashK = 1 + (int(hashVal.hexdigest()[:25],16) % subsetN)
-			if (hashK != subsetK): continue
+	f.close()
+	return chromLengths
 
-		# create the context in which we will evaluate the criteria
 
-		context = dict(safeDict)
-		context["LINENUMBER"] = lineNumber
+# parse_region--
+#	Parse <chrom>:<start>-<end> (origin-one, closed) or <chrom>, returning
+#	(chrom,start,end) as origin-zero, half-open.
 
-		for name in samFieldToColumn:
-			col = samFieldToColumn[name]
-			context[name] = fields[col]
+def parse_region(s):
+	if (":" not in s): return (s,0,None)
+	(chrom,interval) = s.rsplit(":",1)
+	interval = interval.replace(",","")
+	if ("-" not in interval): raise ValueError
+	(start,end) = interval.split("-",1)
+	start = int_with_unit(start) - 1
+	end   = int_with_unit(end)
+	if (chrom == "") or (start < 0) or (end <= start): raise ValueError
+	return (chrom,start,end)
 
-		try:
-			context["FLAG" ] = int_or_string(context["FLAG" ])
-			context["POS"  ] = int_or_string(context["POS"  ])
-			context["MAPQ" ] = int_or_string(context["MAPQ" ])
-			context["PNEXT"] = int_or_string(context["PNEXT"])
-			context["TLEN" ] = int_or_string(context["TLEN" ])
-		except ValueError:
-			assert (False), "bad SAM record at line %d\n%s" % (lineNumber,line)
 
-		context["FLAGS"] = context["FLAG"]
-		if (type(context["POS"]) != str): context["POS"] -= 1
+# support functions for the generated record processor
 
-		for field in fields[SAM_MIN_COLUMNS:]:
-			(tag,typeCode,val) = field.split(":",2)
-			if (tag not in tagsNeeded):
-				continue
-			variable = tagToVariable[tag]
-			if   (typeCode == "i"): context[variable] = int(val)
-			elif (typeCode == "f"): context[variable] = float(val)
-			else:                   context[variable] = val
+def too_few_columns(lineNumber,numFields,expected):
+	assert (False), "not enough columns at line %d (%d, expected %d)" \
+	              % (lineNumber,numFields,expected)
 
-		for tag in tagsNeeded:
-			variable = tagToVariable[tag]
-			if (variable not in context): context[variable] = None
 
-		for variable in computedVariables:
-			if (variable not in variablesNeeded): continue
-			(func,_) = computedVariables[variable]
-			context[variable] = func(context)
+def not_coordinate_sorted(lineNumber):
+	assert (False), "input is not sorted by position (at line %d)" % lineNumber
 
-		if ("context" in debug) or ("flags" in debug):
-			values = [(name,context[name]) for name in context if (name not in safeDict)]
-			if ("flags" in debug):
-				values = [(name,context[name]) for name in context if (name == "FLAGS")]
-			values.sort()
-			print >>stderr, "=== context for line %d ===" % lineNumber
-			nameWidth = max([len(name) for (name,_) in values])
-			for (name,val) in values:
-				if (name in ["SEQ","QUAL"]) and (len(val) > 20):
-					val = "\"%s...\"" % val[:20]
-				elif (name in ["FLAG","FLAGS"]):
-					val = flags_to_string(val)
-				elif (type(val) == str): val = "\"%s\"" % val
-				print >>stderr, "  %-*s = %s" % (nameWidth,name,val)
-
-		# filter, by evaluating the requirements and prohibitions
-
-		reject = False
-		for criterionStr in requirements:
-			(criterion,_) = requirements[criterionStr]
-			if ("evaluation" in debug):
-				print >>stderr, "evaluating requirement \"%s\"" % criterion
-			try:
-				val = eval(criterion,{"__builtins__":None},context)
-			except NameError:
-				print >>stderr, "failed to evaluate requirement \"%s\"" % criterion
-				raise
-			#if ("evaluation" in debug):
-			#	print >>stderr, "  (evaluates to %s)" % val
+def start_after_end(start,end,lineNumber):
+	assert (False), "start > end (%d > %d) at line %d" % (start,end,lineNumber)
+
+
+def in_regions(regions,pos,cigarInfo):
+	# a record overlaps a region if its aligned extent does (an alignment
+	# without a cigar is considered to have length 1, as samtools does)
+	length = 1
+	if (cigarInfo != None):
+		(_,length) = cigar_info_to_extent(cigarInfo)
+		if (length < 1): length = 1
+	for (start,end) in regions:
+		if (pos + length > start) and ((end == None) or (pos < end)):
+			return True
+	return False
+
+
+def tag_value(field):
+	(_,typeCode,val) = field.split(":",2)
+	if   (typeCode == "i"): return int(val)
+	elif (typeCode == "f"): return float(val)
+	else:                   return val
+
+
+def report_records_read(recordNumber):
+	progressCount = commatize(recordNumber)
+	if (progressId == None):
+		print >>stderr, "progress: %s sam records read" % progressCount
+	else:
+		print >>stderr, "progress: %s / %s sam records read" % (progressId,progressCount)
+
+
+def report_written(numberWritten):
+	progressCount = commatize(numberWritten)
+	if (outputWhat == ["sam record"]): writingWhat = "sam records"
+	else:                              writingWhat = "intervals"
+	if (progressId == None):
+		print >>stderr, "progress: %s %s written" % (progressCount,writingWhat)
+	else:
+		print >>stderr, "progress: %s / %s %s written" % (progressId,progressCount,writingWhat)
+
+
+def print_context(lineNumber,context):
+	values = [(name,context[name]) for name in context]
+	if ("flags" in debug):
+		values = [(name,context[name]) for name in context if (name == "FLAGS")]
+	values.sort()
+	print >>stderr, "=== context for line %d ===" % lineNumber
+	nameWidth = max([len(name) for (name,_) in values])
+	for (name,val) in values:
+		if (name in ["SEQ","QUAL"]) and (len(val) > 20):
+			val = "\"%s...\"" % val[:20]
+		elif (name in ["FLAG","FLAGS"]):
+			val = flags_to_string(val)
+		elif (type(val) == str): val = "\"%s\"" % val
+		print >>stderr, "  %-*s = %s" % (nameWidth,name,val)
+
+
+# evaluate_criteria_verbosely--
+#	Evaluate the requirements and prohibitions one at a time (in the same
+#	order as the record processor would), describing each evaluation to
+#	stderr.  This is only used for --debug=evaluation;  normally the criteria
+#	are inlined into the generated record processor.  If specNum is given, the
+#	criteria are those of that output spec (a record they reject is counted by
+#	the record processor, for --stats, rather than here).
+
+def evaluate_criteria_verbosely(context,lineNumber,line,specNum=None):
+	if (specNum == None):
+		(evalCriteria,forOutput) = (criteria,"")
+	else:
+		spec = outputSpecs[specNum]
+		(evalCriteria,forOutput) = (spec.criteria," for output %s" % spec.name)
+
+	for criterion in evalCriteria:
+		(kind,criterionStr) = (criterion.kind,criterion.text)
+		print >>stderr, "evaluating %s \"%s\"%s" % (kind,criterion.expression,forOutput)
+		try:
+			val = eval(criterionToCode[criterion.expression],safeGlobals,context)
+		except NameError:
+			print >>stderr, "failed to evaluate %s \"%s\"" % (kind,criterion.expression)
+			raise
+
+		if (kind == "requirement"):
 			if (val == False):
-				reject = True
-				if ("evaluation" in debug): print >>stderr, "  (rejected)"
-				break
+				print >>stderr, "  (rejected)"
+				if (runStats != None) and (specNum == None):
+					runStats.counts[stats_counter(criterion)] += 1
+				return False
 			if (val != True):
 				assert (False), "requirement \"%s\" evaluates to \"%s\" on SAM record at line %d\n%s\nevaluated as \"%s\"" \
-				              % (criterionStr,val,lineNumber,line,criterion)
-		if (reject): continue
-
-		for criterionStr in prohibitions:
-			(criterion,_) = prohibitions[criterionStr]
-			if ("evaluation" in debug):
-				print >>stderr, "evaluating prohibition \"%s\"" % criterion
-			try:
-				val = eval(criterion,{"__builtins__":None},context)
-			except NameError:
-				print >>stderr, "failed to evaluate prohibition \"%s\"" % criterion
-				raise
-			#if ("evaluation" in debug):
-			#	print >>stderr, "  (evaluates to %s)" % val
+				              % (criterionStr,val,lineNumber,line,criterion.expression)
+		else:
 			if (val == True):
-				reject = True
-				if ("evaluation" in debug): print >>stderr, "  (rejected)"
-				break
+				print >>stderr, "  (rejected)"
+				if (runStats != None) and (specNum == None):
+					runStats.counts[stats_counter(criterion)] += 1
+				return False
 			if (val != False):
 				assert (False), "prohibition \"%s\" evaluates to \"%s\" on SAM record at line %d\n%s\n(evaluated as \"%s\")" \
-				              % (criterionStr,lineNumber,line,criterion)
-		if (reject): continue
+				              % (criterionStr,val,lineNumber,line,criterion.expression)
 
-		# if it made it through all that, keep it
+	return True
 
-		yield (lineNumber,line,context)
 
+# functions to support "special variables"--
+#	Each is called with the values of the variables listed for it in
+#	computedVariables, in that order.
 
-# functions to support "special variables"
+def read_length(seq):
+	return len(seq)
 
-def read_length(context):
-	return len(context["SEQ"])
 
+def after_clip_length(cigarInfo,seq):
+	if (cigarInfo == None): return len(seq)
+	return len(seq) - cigarInfo.lftClip - cigarInfo.rgtClip
 
-def after_clip_length(context):
-	cigar = context["CIGAR"]
-	cigarInfo = split_cigar(cigar)
-	unclip = len(context["SEQ"])
-	if (cigarInfo != None):
-		(rpt,op) = cigarInfo.operations[0]
-		if (op in ["S","H"]): unclip -= rpt
-		if (len(cigarInfo.operations) > 1):
-			(rpt,op) = cigarInfo.operations[-1]
-			if (op in ["S","H"]): unclip -= rpt
-	return unclip
-
-
-def clip_length(context):
-	cigar = context["CIGAR"]
-	cigarInfo = split_cigar(cigar)
-	clip = 0
-	if (cigarInfo != None):
-		(rpt,op) = cigarInfo.operations[0]
-		if (op in ["S","H"]): clip += rpt
-		if (len(cigarInfo.operations) > 1):
-			(rpt,op) = cigarInfo.operations[-1]
-			if (op in ["S","H"]): clip += rpt
-	return clip
 
+def clip_length(cigarInfo):
+	if (cigarInfo == None): return 0
+	return cigarInfo.lftClip + cigarInfo.rgtClip
 
-def left_clip_length(context):
-	cigar = context["CIGAR"]
-	cigarInfo = split_cigar(cigar)
-	if (cigarInfo != None):
-		(rpt,op) = cigarInfo.operations[0]
-		if (op in ["S","H"]): return rpt
-	return 0
 
+def left_clip_length(cigarInfo):
+	if (cigarInfo == None): return 0
+	return cigarInfo.lftClip
 
-def right_clip_length(context):
-	cigar = context["CIGAR"]
-	cigarInfo = split_cigar(cigar)
-	if (cigarInfo != None):
-		(rpt,op) = cigarInfo.operations[-1]
-		if (op in ["S","H"]): return rpt
-	return 0
 
+def right_clip_length(cigarInfo):
+	if (cigarInfo == None): return 0
+	if (len(cigarInfo.operations) == 1): return cigarInfo.lftClip
+	return cigarInfo.rgtClip
 
-def min_clip_length(context):
-	(lftClip,rgtClip) = cigar_to_clip_lengths(context["CIGAR"])
-	return min(lftClip,rgtClip)
 
+def min_clip_length(cigarInfo):
+	if (cigarInfo == None): return 0
+	return min(cigarInfo.lftClip,cigarInfo.rgtClip)
 
-def clip_breakpoint(context):
-	extent = cigar_to_extent(context["CIGAR"])
-	if (extent == None): return "(NO_CLIPBRK)"
-	(left,right) = extent
-	(lftClip,rgtClip) = cigar_to_clip_lengths(context["CIGAR"])
+
+def clip_breakpoint(cigarInfo,rPos):
+	if (cigarInfo == None): return "(NO_CLIPBRK)"
+	(left,right) = cigar_info_to_extent(cigarInfo)
+	(lftClip,rgtClip) = (cigarInfo.lftClip,cigarInfo.rgtClip)
 	if (lftClip == 0) and (rgtClip == 0): return "(NO_CLIPBRK)"
 
-	rPos = context["POS"]
 	if (lftClip >= rgtClip):
 		start = rPos - left
 		if (start < 0): start = 0
@@ -709,16 +2786,13 @@ def clip_breakpoint(context):
 		return end
 
 
-def score_best_by(context):
-	score  = context["SCORE"]
-	subopt = context["SUBOPT"]
+def score_best_by(score,subopt):
 	if (score  == None): score  = 0
 	if (subopt == None): subopt = 0
 	return score - subopt
 
 
-def mate_orientation(context):
-	flags = context["FLAG"]
+def mate_orientation(flags):
 	if (flags & 0xFF9 == 0x061): return "1F";
 	if (flags & 0xFF9 == 0x091): return "2R";
 	if (flags & 0xFF9 == 0x051): return "1R";
@@ -726,9 +2800,7 @@ def mate_orientation(context):
 	return "(MORIENT)"
 
 
-def pair_orientation(context):
-	flags = context["FLAG"]
-	tLen  = context["TLEN"]
+def pair_orientation(flags,tLen):
 	if (tLen > 0):
 		if (flags & 0xFF9 in [0x061,0x0A1]): return "H2H";
 		if (flags & 0xFF9 in [0x091,0x051]): return "T2T";
@@ -765,46 +2837,28 @@ def flags_to_string(val):
 
 
 # cigar string processing--
-
-def cigar_to_extent(cigar,lineNumber=None):
-	cigarInfo = split_cigar(cigar)
-	if (cigarInfo == None): return None
-
-	left = 0
-	(rpt,op) = cigarInfo.operations[0]
-	if (op == "S"): left += rpt
-	right = left
-
-	for (rpt,op) in cigarInfo.operations:
-		if (op in ["M","X","=","D","N"]):
-			right += rpt
-		elif (op in ["I","S"]):
-			pass
+#	A cigar string is parsed into a CigarInfo, which holds everything the
+#	computed variables and the interval extent need, so each record's cigar is
+#	parsed at most once.  Parsed cigars are also kept in a bounded cache keyed
+#	on the cigar string, since a few cigars (e.g. "100M") account for most of
+#	the records in a typical SAM file.
+
+def cigar_info_to_extent(cigarInfo,lineNumber=None):
+	if (cigarInfo.extent == None):
+		(rpt,op) = cigarInfo.unsupported
+		if (lineNumber == None):
+			assert (False), "unsupported \"%d%s\" in cigar %s" \
+			              % (rpt,op,cigarInfo.cigar)
 		else:
-			if (lineNumber == None):
-				assert (False), "unsupported \"%d%s\" in cigar %s" \
-				              % (rpt,op,cigar)
-			else:
-				assert (False), "unsupported \"%d%s\" in cigar %s (line %d)" \
-				              % (rpt,op,cigar,lineNumber)
-
-	return (0,right-left)
-
-
-def cigar_to_clip_lengths(cigar):
-	cigarInfo = split_cigar(cigar)
-	lftClip = rgtClip = 0
-	if (cigarInfo != None):
-		(rpt,op) = cigarInfo.operations[0]
-		if (op in ["S","H"]): lftClip = rpt
-		if (len(cigarInfo.operations) > 1):
-			(rpt,op) = cigarInfo.operations[-1]
-			if (op in ["S","H"]): rgtClip = rpt
-	return (lftClip,rgtClip)
+			assert (False), "unsupported \"%d%s\" in cigar %s (line %d)" \
+			              % (rpt,op,cigarInfo.cigar,lineNumber)
+	return cigarInfo.extent
 
 
 class CigarInfo: pass
 
+cigarOpRe = re_compile("([0-9]*)([^0-9])")
+
 def split_cigar(cigar):
 
 	if (cigar == "*"): return None
@@ -812,15 +2866,23 @@ def split_cigar(cigar):
 	# split the cigar into a list of (count,operation)
 
 	operations = []
-	rpt = []
-	for ch in cigar:
-		if (ch.isdigit()):
-			rpt += [ch]
-		else:
-			assert (rpt != []), "bad cigar: \"%s\"" % cigar
-			operations += [(int("".join(rpt)),ch)]
-			rpt = []
-	assert (rpt == []), "bad cigar: \"%s\"" % cigar
+	for (rpt,op) in cigarOpRe.findall(cigar):
+		assert (rpt != ""), "bad cigar: \"%s\"" % cigar
+		operations += [(int(rpt),op)]
+	assert (not cigar[-1:].isdigit()), "bad cigar: \"%s\"" % cigar
+
+	return operations_to_cigar_info(cigar,operations)
+
+
+def split_packed_cigar(packedCigar):
+	# packedCigar is a BAM record's cigar, an array of uint32 operations
+	if (packedCigar == ""): return None
+	operations = cigar_ops(packedCigar)
+	cigar = "".join(["%d%s" % (rpt,op) for (rpt,op) in operations])
+	return operations_to_cigar_info(cigar,operations)
+
+
+def operations_to_cigar_info(cigar,operations):
 
 	# trim clipping operators from the ends
 
@@ -837,13 +2899,1122 @@ def split_cigar(cigar):
 			endClip = rpt
 			operations = operations[:-1]
 
+	# measure the clipping that remains at the ends (this is what the clip
+	# variables report)
+
+	lftClip = rgtClip = 0
+	if (operations != []):
+		(rpt,op) = operations[0]
+		if (op in ["S","H"]): lftClip = rpt
+		if (len(operations) > 1):
+			(rpt,op) = operations[-1]
+			if (op in ["S","H"]): rgtClip = rpt
+
+	# measure the extent on the reference;  if there's an operation we can't
+	# handle, we only complain if the extent is actually used
+
+	extent = unsupported = None
+	left = 0
+	if (operations != []):
+		(rpt,op) = operations[0]
+		if (op == "S"): left += rpt
+	right = left
+
+	for (rpt,op) in operations:
+		if (op in ["M","X","=","D","N"]):
+			right += rpt
+		elif (op in ["I","S"]):
+			pass
+		else:
+			unsupported = (rpt,op)
+			break
+
+	if (unsupported == None): extent = (0,right-left)
+
 	splitCigar = CigarInfo()
-	splitCigar.operations = operations
-	splitCigar.startClip  = startClip
-	splitCigar.endClip    = endClip
+	splitCigar.cigar       = cigar
+	splitCigar.operations  = operations
+	splitCigar.startClip   = startClip
+	splitCigar.endClip     = endClip
+	splitCigar.lftClip     = lftClip
+	splitCigar.rgtClip     = rgtClip
+	splitCigar.extent      = extent
+	splitCigar.unsupported = unsupported
 	return splitCigar
 
 
+# MateSpill--
+#	Mates that are waiting to be paired, spilled to disk because they would
+#	exceed the memory budget (see --memory).  A spill writes all the pending
+#	mates to a set of partition files, chosen by a hash of the read name, so
+#	that the mates with the same name, from any number of spills, are in the
+#	same partition.  Each partition can then be paired on its own, with only
+#	one partition in memory at a time.
+#
+#	A spill made in a worker process can be paired in the main process;  once
+#	closed, it's passed between them as its list of filenames.
+#
+#	Every spill made in a process is listed in mateSpills until it's removed,
+#	so that if the run fails its files can still be found (the spill itself
+#	is local to the generated record processor), see remove_mate_spills.  The
+#	files are all in runTempDir, which is removed at the end of the run (or if
+#	it fails).
+
+MATE_OVERHEAD         = 250	# (rough bytes of python objects per pending mate)
+MATE_SPILL_PARTITIONS = 64
+
+mateSpills = []
+runTempDir = None
+
+class MateSpill:
+
+	def __init__(self,numPartitions=MATE_SPILL_PARTITIONS):
+		self.filenames = []
+		self.files     = []
+		for _ in xrange(numPartitions):
+			(fd,filename) = mkstemp(prefix="filtered_sam_to_intervals.",suffix=".mates",
+			                        dir=runTempDir)
+			self.filenames += [filename]
+			self.files     += [fdopen(fd,"wb")]
+		self.numSpills = 0
+		mateSpills.append(self)
+
+	def spill(self,qNameToMates):
+		files = self.files
+		numPartitions = len(files)
+		for qName in qNameToMates:
+			marshal_dump((qName,qNameToMates[qName]),files[hash(qName) % numPartitions])
+		qNameToMates.clear()
+		self.numSpills += 1
+
+	def close(self):
+		if (self.files == None): return
+		for f in self.files: f.close()
+		self.files = None
+
+	def load(self,partition,qNameToMates):
+		f = file(self.filenames[partition],"rb")
+		while (True):
+			try:             (qName,mates) = marshal_load(f)
+			except EOFError: break
+			if (qName in qNameToMates): qNameToMates[qName] += mates
+			else:                       qNameToMates[qName] =  mates
+		f.close()
+
+	def remove(self):
+		self.close()
+		for filename in self.filenames:
+			if (exists(filename)): remove(filename)
+		if (self in mateSpills): mateSpills.remove(self)
+
+
+# remove_mate_spills--
+#	Remove the files of the spills made in this process (since the first
+#	numBefore were made) that haven't been removed;  this is for cleaning up
+#	after a failure.
+
+def remove_mate_spills(numBefore=0):
+	for spill in mateSpills[numBefore:]:
+		spill.remove()
+
+
+def spill_mates(qNameToMates,spill):
+	if (spill == None): spill = MateSpill()
+	if ("memory" in debug):
+		print >>stderr, "spilling %s pending read names (%s mates) to disk" \
+		              % (commatize(len(qNameToMates)),
+		                 commatize(sum([len(mates) for mates in qNameToMates.itervalues()])))
+	spill.spill(qNameToMates)
+	return spill
+
+
+def mates_bytes(qName,mates):
+	return sum([MATE_OVERHEAD + len(qName) + len(text or "")
+	            for (_,_,_,text) in mates])
+
+
+# mate_groups--
+#	Yield (qName,mates) for each group of mates with the same name, whether
+#	they are pending in memory or have been spilled to disk;  the pending dict
+#	is emptied, and the spill files are removed.
+
+def mate_groups(qNameToMates,spills):
+	spills = [spill for spill in spills if (spill != None)]
+	if (spills == []):
+		for qName in qNameToMates:
+			yield (qName,qNameToMates[qName])
+		return
+
+	for spill in spills: spill.close()
+
+	numPartitions = len(spills[0].filenames)
+	partitions = [{} for _ in xrange(numPartitions)]
+	for qName in qNameToMates:
+		partitions[hash(qName) % numPartitions][qName] = qNameToMates[qName]
+	qNameToMates.clear()
+
+	for partition in xrange(numPartitions):
+		group = partitions[partition]
+		partitions[partition] = None
+		for spill in spills: spill.load(partition,group)
+		for qName in group:
+			yield (qName,group[qName])
+
+	for spill in spills: spill.remove()
+
+
+# PairDuplicates--
+#	Recognizes duplicate pairs, for --rmdup.  A pair's key is its chromosome,
+#	start, end and orientation (the strands of its leftmost and rightmost
+#	mates), and it is a duplicate if an earlier pair had the same key.
+#
+#	For name-sorted or unsorted input, seen() keeps every key.  For
+#	coordinate-sorted input, a pair is written when its last mate is read, so
+#	(on each chromosome) the start of the last mate never decreases;  once it
+#	passes a pair's end, no later pair can have that end.  seen_near() keeps
+#	the keys in a heap by end, and forgets them then, so only the pairs that
+#	span the current position are remembered.
+
+class PairDuplicates:
+
+	def __init__(self):
+		self.keys  = set()
+		self.ends  = []
+		self.chrom = None
+
+	def seen(self,key):
+		if (key in self.keys): return True
+		self.keys.add(key)
+		return False
+
+	def seen_near(self,key,lastStart):
+		(keys,ends) = (self.keys,self.ends)
+		if (key[0] != self.chrom):
+			keys.clear()
+			del ends[:]
+			self.chrom = key[0]
+		while (ends != []) and (ends[0][0] < lastStart):
+			keys.discard(heappop(ends)[1])
+		if (key in keys): return True
+		keys.add(key)
+		heappush(ends,(key[2],key))
+		return False
+
+
+# DepthCoverage--
+#	Depth of coverage of a set of intervals (see --depth).  Rather than a count
+#	for every position, we keep each chromosome's interval starts and ends, in
+#	two compact arrays (four bytes per interval end);  at the end, sorting
+#	them gives the positions at which the depth changes, and the runs between
+#	those are written as a bedGraph.  Intervals are origin-zero, half-open
+#	(or origin-one, closed, with --origin=one);  any part of an interval
+#	beyond the end of its chromosome is ignored.  With --out=binary the runs
+#	are written as a binary interval stream, with the depth as the value.
+
+class DepthCoverage:
+
+	def __init__(self,chromLengths):
+		self.chroms    = [chrom for (chrom,_) in chromLengths]
+		self.intervals = {}
+		for (chrom,length) in chromLengths:
+			self.intervals[chrom] = (array("I"),array("I"),length)
+		self.originOne = (origin == "one")
+		self.binary    = (outputFormat == "binary")
+
+	def add(self,chrom,start,end):
+		if (chrom == "*"): return
+		try:
+			(starts,ends,length) = self.intervals[chrom]
+		except KeyError:
+			assert (False), "%s is in input but not in chromosome lengths" % chrom
+		if (self.originOne): start -= 1
+		if (end > length):
+			if (start >= length): return
+			end = length
+		starts.append(start)
+		ends.append(end)
+
+	def write(self,f):
+		if (self.binary):
+			writer = IntervalWriter(f,"i",1)
+			for chrom in self.chroms:
+				(starts,ends,length) = self.intervals[chrom]
+				for (start,end,depth) in depth_runs(starts,ends,length):
+					writer.write(chrom,start,end,depth)
+				self.intervals[chrom] = None
+			writer.close()
+			return
+
+		o = 1 if (self.originOne) else 0
+		for chrom in self.chroms:
+			(starts,ends,length) = self.intervals[chrom]
+			for (start,end,depth) in depth_runs(starts,ends,length):
+				f.write("%s\t%d\t%d\t%d\n" % (chrom,start+o,end,depth))
+			self.intervals[chrom] = None
+
+
+# depth_runs--
+#	Yield (start,end,depth) for each run of positions with the same depth of
+#	coverage, from the start of a chromosome to its end.
+
+def depth_runs(starts,ends,length):
+	starts = sorted(starts)
+	ends   = sorted(ends)
+	n = len(starts)
+
+	(runStart,depth) = (0,0)
+	(i,j) = (0,0)
+	while (j < n):
+		if (i < n) and (starts[i] <= ends[j]): pos = starts[i]
+		else:                                   pos = ends[j]
+		newDepth = depth
+		while (i < n) and (starts[i] == pos):
+			newDepth += 1
+			i += 1
+		while (j < n) and (ends[j] == pos):
+			newDepth -= 1
+			j += 1
+		if (newDepth != depth):
+			if (pos > runStart): yield (runStart,pos,depth)
+			(runStart,depth) = (pos,newDepth)
+
+	if (length > runStart): yield (runStart,length,depth)
+
+
+# MeanCoverage--
+#	Mean value of the intervals covering each position (see --mean).  As for
+#	DepthCoverage, rather than a sum and count for every position we keep
+#	each chromosome's interval starts, ends and values in compact arrays;  the
+#	values' array holds integers of 2 or 4 bytes, or 8-byte floats, as chosen
+#	by --meanwidth.  At the end, the starts and ends (each with its value) are
+#	sorted, and a running sum and count give the mean between each position
+#	at which they change.  Runs are written as a bedGraph, joining adjacent
+#	runs that print the same;  positions with no intervals aren't written.
+#
+#	The mean is rounded before the constant is subtracted, as it was when we
+#	piped intervals through "chrom_avg --precision" and then awk.
+
+class MeanCoverage:
+
+	def __init__(self,chromLengths,constant=0,width=4,precision=0):
+		typecode = {2:"h", 4:"i", 8:"d"}[width]
+		self.chroms    = [chrom for (chrom,_) in chromLengths]
+		self.intervals = {}
+		for (chrom,length) in chromLengths:
+			self.intervals[chrom] = (array("I"),array("I"),array(typecode),length)
+		self.width     = width
+		self.constant  = constant
+		self.precision = precision
+		self.originOne = (origin == "one")
+		self.binary    = (outputFormat == "binary")
+
+	def add(self,chrom,start,end,val):
+		if (chrom == "*") or (val == None): return
+		try:
+			(starts,ends,vals,length) = self.intervals[chrom]
+		except KeyError:
+			assert (False), "%s is in input but not in chromosome lengths" % chrom
+		if (self.originOne): start -= 1
+		if (end > length):
+			if (start >= length): return
+			end = length
+		try:
+			vals.append(val)
+		except (OverflowError,TypeError):
+			assert (False), "%s can't be kept in %d bytes (see --meanwidth)" % (val,self.width)
+		starts.append(start)
+		ends.append(end)
+
+	def write(self,f):
+		if (self.binary):
+			writer = IntervalWriter(f,"d",1)
+			for chrom in self.chroms:
+				(starts,ends,vals,_) = self.intervals[chrom]
+				for (start,end,meanText) in mean_runs(starts,ends,vals,self.constant,self.precision):
+					writer.write(chrom,start,end,float(meanText))
+				self.intervals[chrom] = None
+			writer.close()
+			return
+
+		o = 1 if (self.originOne) else 0
+		for chrom in self.chroms:
+			(starts,ends,vals,_) = self.intervals[chrom]
+			for (start,end,meanText) in mean_runs(starts,ends,vals,self.constant,self.precision):
+				f.write("%s\t%d\t%d\t%s\n" % (chrom,start+o,end,meanText))
+			self.intervals[chrom] = None
+
+
+# mean_runs--
+#	Yield (start,end,meanText) for each run of covered positions with the
+#	same mean value (as text).
+
+def mean_runs(starts,ends,vals,constant,precision):
+	startEvents = sorted(izip(starts,vals))
+	endEvents   = sorted(izip(ends,vals))
+	n = len(startEvents)
+
+	(runStart,runText) = (None,None)
+	(valSum,count) = (0,0)
+	(i,j) = (0,0)
+	while (j < n):
+		if (i < n) and (startEvents[i][0] <= endEvents[j][0]): pos = startEvents[i][0]
+		else:                                                   pos = endEvents[j][0]
+		while (i < n) and (startEvents[i][0] == pos):
+			valSum += startEvents[i][1]
+			count  += 1
+			i += 1
+		while (j < n) and (endEvents[j][0] == pos):
+			valSum -= endEvents[j][1]
+			count  -= 1
+			j += 1
+		if (count == 0):
+			valSum = 0  # (so that float error doesn't accumulate)
+			text   = None
+		else:
+			mean = float("%.*f" % (precision,float(valSum)/count))
+			text = "%.*f" % (precision,mean-constant)
+		if (text != runText):
+			if (runText != None) and (pos > runStart): yield (runStart,pos,runText)
+			(runStart,runText) = (pos,text)
+
+
+# BreakpointCounts--
+#	Number of clipped-read breakpoints (CLIPBRK) in each fixed-size window of
+#	each chromosome (see --breakpoints).  Rather than a count for every window
+#	(hundreds of millions of them, for a 10-base window over a whole genome),
+#	we keep each chromosome's breakpoints as window numbers, in a compact
+#	array (four bytes per breakpoint);  at the end, sorting them gives the
+#	count in each window, and runs of windows with the same count (including
+#	runs with none) are written as a bedGraph covering the whole chromosome.
+#	Breakpoints are origin-zero (or origin-one with --origin=one);  any beyond
+#	the end of their chromosome are ignored.  With --out=binary the runs are
+#	written as a binary interval stream, with the count as the value.
+
+class BreakpointCounts:
+
+	def __init__(self,chromLengths,window):
+		self.chroms    = [chrom for (chrom,_) in chromLengths]
+		self.windows   = {}
+		for (chrom,length) in chromLengths:
+			self.windows[chrom] = (array("I"),length)
+		self.window    = window
+		self.originOne = (origin == "one")
+		self.binary    = (outputFormat == "binary")
+
+	def add(self,chrom,pos):
+		try:
+			(windows,length) = self.windows[chrom]
+		except KeyError:
+			assert (False), "%s is in input but not in chromosome lengths" % chrom
+		if (self.originOne): pos -= 1
+		if (pos >= length): return
+		windows.append(pos // self.window)
+
+	def write(self,f):
+		if (self.binary):
+			writer = IntervalWriter(f,"i",1)
+			for chrom in self.chroms:
+				(windows,length) = self.windows[chrom]
+				for (start,end,count) in window_runs(windows,self.window,length):
+					writer.write(chrom,start,end,count)
+				self.windows[chrom] = None
+			writer.close()
+			return
+
+		o = 1 if (self.originOne) else 0
+		for chrom in self.chroms:
+			(windows,length) = self.windows[chrom]
+			for (start,end,count) in window_runs(windows,self.window,length):
+				f.write("%s\t%d\t%d\t%d\n" % (chrom,start+o,end,count))
+			self.windows[chrom] = None
+
+
+# window_runs--
+#	Yield (start,end,count) for each run of windows with the same count, from
+#	the start of a chromosome to its end;  windows holds the window number of
+#	each breakpoint.
+
+def window_runs(windows,window,length):
+	windows = sorted(windows)
+	n = len(windows)
+
+	(runStart,runCount) = (0,0)
+	pos = 0	# (the end of the last window with a breakpoint)
+	i = 0
+	while (i < n):
+		windowNum = windows[i]
+		count = 0
+		while (i < n) and (windows[i] == windowNum):
+			count += 1
+			i += 1
+		(start,end) = (windowNum*window,min((windowNum+1)*window,length))
+		if (start > pos) and (runCount != 0):
+			yield (runStart,pos,runCount)
+			(runStart,runCount) = (pos,0)
+		if (count != runCount):
+			if (start > runStart): yield (runStart,start,runCount)
+			(runStart,runCount) = (start,count)
+		pos = end
+
+	if (length > pos) and (runCount != 0):
+		yield (runStart,pos,runCount)
+		(runStart,runCount) = (pos,0)
+	if (length > runStart): yield (runStart,length,runCount)
+
+
+# BatchFilter--
+#	Evaluates criteria that only involve numeric fields (see vector_source) for
+#	a batch of SAM records at once.  The input is read as a block of text,
+#	the lines and fields are located from the positions of its newlines and
+#	tabs, and the fields' digits are converted to NumPy arrays of integers, all
+#	without any per-record python work.  Only the records that satisfy these
+#	criteria are split into lines, and the generated record processor sees
+#	only those, and doesn't evaluate the criteria again.
+#
+#	If any record in a batch doesn't have the fields in the expected form
+#	(e.g. it has too few columns, or a field that isn't an integer), the whole
+#	batch is passed through unchecked, and the record processor evaluates the
+#	criteria (or complains about the record) as it would without a batch
+#	filter.
+#
+#	lines() takes over counting lines and records (and enforcing --head and
+#	reporting --progress) from the record processor;  it yields
+#	(lineNumber,recordNumber,line,checked) for header lines and for the
+#	records that pass, where checked is false for an unchecked batch.
+#
+#	With --stats, the batch filter also counts the records read, and it
+#	evaluates the criteria one at a time, so that each is charged with the
+#	records that pass the criteria before it but not it.
+
+class BatchFilter:
+
+	def __init__(self,criteria,batchSize):
+		self.criteria  = criteria
+		self.batchSize = batchSize
+
+		names = set()
+		for criterion in criteria:
+			for name in criterion.names: names.add(name)
+		self.names   = sorted(names)
+		self.columns = sorted(set([samFieldToColumn["FLAG" if (name == "FLAGS") else name]
+		                           for name in names]))
+
+		terms = []
+		for criterion in criteria:
+			if (criterion.kind == "requirement"): terms += [criterion.vectorSource]
+			else:                                 terms += ["(~%s)" % criterion.vectorSource]
+		self.source = " & ".join(terms)
+		self.code   = compile(self.source,"<batch filter>","eval")
+
+		self.records  = 0
+		self.rejected = 0
+		self.unparsed = 0
+
+		if (runStats != None):
+			self.termCodes = [compile(term,"<batch filter>","eval") for term in terms]
+			self.counters  = [stats_counter(criterion) for criterion in criteria]
+			self.readCounter     = stats_counter("records read")
+			self.rejectedCounter = stats_counter("batch filter rejected")
+
+	def lines(self,f,lineNumber=0,recordNumber=0):
+		return chain.from_iterable(self.batches(f,lineNumber,recordNumber))
+
+	# batches--
+	#	Yield a list of lines() items for each batch (or header line).  The
+	#	input is read as blocks of text (see SamText.blocks);  a SamText is
+	#	read in large blocks, anything else (e.g. a list of lines) batchSize
+	#	lines at a time.
+
+	def batches(self,f,lineNumber,recordNumber):
+		if (isinstance(f,SamText)):
+			blocks = f.blocks()
+		else:
+			f = iter(f)
+			blocks = ((text,len(text)) for text in iter(lambda:"".join(islice(f,self.batchSize)),""))
+
+		for (text,textLen) in blocks:
+			data = numpy.frombuffer(text,dtype=numpy.uint8,count=textLen)
+			ends = numpy.flatnonzero(data == 10) + 1
+			if (text[textLen-1] != "\n"): ends = numpy.append(ends,textLen)
+			starts = numpy.concatenate(([0],ends[:-1]))
+			self.otherSpace = numpy.flatnonzero((data == ord(" ")) | (data - numpy.uint8(11) <= 2))	# (also \v, \f or \r)
+
+			for batchStart in xrange(0,len(ends),self.batchSize):
+				batchEnd = min(batchStart+self.batchSize,len(ends))
+
+				# usually there are no header lines, and the whole batch is
+				# records
+
+				if (not (data[starts[batchStart:batchEnd]] == ord("@")).any()):
+					numRecords = batchEnd - batchStart
+					if (headLimit != None) and (recordNumber + numRecords > headLimit):
+						batchEnd = batchStart + headLimit - recordNumber
+					yield self.filter(text,data,starts[batchStart:batchEnd],ends[batchStart:batchEnd],
+					                  lineNumber,recordNumber)
+					lineNumber   += batchEnd - batchStart
+					recordNumber += batchEnd - batchStart
+					if (batchEnd - batchStart < numRecords):
+						print >>stderr, "limit of %d sam records reached" % headLimit
+						return
+					continue
+
+				# otherwise the batch is split at the header lines
+
+				(firstIx,firstLine,firstRecord) = (batchStart,lineNumber,recordNumber)
+				for ix in xrange(batchStart,batchEnd):
+					lineNumber += 1
+					if (text[starts[ix]] == "@"):
+						yield self.filter(text,data,starts[firstIx:ix],ends[firstIx:ix],firstLine,firstRecord)
+						yield [(lineNumber,recordNumber,text[starts[ix]:ends[ix]],True)]
+						(firstIx,firstLine,firstRecord) = (ix+1,lineNumber,recordNumber)
+						continue
+					if (headLimit != None) and (recordNumber >= headLimit):
+						yield self.filter(text,data,starts[firstIx:ix],ends[firstIx:ix],firstLine,firstRecord)
+						print >>stderr, "limit of %d sam records reached" % headLimit
+						return
+					recordNumber += 1
+				yield self.filter(text,data,starts[firstIx:batchEnd],ends[firstIx:batchEnd],firstLine,firstRecord)
+
+	# filter--
+	#	Returns a list of (lineNumber,recordNumber,line,checked) for each record
+	#	in a batch that satisfies the criteria (or for every record, if the
+	#	batch can't be parsed);  the batch's lines are text[start:end], and
+	#	lineNumber and recordNumber are those of the line and record preceding
+	#	the batch.
+
+	def filter(self,text,data,starts,ends,lineNumber,recordNumber):
+		if (len(starts) == 0): return []
+		(firstLine,firstRecord) = (lineNumber+1,recordNumber+1)
+		lastRecord = recordNumber + len(starts)
+		if (reportProgress != None):
+			firstReport = reportProgress * ((firstRecord + reportProgress - 1) / reportProgress)
+			for reportNumber in xrange(firstReport,lastRecord+1,reportProgress):
+				report_records_read(reportNumber)
+
+		self.records += len(starts)
+		if (runStats != None):
+			runStats.mark(None)	# (in case the last record was being timed)
+			runStats.counts[self.readCounter] += len(starts)
+			runStats.begin("filter")
+		keep = self.evaluate(data,starts,ends)
+		if (runStats != None): runStats.end()
+		if (keep is None):
+			self.unparsed += len(starts)
+			return zip(xrange(firstLine,firstLine+len(starts)),xrange(firstRecord,lastRecord+1),
+			           [text[start:end] for (start,end) in izip(starts.tolist(),ends.tolist())],
+			           repeat(False))
+
+		keptIxs = numpy.flatnonzero(keep)
+		self.rejected += len(starts) - len(keptIxs)
+		if (runStats != None):
+			runStats.counts[self.rejectedCounter] += len(starts) - len(keptIxs)
+		return zip((keptIxs+firstLine).tolist(),(keptIxs+firstRecord).tolist(),
+		           [text[start:end] for (start,end) in izip(starts[keptIxs].tolist(),ends[keptIxs].tolist())],
+		           repeat(True))
+
+	# evaluate--
+	#	Returns an array of booleans, true for each record in a batch that
+	#	satisfies the criteria, or None if the batch can't be parsed.
+
+	def evaluate(self,data,starts,ends):
+		base = starts[0]
+		data = data[base:ends[-1]]
+		(starts,ends) = (starts-base,ends-base)
+
+		# locate the tabs that end each of the columns we need;  every column
+		# up to the last one we need must be non-empty, and there must be no
+		# other whitespace before it (otherwise line.split() would see
+		# different columns than we do)
+
+		lastCol = self.columns[-1]
+		tabs = numpy.flatnonzero(data == 9)
+		tabIxs = numpy.searchsorted(tabs,starts)
+		if (tabIxs[-1] + lastCol >= len(tabs)): return None
+		colEnds = [tabs[tabIxs+col] for col in xrange(lastCol+1)]
+		if ((colEnds[lastCol] >= ends).any()): return None
+
+		colStarts = [starts] + [colEnd+1 for colEnd in colEnds[:-1]]
+		for col in xrange(lastCol+1):
+			if ((colEnds[col] <= colStarts[col]).any()): return None
+
+		otherSpace = self.otherSpace[numpy.searchsorted(self.otherSpace,base):
+		                             numpy.searchsorted(self.otherSpace,base+len(data))] - base
+		if (len(otherSpace) > 0):
+			lineIxs = numpy.searchsorted(starts,otherSpace,side="right") - 1
+			if ((otherSpace < colEnds[lastCol][lineIxs]).any()): return None
+
+		# convert the columns to integers
+
+		fields = {}
+		for col in self.columns:
+			vals = batch_int_column(data,colStarts[col],colEnds[col])
+			if (vals is None): return None
+			fields[col] = vals
+
+		context = {"__builtins__":None, "abs":abs}
+		for name in self.names:
+			if (name == "FLAGS"): context[name] = fields[samFieldToColumn["FLAG"]]
+			elif (name == "POS"): context[name] = fields[samFieldToColumn["POS"]] - 1
+			else:                 context[name] = fields[samFieldToColumn[name]]
+
+		if (runStats == None):
+			return eval(self.code,context)
+
+		keep = numpy.ones(len(starts),dtype=bool)
+		for (code,counter) in zip(self.termCodes,self.counters):
+			passed = eval(code,context)
+			runStats.counts[counter] += int(numpy.count_nonzero(keep & ~passed))
+			keep &= passed
+		return keep
+
+	def report(self,f):
+		print >>f, "batch filter: %s" % self.source
+		print >>f, "batch filter: %s records, %s rejected, %s in batches that couldn't be parsed" \
+		         % (commatize(self.records),commatize(self.rejected),commatize(self.unparsed))
+
+
+# batch_int_column--
+#	Convert the fields of a column of a batch (see BatchFilter) to an array of
+#	integers;  each field is data[start:end].  Returns None if any field is not
+#	an integer.
+
+def batch_int_column(data,starts,ends):
+	widths = ends - starts
+	maxWidth = widths.max()
+	if (maxWidth > 18): return None	# (might not fit in 64 bits)
+
+	offsets  = numpy.arange(maxWidth)
+	inField  = offsets < widths[:,numpy.newaxis]
+	chars    = data[numpy.where(inField,starts[:,numpy.newaxis]+offsets,0)].astype(numpy.int64)
+	negative = (chars[:,0] == ord("-"))
+	isDigit  = inField & ~((offsets == 0) & negative[:,numpy.newaxis])
+	digits   = chars - ord("0")
+	if ((isDigit & ((digits < 0) | (digits > 9))).any()): return None
+	if ((widths - negative < 1).any()): return None
+
+	vals = numpy.zeros(len(starts),dtype=numpy.int64)
+	for ix in xrange(maxWidth):
+		vals = numpy.where(isDigit[:,ix],10*vals+digits[:,ix],vals)
+	return numpy.where(negative,-vals,vals)
+
+
+# SamText--
+#	SAM text to be read by a BatchFilter in large blocks, rather than by
+#	lines;  prefix is whatever has already been read from the file (see
+#	sniff_bgzf).  blocks() yields (text,length), where text[:length] ends at
+#	the end of a line (text itself may continue into the next line, which
+#	saves copying the block).
+
+class SamText:
+	blockSize = 1024*1024
+
+	def __init__(self,f,prefix=""):
+		self.f      = f
+		self.prefix = prefix
+
+	def read_ahead(self,numLines):
+		# returns the next lines, which blocks() will still yield
+		lines = []
+		while (len(lines) < numLines):
+			line = self.f.readline()
+			if (line == ""): break
+			lines += [line]
+		self.prefix += "".join(lines)
+		return self.prefix.splitlines(True)[:numLines]
+
+	def blocks(self):
+		leftover = self.prefix
+		while (True):
+			block = self.f.read(self.blockSize)
+			if (block == ""): break
+			text = leftover + block if (leftover != "") else block
+			lineEnd = text.rfind("\n") + 1
+			if (lineEnd > 0): yield (text,lineEnd)
+			leftover = text[lineEnd:]
+		if (leftover != ""): yield (leftover,len(leftover))
+
+
+# RunStats--
+#	Counts and times for the --stats report.  Each count has a slot in
+#	self.counts, allocated (by key) when the record processor is generated;
+#	the generated code adds to the slots directly, and only where it already
+#	discards or writes something, so a record costs no more than an addition.
+#	A key is a criterion, a name (e.g. "records read" or "subset"), or
+#	(what,spec) for one output's counts.
+#
+#	Phases that are outside the record loop (setup, pairing the mates that
+#	remain at the end, writing depth or mean, and the batch filter) are timed
+#	directly, with begin() and end().  Timing every record in the loop would
+#	cost more than some of the phases being timed, so one record in
+#	sampleRate is timed, with mark() at the start of each phase;  the
+#	report scales those times by the number of records (--profile=phases
+#	sets sampleRate to 1, timing every record).  What mark() itself adds to
+#	each interval it times (measured by timing nothing) is deducted.
+#
+#	A worker process returns the difference between two snapshot()s, which is
+#	added to the main process' RunStats.
+
+statsPhases       = ["setup","parse","filter","context","merge","write"]
+statsSampleRate   = 64
+statsCalibrations = 1000
+
+class RunStats:
+
+	def __init__(self,sampleRate=statsSampleRate):
+		self.sampleRate   = sampleRate
+		self.keys         = []
+		self.counts       = []
+		self.times        = dict([(phase,[0.0,0.0]) for phase in statsPhases])
+		self.sampledTimes = dict([(phase,[0.0,0.0,0]) for phase in statsPhases])
+		self.sampled      = 0
+		self.phase        = None
+		self.markPhase    = None
+		self.startTimes   = (wall_clock(),cpu_clock(),sum(process_times()[2:4]))
+
+		self.sampledTimes["calibration"] = [0.0,0.0,0]
+		for _ in xrange(statsCalibrations): self.mark("calibration")
+		self.mark(None)
+		(wall,cpu,numIntervals) = self.sampledTimes.pop("calibration")
+		self.markOverhead = (wall/numIntervals,cpu/numIntervals)
+		self.sampled = 0
+
+	def counter(self,key):
+		# (the list of counts is never replaced, so generated code can hold it)
+		if (key not in self.keys):
+			self.keys   += [key]
+			self.counts += [0]
+		return self.keys.index(key)
+
+	def count(self,key):
+		if (key not in self.keys): return 0
+		return self.counts[self.keys.index(key)]
+
+	def begin(self,phase):
+		self.end()
+		(self.phase,self.phaseStart) = (phase,(wall_clock(),cpu_clock()))
+
+	def end(self):
+		if (self.phase == None): return
+		(wallStart,cpuStart) = self.phaseStart
+		times = self.times[self.phase]
+		times[0] += wall_clock() - wallStart
+		times[1] += cpu_clock()  - cpuStart
+		self.phase = None
+
+	def mark(self,phase):
+		# phase is None at the end of a timed record
+		now = (wall_clock(),cpu_clock())
+		if (self.markPhase != None):
+			times = self.sampledTimes[self.markPhase]
+			times[0] += now[0] - self.markStart[0]
+			times[1] += now[1] - self.markStart[1]
+			times[2] += 1
+		elif (phase != None):
+			self.sampled += 1
+		(self.markPhase,self.markStart) = (phase,now)
+
+	def records_timed(self):
+		# (records rejected by the batch filter never reach the record loop)
+		return self.count("records read") - self.count("batch filter rejected")
+
+	def phase_times(self):
+		# returns [(phase,wall,cpu)], the sampled times scaled to all records
+		numTimed = self.records_timed()
+		scale = float(numTimed) / self.sampled if (self.sampled > 0) else 0.0
+		(wallOverhead,cpuOverhead) = self.markOverhead
+		phaseTimes = []
+		for phase in statsPhases:
+			(wall,cpu) = self.times[phase]
+			(sampledWall,sampledCpu,numIntervals) = self.sampledTimes[phase]
+			sampledWall = max(0.0,sampledWall - numIntervals*wallOverhead)
+			sampledCpu  = max(0.0,sampledCpu  - numIntervals*cpuOverhead)
+			phaseTimes += [(phase,wall+scale*sampledWall,cpu+scale*sampledCpu)]
+		return phaseTimes
+
+	def total_times(self):
+		# returns (wall,cpu) since we were created;  cpu includes any workers'
+		(wallStart,cpuStart,childCpuStart) = self.startTimes
+		cpu = cpu_clock() - cpuStart + sum(process_times()[2:4]) - childCpuStart
+		return (wall_clock()-wallStart,cpu)
+
+	def snapshot(self):
+		values = list(self.counts) + [self.sampled]
+		for phase in statsPhases:
+			values += self.times[phase] + self.sampledTimes[phase]
+		return values
+
+	def add(self,delta):
+		numCounts = len(self.counts)
+		for ix in xrange(numCounts): self.counts[ix] += delta[ix]
+		self.sampled += delta[numCounts]
+		ix = numCounts + 1
+		for phase in statsPhases:
+			for times in [self.times[phase],self.sampledTimes[phase]]:
+				for valueIx in xrange(len(times)):
+					times[valueIx] += delta[ix]
+					ix += 1
+
+
+runStats = None
+
+
+def stats_counter(key):
+	if (runStats == None): return None
+	return runStats.counter(key)
+
+
+# write_stats--
+#	Write the --stats report, as JSON.  Criteria are listed in the order they
+#	are applied (those in the batch filter, those in the flag prefilter, the
+#	subset, chromosome and region limits, then the rest), and each is said to
+#	have evaluated whatever the ones before it didn't reject.  Times are in
+#	seconds;  with --jobs, the phases are summed over the worker processes.
+
+def write_stats(filename,flagCriteria):
+	stages = []
+	if (batchFilter != None):
+		stages += [(criterion.kind,criterion.text,criterion) for criterion in batchFilter.criteria]
+	stages += [(criterion.kind,criterion.text,criterion) for criterion in flagCriteria]
+	if (subsetN != None):
+		stages += [("subset","qname=%d/%d" % (subsetK,subsetN),"subset")]
+	if (chromsOfInterest != None):
+		stages += [("chromosomes",",".join(chromsOfInterest),"chromosomes")]
+	if (regionsOfInterest != None):
+		stages += [("regions",",".join([region_text(region) for region in regionsOfInterest]),"regions")]
+	staged = [key for (_,_,key) in stages]
+	stages += [(criterion.kind,criterion.text,criterion) for criterion in criteria
+	                                                      if (criterion not in staged)]
+
+	numRead = runStats.count("records read")
+	report = OrderedDict()
+	report["records read"] = numRead
+
+	numRemaining = numRead
+	report["criteria"] = []
+	for (kind,text,key) in stages:
+		numRejected = runStats.count(key)
+		report["criteria"] += [OrderedDict([("kind",kind),("criterion",text),
+		                                    ("evaluated",numRemaining),("rejected",numRejected)])]
+		numRemaining -= numRejected
+	report["records kept"] = numRemaining
+
+	report["outputs"] = []
+	for spec in outputSpecs:
+		output = OrderedDict()
+		output["name"]     = spec.name
+		output["filename"] = spec.filename if (spec.filename != None) else "-"
+		if (partitionKey != None):
+			partition = outputFiles[0]
+			output["partition"] = OrderedDict([("key",partitionKey),("files",partition.filenames)])
+			if (partition.values != []):
+				output["partition"]["values"] = \
+				    OrderedDict([(str(value),partition.filenames[ix % partitionN])
+				                 for (ix,value) in enumerate(partition.values)])
+		if (spec.criteria != []):
+			output["criteria"] = [criterion.text for criterion in spec.criteria]
+			output["rejected"] = runStats.count(("rejected",spec))
+		if (spec.pairCriteria != []):
+			output["pair criteria"] = [criterion.text for criterion in spec.pairCriteria]
+		if (spec.mergeEm):
+			mates = OrderedDict()
+			mates["merged"]    = runStats.count(("merged",spec))
+			mates["discarded"] = OrderedDict([(reason,runStats.count((reason,spec)))
+			                                  for reason in mateDiscardReasons])
+			output["mates"] = mates
+		output["intervals written"] = runStats.count(("written",spec))
+		report["outputs"] += [output]
+
+	numTimed = runStats.records_timed()
+	report["phases"] = OrderedDict()
+	for (phase,wall,cpu) in runStats.phase_times():
+		report["phases"][phase] = OrderedDict([("wall",round(wall,6)),("cpu",round(cpu,6))])
+	(wall,cpu) = runStats.total_times()
+	report["total"] = OrderedDict([("wall",round(wall,6)),("cpu",round(cpu,6))])
+	report["records timed"] = OrderedDict([("sampled",runStats.sampled),("of",numTimed)])
+
+	f = file(filename,"wt")
+	json_dump(report,f,indent=2,separators=(",",": "))
+	f.write("\n")
+	f.close()
+
+
+# write_phase_profile--
+#	Write the --profile=phases report, a table of the time spent in each
+#	phase, and per record read.
+
+def write_phase_profile(filename):
+	numRead = runStats.count("records read")
+	f = file(filename,"wt")
+	print >>f, "%-8s %11s %11s %11s" % ("#phase","wall(s)","cpu(s)","cpu(us)/rec")
+	phaseTimes = runStats.phase_times()
+	phaseTimes += [("total",) + runStats.total_times()]
+	for (phase,wall,cpu) in phaseTimes:
+		perRecord = 1e6*cpu/numRead if (numRead > 0) else 0.0
+		print >>f, "%-8s %11.6f %11.6f %11.3f" % (phase,wall,cpu,perRecord)
+	print >>f, "# %d records read, %d timed" % (numRead,runStats.sampled)
+	f.close()
+
+
+mateDiscardReasons = ["singleton","multi-chromosome","shorter than min","longer than max","unmapped",
+                      "concordant","pair criteria","duplicate"]
+
+def region_text(region):
+	(chrom,start,end) = region
+	if (end == None): return chrom
+	return "%s:%d-%d" % (chrom,start+1,end)
+
+
+# PartitionFiles--
+#	The files for --partition, which stand in for the output file.  Records
+#	are written to the shards directly (see partition_write_source);  write()
+#	writes to all of them, and is only used for header lines.  For keys that
+#	aren't hashed, writeOf maps each value seen so far to its shard's write
+#	function, and new_shard() gives a new value the next shard in turn.
+
+class PartitionFiles:
+
+	def __init__(self,prefix,numShards):
+		self.filenames = ["%s%d" % (prefix,shardNum+1) for shardNum in xrange(numShards)]
+		self.shards    = [file(filename,"wt") for filename in self.filenames]
+		self.writeOf   = {}
+		self.values    = []
+
+	def new_shard(self,value):
+		shardNum = len(self.values) % len(self.shards)
+		self.values += [value]
+		self.writeOf[value] = self.shards[shardNum].write
+		return self.writeOf[value]
+
+	def write(self,s):
+		for f in self.shards: f.write(s)
+
+	def close(self):
+		for f in self.shards: f.close()
+
+
+# StackSampler--
+#	Statistical profiler for --profile=sample.  Every profileSampleInterval
+#	seconds of cpu time (ITIMER_PROF), the signal handler records the python
+#	stack it interrupted;  a stack is kept as a string of its frames from the
+#	outermost in, so counting a sample is one dict update.  The interface
+#	(enable(), disable() and dump_stats()) is cProfile's.
+#
+#	dump_stats() writes "collapsed" stacks, the format flamegraph.pl (and
+#	speedscope, etc.) read.  The generated record processor's frames show up
+#	as "<sam processor>".
+
+profileSampleInterval = 0.005
+
+class StackSampler:
+
+	def __init__(self,interval=profileSampleInterval):
+		self.interval   = interval
+		self.stacks     = {}
+		self.frameNames = {}
+
+	def enable(self):
+		signal.signal(signal.SIGPROF,self.sample)
+		signal.siginterrupt(signal.SIGPROF,False)
+		signal.setitimer(signal.ITIMER_PROF,self.interval,self.interval)
+
+	def disable(self):
+		signal.setitimer(signal.ITIMER_PROF,0)
+		signal.signal(signal.SIGPROF,signal.SIG_DFL)
+
+	def sample(self,signalNum,frame):
+		frameNames = self.frameNames
+		names = []
+		while (frame != None):
+			code = frame.f_code
+			try:
+				names += [frameNames[code]]
+			except KeyError:
+				name = "%s (%s:%d)" % (code.co_name,basename(code.co_filename),code.co_firstlineno)
+				frameNames[code] = name = name.replace(";",":")
+				names += [name]
+			frame = frame.f_back
+		names.reverse()
+		stack = ";".join(names)
+		self.stacks[stack] = self.stacks.get(stack,0) + 1
+
+	def dump_stats(self,filename):
+		f = file(filename,"wt")
+		for stack in sorted(self.stacks):
+			print >>f, "%s %d" % (stack,self.stacks[stack])
+		f.close()
+
+
+# CigarCache--
+#	Bounded cache of parsed cigar strings.  This is an approximation of LRU
+#	that is cheap on a hit;  entries live in a recent generation and an older
+#	one, and when the recent generation fills it becomes the older one (and
+#	whatever was in the older one is forgotten).  A hit in the older
+#	generation moves the entry back into the recent one.
+#
+#	The generated record processor looks in self.recent directly, and only
+#	calls self.lookup() when that misses;  self.recent is never replaced, so
+#	the processor can hold on to it.
+
+class CigarCache:
+	def __init__(self,capacity):
+		self.capacity   = max(1,capacity)
+		self.recent     = {}
+		self.older      = {}
+		self.lookups    = 0	# (only counted by info(), or when debugging)
+		self.misses     = 0
+		self.promotions = 0
+		self.parses     = 0
+		self.turnovers  = 0
+
+	def info(self,cigar):
+		self.lookups += 1
+		cigarInfo = self.recent.get(cigar)
+		if (cigarInfo == None): cigarInfo = self.lookup(cigar)
+		return cigarInfo
+
+	def lookup(self,cigar):
+		# called when cigar isn't in the recent generation
+		if (cigar == "*"): return None
+		return self.find(cigar,split_cigar)
+
+	def lookup_packed(self,packedCigar):
+		# same as lookup(), for a BAM record's packed cigar (we don't mix
+		# packed and text keys in the same run)
+		if (packedCigar == ""): return None
+		return self.find(packedCigar,split_packed_cigar)
+
+	def find(self,key,split):
+		self.misses += 1
+		cigarInfo = self.older.get(key)
+		if (cigarInfo != None):
+			self.promotions += 1
+		else:
+			cigarInfo = split(key)
+			self.parses += 1
+		if (len(self.recent) >= self.capacity):
+			self.older = self.recent.copy()
+			self.recent.clear()
+			self.turnovers += 1
+		self.recent[key] = cigarInfo
+		return cigarInfo
+
+	def report(self,f):
+		print >>f, "=== cigar cache ==="
+		print >>f, "  capacity:   %s (per generation)" % commatize(self.capacity)
+		print >>f, "  lookups:    %s" % commatize(self.lookups)
+		print >>f, "  misses:     %s (%s found in older generation)" \
+		         % (commatize(self.misses),commatize(self.promotions))
+		print >>f, "  parses:     %s" % commatize(self.parses)
+		print >>f, "  turnovers:  %s" % commatize(self.turnovers)
+		print >>f, "  distinct:   %s" % commatize(len(self.recent)+len(self.older))
+		if (self.lookups > 0):
+			hitRate = 1 - float(self.parses) / self.lookups
+			print >>f, "  hit rate:   %.2f%%" % (100*hitRate)
+
+
+cigarCache = CigarCache(10*1000)
+
+
 # evaluation context stuff--
 #	(see reference [2], lybniz2.sourceforge.net/safeeval.html)
 
@@ -868,6 +4039,9 @@ safeDict["log2"]    = log2
 safeDict["max"]     = max
 safeDict["min"]     = min
 
+safeGlobals = dict(safeDict)
+safeGlobals["__builtins__"] = None
+
 
 # criterion to python expression conversion--
 
@@ -883,21 +4057,21 @@ eqnObject     = eqnVar + "|" + eqnInt + "|" + eqnHex + "|" + eqnFloat + "|" + eq
 eqnExpression = eqnVar + "(" + eqnArith + ")" + "(" + eqnInt + "|" + eqnFloat + ")"
 eqnFlags      = "FLAGS *& *0x[0-9A-Fa-f]+"
 
-eqnRe = compile("\( *"
+eqnRe = re_compile("\( *"
               + "(?P<left>" + eqnObject + "|" + eqnExpression + "|" + eqnFlags + ")"
               + " *"
               + "(?P<operator>" + eqnOperator + ")"
               + " *"
               + "(?P<right>" + eqnObject + "|" + eqnExpression + ")"
               + " *\)")
-eqnExpressionRe = compile(
+eqnExpressionRe = re_compile(
                 "(?P<left>" + eqnVar + ")"
               + " *"
               + "(?P<operator>" + eqnArith + ")"
               + " *"
               + "(?P<right>" + eqnVar + "|" + eqnInt + "|" + eqnFloat + ")")
 
-eqnFlagsRe    = compile(eqnFlags)
+eqnFlagsRe    = re_compile(eqnFlags)
 
 
 def criterion_to_python(s):
@@ -1004,6 +4178,303 @@ def var_names(names1,names2):
 	return varNames
 
 
+# criterion compilation--
+#	Each criterion's python expression is parsed once into an abstract syntax
+#	tree (see reference [3]) and constant subexpressions are folded.  The
+#	result is converted back to python source, to be inlined into the
+#	generated record processor (see generate_sam_processor), in which the
+#	variables are local variables, e.g.
+#	  if (CIGAR == "*"): continue
+#	  if (not (RNEXT == "=")): continue
+#	Each criterion is also compiled separately into a code object, for the
+#	verbose evaluation done for --debug=evaluation, and if it only involves
+#	numeric fields it is converted to source that evaluates a whole batch of
+#	records (see vector_source and BatchFilter).  Criteria that can be decided
+#	from FLAG alone are marked as such (see flag_rejects), as are those that
+#	involve pair variables (which are evaluated per pair, in write_pair).
+#
+#	compile_criteria returns a list of criterion objects, requirements first.
+
+class Criterion: pass
+
+criterionToCode = {}
+
+def compile_criteria(requirements,prohibitions):
+	criteria = []
+
+	for (kind,criterionDict) in [("requirement",requirements),("prohibition",prohibitions)]:
+		for criterionStr in criterionDict:
+			(expression,_) = criterionDict[criterionStr]
+			tree = criterion_to_ast(expression)
+			if (not is_truth_test(tree)):
+				raise ValueError("%s \"%s\" doesn't evaluate to true or false" % (kind,criterionStr))
+			criterionToCode[expression] = compile(ast.Expression(body=tree),"<%s>" % kind,"eval")
+
+			criterion = Criterion()
+			criterion.kind       = kind
+			criterion.text       = criterionStr
+			criterion.expression = expression
+			criterion.source     = ast_to_source(tree)
+			criterion.vectorSource = vector_source(tree)
+			criterion.names      = []
+			for node in ast.walk(tree):
+				if (type(node) == ast.Name) and (node.id not in safeDict) \
+				  and (node.id != "None") and (node.id not in criterion.names):
+					criterion.names += [node.id]
+			criterion.flagOnly = ([name for name in criterion.names
+			                            if (name not in flagOnlyVariables)] == [])
+			criterion.isPair   = ([name for name in criterion.names
+			                            if (name in pairVariables)] != [])
+			if (criterion.isPair) \
+			  and ([name for name in criterion.names if (name not in pairVariables)] != []):
+				raise ValueError("\"%s\" involves pair variables and others" % criterionStr)
+			criteria += [criterion]
+
+	return criteria
+
+
+# flag_rejects--
+#	Find the FLAG values that a set of criteria reject, for criteria that
+#	can be decided from FLAG alone (e.g. "broken mates" or "(0x004 in FLAGS)").
+#	The record processor looks up each record's FLAG in this set before it
+#	splits the rest of the line or computes any other variable.  Values whose
+#	evaluation fails are left out, so those records get the usual treatment.
+#	Returns a dict mapping each rejected value to the first criterion that
+#	rejects it (see --stats).
+
+flagOnlyVariables = ["FLAG","FLAGS","MORIENT"]
+flagValuesLimit   = 0x1000	# (0x800 is the highest flag bit defined)
+
+def flag_rejects(criteria):
+	rejects = {}
+	for flag in xrange(flagValuesLimit):
+		context = {"FLAG":flag, "FLAGS":flag, "MORIENT":mate_orientation(flag)}
+		for criterion in criteria:
+			try:
+				val = eval(criterionToCode[criterion.expression],safeGlobals,context)
+			except Exception:
+				break
+			if (criterion.kind == "requirement") and (not val): rejects[flag] = criterion; break
+			if (criterion.kind == "prohibition") and (val):     rejects[flag] = criterion; break
+	return rejects
+
+
+# criterion_to_ast--
+#	Parse a criterion's python expression into a tree, folding constants and
+#	validating that every name is something the context (or safeDict) will
+#	provide.  ValueError is raised if the expression can't be used.
+
+def criterion_to_ast(criterion):
+	try:
+		tree = ast.parse(criterion,mode="eval").body
+	except SyntaxError:
+		raise ValueError("\"%s\" is not a valid expression" % criterion)
+
+	tree = ConstantFolder().visit(tree)
+	ast.fix_missing_locations(tree)
+
+	for node in ast.walk(tree):
+		if (not isinstance(node,criterionNodeTypes)):
+			raise ValueError("\"%s\" contains an unsupported construct (%s)" \
+			               % (criterion,type(node).__name__))
+		if (type(node) == ast.Call) and ((node.starargs != None) or (node.kwargs != None)):
+			raise ValueError("\"%s\" contains an unsupported construct (%s)" \
+			               % (criterion,"argument list"))
+		if (type(node) != ast.Name): continue
+		if (type(node.ctx) != ast.Load):
+			raise ValueError("\"%s\" is not a valid expression" % criterion)
+		if (node.id in safeDict) or (node.id == "None"): continue
+		if (node.id in knownVariables) or (node.id in pairVariables): continue
+		if (node.id == "LINENUMBER"): continue
+		raise ValueError("\"%s\" is not a known name, in \"%s\"" % (node.id,criterion))
+
+	return tree
+
+
+# is_truth_test--
+#	Returns true if an expression's tree is a comparison (including an "in"
+#	test), a "not", or an "and" or "or" of those, so that it evaluates to true
+#	or false rather than to some other value (e.g. "(MAPQ)").
+
+def is_truth_test(node):
+	if (type(node) == ast.Compare): return True
+	if (type(node) == ast.UnaryOp) and (type(node.op) == ast.Not): return True
+	if (type(node) == ast.BoolOp):
+		return ([val for val in node.values if (not is_truth_test(val))] == [])
+	return False
+
+
+criterionNodeTypes = (ast.Num,ast.Str,ast.Name,ast.Tuple,ast.List,
+                      ast.BinOp,ast.UnaryOp,ast.BoolOp,ast.Compare,ast.Call,
+                      ast.expr_context,ast.operator,ast.unaryop,ast.boolop,ast.cmpop)
+
+
+class ConstantFolder(ast.NodeTransformer):
+
+	def visit_Name(self,node):
+		if (node.id in ["e","pi"]):
+			return ast.copy_location(ast.Num(n=safeDict[node.id]),node)
+		return node
+
+	def visit_UnaryOp(self,node):
+		self.generic_visit(node)
+		if (type(node.operand) == ast.Num) and (type(node.op) in [ast.USub,ast.UAdd]):
+			return ast.copy_location(ast.Num(n=constant_value(node)),node)
+		return node
+
+	def visit_BinOp(self,node):
+		self.generic_visit(node)
+		if (type(node.left) == ast.Num) and (type(node.right) == ast.Num):
+			try:
+				return ast.copy_location(ast.Num(n=constant_value(node)),node)
+			except ArithmeticError:
+				pass # (leave it for run time to complain about)
+		return node
+
+	def visit_Call(self,node):
+		self.generic_visit(node)
+		if (type(node.func) == ast.Name) and (node.func.id in safeDict) \
+		  and (node.keywords == []) and (node.starargs == None) and (node.kwargs == None) \
+		  and ([arg for arg in node.args if (type(arg) != ast.Num)] == []):
+			try:
+				return ast.copy_location(ast.Num(n=constant_value(node)),node)
+			except (ArithmeticError,ValueError):
+				pass # (leave it for run time to complain about)
+		return node
+
+
+# ast_to_source--
+#	Convert a criterion's tree back to python source.  Only the node types
+#	that criterion_to_ast allows are supported, and every subexpression is
+#	parenthesized, so we needn't worry about operator precedence.
+
+astOpToSource = { \
+	ast.Add   : "+",   ast.Sub    : "-",      ast.Mult  : "*",  ast.Div    : "/",
+	ast.Mod   : "%",   ast.Pow    : "**",     ast.FloorDiv : "//",
+	ast.BitAnd: "&",   ast.BitOr  : "|",      ast.BitXor: "^",
+	ast.LShift: "<<",  ast.RShift : ">>",
+	ast.Eq    : "==",  ast.NotEq  : "!=",     ast.Lt    : "<",  ast.LtE    : "<=",
+	ast.Gt    : ">",   ast.GtE    : ">=",     ast.In    : "in", ast.NotIn  : "not in",
+	ast.Is    : "is",  ast.IsNot  : "is not",
+	ast.And   : "and", ast.Or     : "or",
+	ast.Not   : "not ",ast.USub   : "-",      ast.UAdd  : "+",  ast.Invert : "~"
+	}
+
+def ast_to_source(node):
+	nodeType = type(node)
+	if (nodeType == ast.Num):
+		return repr(node.n)
+	if (nodeType == ast.Str):
+		return repr(node.s)
+	if (nodeType == ast.Name):
+		return node.id
+	if (nodeType == ast.Tuple) or (nodeType == ast.List):
+		items = [ast_to_source(item) for item in node.elts]
+		if (nodeType == ast.List): return "[%s]" % ",".join(items)
+		if (len(items) == 1):      return "(%s,)" % items[0]
+		return "(%s)" % ",".join(items)
+	if (nodeType == ast.BinOp):
+		return "(%s %s %s)" % (ast_to_source(node.left),astOpToSource[type(node.op)],ast_to_source(node.right))
+	if (nodeType == ast.UnaryOp):
+		return "(%s%s)" % (astOpToSource[type(node.op)],ast_to_source(node.operand))
+	if (nodeType == ast.BoolOp):
+		op = " %s " % astOpToSource[type(node.op)]
+		return "(%s)" % op.join([ast_to_source(value) for value in node.values])
+	if (nodeType == ast.Compare):
+		s = [ast_to_source(node.left)]
+		for (op,right) in zip(node.ops,node.comparators):
+			s += [astOpToSource[type(op)],ast_to_source(right)]
+		return "(%s)" % " ".join(s)
+	if (nodeType == ast.Call):
+		args = [ast_to_source(arg) for arg in node.args]
+		return "%s(%s)" % (ast_to_source(node.func),",".join(args))
+	raise ValueError("can't convert %s to python source" % nodeType.__name__)
+
+
+def constant_value(node):
+	node = ast.fix_missing_locations(ast.Expression(body=node))
+	return eval(compile(node,"<constant>","eval"),safeGlobals)
+
+
+# vector_source--
+#	Convert a criterion's tree to source that evaluates it for a batch of
+#	records, with each name bound to a NumPy array (see BatchFilter);  returns
+#	None if the criterion can't be evaluated that way.  Only the fields in
+#	batchFilterFields can be used, and only arithmetic and comparisons.
+#
+#	Since "and", "or" and "not" don't apply to arrays, they become "&", "|"
+#	and "~", and any number used as a truth value is compared to zero.  Every
+#	comparison must involve a field, so that each of these applies to an array
+#	of booleans.
+
+batchFilterFields = ["FLAG","FLAGS","POS","MAPQ","PNEXT","TLEN"]
+
+vectorCompareOps = [ast.Eq,ast.NotEq,ast.Lt,ast.LtE,ast.Gt,ast.GtE]
+vectorArithOps   = [ast.Add,ast.Sub,ast.Mult,ast.BitAnd,ast.BitOr,ast.BitXor]
+vectorByConstOps = [ast.Mod,ast.FloorDiv,ast.LShift,ast.RShift]
+
+def vector_source(node):
+	try:
+		return vector_truth_source(node)
+	except ValueError:
+		return None
+
+
+def vector_truth_source(node):
+	nodeType = type(node)
+	if (nodeType == ast.BoolOp):
+		op = " %s " % {ast.And:"&", ast.Or:"|"}[type(node.op)]
+		return "(%s)" % op.join([vector_truth_source(value) for value in node.values])
+	if (nodeType == ast.UnaryOp) and (type(node.op) == ast.Not):
+		return "(~%s)" % vector_truth_source(node.operand)
+	if (nodeType == ast.Compare):
+		terms = []
+		left = node.left
+		for (op,right) in zip(node.ops,node.comparators):
+			if (type(op) not in vectorCompareOps): raise ValueError
+			if (not involves_field(left)) and (not involves_field(right)): raise ValueError
+			terms += ["(%s %s %s)" % (vector_number_source(left),astOpToSource[type(op)],
+			                          vector_number_source(right))]
+			left = right
+		if (len(terms) == 1): return terms[0]
+		return "(%s)" % " & ".join(terms)
+	if (not involves_field(node)): raise ValueError
+	return "(%s != 0)" % vector_number_source(node)
+
+
+def vector_number_source(node):
+	nodeType = type(node)
+	if (nodeType == ast.Num):
+		return repr(node.n)
+	if (nodeType == ast.Name):
+		if (node.id not in batchFilterFields): raise ValueError
+		return node.id
+	if (nodeType == ast.BinOp):
+		opType = type(node.op)
+		if (opType in vectorByConstOps):
+			# (these are only allowed with a constant on the right, so that
+			#  division by zero and large shifts behave as they do for a
+			#  single record)
+			if (type(node.right) != ast.Num) or (type(node.right.n) not in [int,long]): raise ValueError
+			if (node.right.n <= 0) or (node.right.n >= 32): raise ValueError
+		elif (opType not in vectorArithOps):
+			raise ValueError
+		return "(%s %s %s)" % (vector_number_source(node.left),astOpToSource[opType],
+		                       vector_number_source(node.right))
+	if (nodeType == ast.UnaryOp) and (type(node.op) in [ast.USub,ast.UAdd,ast.Invert]):
+		return "(%s%s)" % (astOpToSource[type(node.op)],vector_number_source(node.operand))
+	if (nodeType == ast.Call) and (type(node.func) == ast.Name) and (node.func.id == "abs") \
+	  and (len(node.args) == 1) and (node.keywords == []):
+		return "abs(%s)" % vector_number_source(node.args[0])
+	raise ValueError
+
+
+def involves_field(node):
+	for subNode in ast.walk(node):
+		if (type(subNode) == ast.Name) and (subNode.id in batchFilterFields): return True
+	return False
+
+
 # int_or_string--
 #	Parse a string as an integer, leaving it as a string if it fails
 
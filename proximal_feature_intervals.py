@@ -6,6 +6,7 @@ other.
 
 from sys  import argv,stdin,stdout,stderr,exit
 from math import ceil
+from binary_intervals import IntervalWriter,read_binary_intervals
 
 
 def usage(s=None):
@@ -24,6 +25,11 @@ usage: cat <intervals> | proximal_feature_intervals <intervals filename>
   --origin=zero         input intervals are origin-zero, half-open
                         (this is the default)
                         (output intervals are always origin-zero, half-open)
+  --in=binary           both sets of features are binary interval streams (see
+                        binary_intervals.py);  a feature's value is the first
+                        value of its record (or 1 if records have no values)
+  --out=binary          write the output as a binary interval stream, with the
+                        second feature's start and end as the values
   --head=<number>       limit the number of input lines
 
 Input intervals are of the form <chrom> <start> <end>, and can be in random
@@ -37,7 +43,7 @@ can hold them in memory."""
 
 
 def main():
-	global headLimit,origin,mutuallyClosest
+	global headLimit,origin,inputFormat,mutuallyClosest
 	global debug
 
 	# parse args
@@ -47,6 +53,8 @@ def main():
 	mutuallyClosest   = False
 	valueCutoff       = None
 	origin            = "zero"
+	inputFormat       = "text"
+	outputFormat      = "text"
 	headLimit         = None
 	debug             = []
 
@@ -69,6 +77,10 @@ def main():
 			if (origin == "0"): origin = "zero"
 			if (origin == "1"): origin = "one"
 			assert (origin in ["zero","one"]), "can't understand %s" % arg
+		elif (arg in ["--in=binary","--in=text"]):
+			inputFormat = argVal
+		elif (arg in ["--out=binary","--out=text"]):
+			outputFormat = argVal
 		elif (arg == "--debug"):
 			debug += ["debug"]
 		elif (arg.startswith("--debug=")):
@@ -86,11 +98,15 @@ def main():
 	if (features2Filename == None):
 		usage ("you must give me a second set of features")
 
+	if (origin == "one") and (inputFormat == "binary"):
+		usage ("binary intervals are always origin-zero, so --origin=one can't be used")
+
 	# load the features
 
 	(chromToFeatures1,order1) = read_features(stdin,cutoff=valueCutoff)
 
-	f = file(features2Filename,"rt")
+	if (inputFormat == "binary"): f = file(features2Filename,"rb")
+	else:                         f = file(features2Filename,"rt")
 	(chromToFeatures2,order2) = read_features(f,filename=features2Filename,cutoff=valueCutoff)
 	f.close()
 
@@ -98,6 +114,14 @@ def main():
 
 	# process the features
 
+	if (outputFormat == "binary"):
+		writer = IntervalWriter(stdout,"i",2)
+		def write_pair(chrom,start1,end1,start2,end2):
+			writer.write(chrom,start1,end1,start2,end2)
+	else:
+		def write_pair(chrom,start1,end1,start2,end2):
+			print "%s\t%d\t%d\t%d\t%d" % (chrom,start1,end1,start2,end2)
+
 	for chrom in chromOrder:
 		if (chrom not in chromToFeatures1): continue
 		if (chrom not in chromToFeatures2): continue
@@ -143,7 +167,7 @@ def main():
 			for (start1,end1) in f1ToProximal:
 				(d,start2,end2) = f1ToProximal[(start1,end1)]
 				if (f2ToProximal[(start2,end2)] != (d,start1,end1)): continue
-				print "%s\t%d\t%d\t%d\t%d" % (chrom,start1,end1,start2,end2)
+				write_pair(chrom,start1,end1,start2,end2)
 		else:
 			# report all features with its closest mate
 			pairs = set()
@@ -158,7 +182,10 @@ def main():
 			pairs = list(pairs)
 			pairs.sort()
 			for (start1,end1,start2,end2) in pairs:
-				print "%s\t%d\t%d\t%d\t%d" % (chrom,start1,end1,start2,end2)
+				write_pair(chrom,start1,end1,start2,end2)
+
+	if (outputFormat == "binary"):
+		writer.close()
 
 
 def proximal_pairs(maxDistance,features1,features2):
@@ -210,9 +237,12 @@ def read_features(f,filename="(unnamed)",cutoff=None):
 	chromOrder      = []
 	chromToFeatures = {}
 
+	if (inputFormat == "binary"): reader = read_binary_features
+	else:                         reader = read_intervals
+
 	if (cutoff == None):
 		intervalNum = 0
-		for (lineNumber,chrom,start,end) in read_intervals(f):
+		for (lineNumber,chrom,start,end) in reader(f):
 			intervalNum += 1
 			if (headLimit != None) and (intervalNum > headLimit):
 				print >>stderr, "limit of %s intervals reached in %s" \
@@ -226,7 +256,7 @@ def read_features(f,filename="(unnamed)",cutoff=None):
 				chromToFeatures[chrom] += [(start,end,lineNumber)]
 	else:
 		intervalNum = 0
-		for (lineNumber,chrom,start,end,val) in read_intervals(f,withValues=True):
+		for (lineNumber,chrom,start,end,val) in reader(f,withValues=True):
 			intervalNum += 1
 			if (headLimit != None) and (intervalNum > headLimit):
 				print >>stderr, "limit of %s intervals reached in %s" \
@@ -305,6 +335,21 @@ def read_intervals(f,withValues=False):
 			assert (False), "bad line (%d): %s" % (lineNumber,line)
 
 
+# read_binary_features--
+#	Same as read_intervals, but from a binary stream;  records are numbered
+#	in place of line numbers.
+
+def read_binary_features(f,withValues=False):
+	for (recordNumber,record) in enumerate(read_binary_intervals(f)):
+		(chrom,start,end) = record[:3]
+		if (not withValues):
+			yield (recordNumber+1,chrom,start,end)
+		elif (len(record) > 3):
+			yield (recordNumber+1,chrom,start,end,record[3])
+		else:
+			yield (recordNumber+1,chrom,start,end,1)
+
+
 # parse a string as an integer, allowing units (e.g. "3.2M")
 
 def int_with_units(s):
@@ -4,7 +4,10 @@ Bare-bones SAM reading "class"
 """
 
 import sys
-from time import clock
+from time       import clock
+from bam_reader import BgzfReader,read_bam_header,unpack_bam_core,BAM_CORE_SIZE, \
+                       cigar_ops_to_string,seq_to_string,qual_to_string,tag_fields, \
+                       record_to_sam
 
 # column indexes for SAM required fields
 
@@ -127,6 +130,75 @@ def read_sam_records(f,include=None,recordLimit=None,reportProgress=None,progres
 		yield samrec
 
 
+# read_bam_records--
+#	Same as read_sam_records, but reading a BAM file directly;  f must be open
+#	in binary mode.  The record fields are the same strings a SAM line would
+#	have (except that flag is an int, as for SAM).  "line" is the record
+#	formatted as SAM text, and "line number" is the record number.
+
+def read_bam_records(f,include=None,recordLimit=None,reportProgress=None,progressFmt=None):
+
+	if (include == None):
+		include = ["tags"]
+
+	if (reportProgress != None):
+		prevTime = clock()
+		if (progressFmt == None): progressFmt = "(%.2f) read %d: %s"
+
+	bgzf = BgzfReader(f)
+	header = read_bam_header(bgzf)
+	refNames = header.refNames + ["*"]	# (so that refNames[-1] is "*")
+
+	readCount = 0
+	for record in bgzf.records():
+		if (recordLimit != None) and (readCount >= recordLimit):
+			print >>sys.stderr, "record limit of %d reached" % recordLimit
+			break
+
+		(refID,pos,nameLen,mapQ,_,numCigarOps,flag,seqLen,nextRefID,nextPos,iSize) \
+		  = unpack_bam_core(record)
+		cigarStart = BAM_CORE_SIZE + nameLen
+		seqStart   = cigarStart + 4*numCigarOps
+		qualStart  = seqStart + (seqLen+1)/2
+
+		samrec = SamRecord()
+		samrec.flag  = flag
+		samrec.qName = record[BAM_CORE_SIZE:cigarStart-1]
+		samrec.rName = refNames[refID]
+		samrec.rPos  = str(pos+1)
+		samrec.mapQ  = str(mapQ)
+		samrec.cigar = cigar_ops_to_string(record[cigarStart:seqStart])
+		if (nextRefID == refID) and (refID >= 0): samrec.mrnm = "="
+		else:                                     samrec.mrnm = refNames[nextRefID]
+		samrec.mPos  = str(nextPos+1)
+		samrec.iSize = str(iSize)
+		samrec.seq   = seq_to_string(record,seqStart,seqLen)
+		samrec.qual  = qual_to_string(record,qualStart,seqLen)
+
+		if ("line" in include):
+			samrec.line = record_to_sam(record,header.refNames)
+		if ("line number" in include):
+			samrec.lineNumber = readCount+1
+
+		if ("tags" in include):
+			tagFields = tag_fields(record,qualStart+seqLen)
+			if (tagFields != []):
+				tags = {}
+				for tag in tagFields:
+					(tag,val) = tag.split(":",1)
+					assert (tag not in tags)
+					tags[tag] = val
+				samrec.tags = tags
+
+		readCount += 1
+		if (reportProgress != None) and (readCount % reportProgress == 0):
+			currTime = clock()
+			print >>sys.stderr, progressFmt % (currTime-prevTime,readCount,samrec.qName)
+			prevTime = currTime
+
+		yield samrec
+
+
 def sam_flags_to_binary_string(flags):
 	s = []
 	f = flags